@@ -0,0 +1,62 @@
+"""Benchmark of `expand_many_nested` on synthetic `all_variants` frames, with
+variant-so-consequences drawn from a small set of shared entities, against
+the previous explode + apply + merge version. The merge joined on :db/id
+against one nested row per parent, so shared entities multiplied rows and
+the old version is only run on the smaller sizes.
+
+    python benchmarks/bench_expand_many.py [n_variants ...]
+"""
+import random
+import sys
+import time
+
+import pandas as pd
+
+import patternq.helpers as pqh
+import patternq.reference as pqr
+
+from bench_pull2fields import variant_entity
+
+
+def merge_expand_many_nested(qres_df, attribute):
+    qres_df = qres_df.explode(column=attribute)
+    qres_df["nested-db-id###"] = qres_df[attribute].apply(lambda l: l[":db/id"])
+    nested_entities = pd.json_normalize(qres_df[attribute].tolist())
+    nested_entities = pqh.clean_column_names(nested_entities)
+    result = qres_df.merge(nested_entities, left_on="nested-db-id###",
+                           right_on="db-id", how="left")
+    return result.drop(columns=['db-id_x', 'db-id_y', 'db-id', 'nested-db-id###'],
+                       errors='ignore')
+
+
+def variants_frame(n):
+    rng = random.Random(0)
+    qres = {"query_result": [[variant_entity(rng, i)] for i in range(n)],
+            pqh.enums_flattened_key: True}
+    return pqr.variant_fields(qres)
+
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(*sizes):
+    sizes = sizes or (1_000, 4_000, 16_000, 64_000, 256_000)
+    for n in sizes:
+        df = variants_frame(n)
+        elapsed, result = timed(lambda: pqh.expand_many_nested(df, "variant-so-consequences"))
+        line = f"{n:8d} variants -> {len(result):8d} rows  offsets: {elapsed:7.3f}s"
+        if n <= 16_000:
+            old, old_result = timed(
+                lambda: merge_expand_many_nested(df, "variant-so-consequences"), repeat=1)
+            line += f"  merge: {old:7.3f}s ({len(old_result)} rows)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,66 @@
+"""Micro-benchmark of enum ident flattening on a synthetic variant pull
+result, comparing the recursive postwalk, the copy on write
+`flatten_enum_idents` (walking an explicit stack), and flattening fused
+into JSON decoding.
+
+    python benchmarks/bench_flatten.py [n_variants]
+"""
+import json
+import random
+import sys
+import time
+
+import patternq.helpers as pqh
+
+
+def variant_result(n):
+    rng = random.Random(0)
+    impacts = [":variant.impact/" + i for i in ["modifier", "low", "moderate", "high"]]
+    relations = []
+    for i in range(n):
+        relations.append([{
+            ":db/id": 17592186045418 + i,
+            ":variant/id": f"chr{rng.randint(1, 22)}:{rng.randint(1, 10**8)}:A/T",
+            ":variant/ref-allele": "A",
+            ":variant/alt-allele": "T",
+            ":variant/classification": {":db/ident": ":variant.classification/missense"},
+            ":variant/type": {":db/ident": ":variant.type/snp"},
+            ":variant/feature": {":db/ident": ":variant.feature/transcript"},
+            ":variant/impact": {":db/ident": rng.choice(impacts)},
+            ":variant/genomic-coordinates": [{":genomic-coordinate/id": f"GRCh38:chr1:+:{i}"}],
+            ":variant/so-consequences": [{":so-sequence-feature/name": "missense_variant",
+                                          ":db/id": 17592186045000 + rng.randint(0, 40)}
+                                         for _ in range(rng.randint(0, 3))],
+            ":variant/gene": {":gene/hgnc-symbol": f"G{rng.randint(0, 20000)}"},
+        }])
+    return {"query_result": relations, "basis_t": 1000}
+
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(n=100_000):
+    raw = json.dumps(variant_result(n))
+    decode, _ = timed(lambda: json.loads(raw))
+    postwalk, expected = timed(lambda: pqh.postwalk(pqh.maybe_flatten_enum, json.loads(raw)))
+    copy_on_write, flattened = timed(lambda: pqh.flatten_enum_idents(json.loads(raw)))
+    fused, hooked = timed(lambda: json.loads(raw, object_hook=pqh.maybe_flatten_enum))
+    assert flattened["query_result"] == expected["query_result"]
+    assert hooked["query_result"] == expected["query_result"]
+    print(f"{n} variants, {len(raw) / 1e6:.1f} MB of JSON")
+    print(f"json.loads alone:               {decode:8.3f}s")
+    print(f"json.loads + postwalk:          {postwalk:8.3f}s")
+    print(f"json.loads + copy on write:     {copy_on_write:8.3f}s "
+          f"(flatten {(postwalk - decode) / max(copy_on_write - decode, 1e-9):.1f}x faster)")
+    print(f"json.loads with object_hook:    {fused:8.3f}s "
+          f"({postwalk / fused:.1f}x faster end to end)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,60 @@
+"""Benchmark of the time to import patternq modules, each in a fresh
+interpreter, and check that the modules that only return plain values don't
+import pandas or numpy (see patternq.lazy):
+
+    python benchmarks/bench_import.py [--repeat 5] [module ...]
+
+Exits non-zero if one of `lean_modules` imports pandas or numpy."""
+import argparse
+import os
+import subprocess
+import sys
+
+# modules whose import must not load pandas or numpy
+lean_modules = ["patternq.query", "patternq.schema", "patternq.dataset",
+                "patternq.reference", "patternq.cache", "patternq.aio",
+                "patternq.backend", "patternq.sql", "patternq.formats",
+                "patternq.refresh"]
+heavy = ["pandas", "numpy"]
+
+probe = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, *[name for name in {heavy!r} if name in sys.modules])
+"""
+
+
+def measure(module: str, repeat: int = 5):
+    """Best of `repeat` import times of `module` in seconds, with the heavy
+    modules it loaded."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(here)] + sys.path[1:]))
+    best, loaded = float("inf"), []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", probe.format(module=module, heavy=heavy)],
+                             capture_output=True, text=True, env=env, check=True).stdout.split()
+        best, loaded = min(best, float(out[0])), out[1:]
+    return {"total": best, "loaded": loaded}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("modules", nargs="*", default=lean_modules + ["patternq.matrix", "pandas"])
+    opts = parser.parse_args()
+    failed = False
+    for module in opts.modules:
+        r = measure(module, opts.repeat)
+        line = f"{module:24s} {r['total'] * 1000:8.1f} ms  {' '.join(r['loaded'])}"
+        if module in lean_modules and r["loaded"]:
+            line += "  REGRESSION"
+            failed = True
+        print(line, flush=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
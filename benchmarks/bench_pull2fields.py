@@ -0,0 +1,75 @@
+"""Benchmark of the compiled pull extractor against the json_normalize path
+(`pull2fields` + `clean_column_names`) on synthetic sample and variant pull
+results, checking that both produce the same frame.
+
+    python benchmarks/bench_pull2fields.py [n_entities]
+"""
+import copy
+import random
+import sys
+import time
+
+import pandas as pd
+
+import patternq.dataset as pqd
+import patternq.helpers as pqh
+import patternq.reference as pqr
+
+
+def sample_entity(rng, i):
+    return {":db/id": 17592186045418 + i,
+            ":sample/id": f"TCGA-{i:06d}-01A",
+            ":sample/type": ":sample.type/tumor",
+            ":sample/specimen": ":specimen/fresh-frozen",
+            ":sample/subject": {":subject/id": f"TCGA-{i // 2:06d}"},
+            ":sample/timepoint": {":timepoint/id": "baseline",
+                                  ":timepoint/treatment-regiment": {
+                                      ":treatment-regiment/name": "none"}},
+            ":sample/gdc-anatomic-site": {":gdc-anatomic-site/name": "Breast"},
+            ":sample/purity": rng.random()}
+
+
+def variant_entity(rng, i):
+    return {":variant/id": f"chr{rng.randint(1, 22)}:{rng.randint(1, 10**8)}:A/T",
+            ":variant/ref-allele": "A",
+            ":variant/alt-allele": "T",
+            ":variant/classification": ":variant.classification/missense",
+            ":variant/type": ":variant.type/snp",
+            ":variant/genomic-coordinates": {":genomic-coordinate/id": f"GRCh38:chr1:+:{i}"},
+            ":variant/so-consequences": [{":so-sequence-feature/name": "missense_variant",
+                                          ":db/id": 17592186045000 + rng.randint(0, 40)}],
+            ":variant/gene": {":gene/hgnc-symbol": f"G{rng.randint(0, 20000)}"}}
+
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def compare(name, qres, extract):
+    def normalize_path():
+        return pqh.clean_column_names(pqh.pull2fields(copy.copy(qres)))
+    baseline, expected = timed(normalize_path)
+    compiled, result = timed(lambda: extract(qres))
+    pd.testing.assert_frame_equal(result, expected)
+    print(f"{name:10s} json_normalize: {baseline:7.3f}s  compiled: {compiled:7.3f}s  "
+          f"({baseline / compiled:.1f}x)")
+
+
+def main(n=200_000):
+    rng = random.Random(0)
+    samples = {"query_result": [[sample_entity(rng, i)] for i in range(n)],
+               pqh.enums_flattened_key: True}
+    variants = {"query_result": [[variant_entity(rng, i)] for i in range(n)],
+                pqh.enums_flattened_key: True}
+    print(f"{n} entities per result")
+    compare("samples", samples, pqd.samples_fields)
+    compare("variants", variants, pqr.variant_fields)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,986 @@
+"""A local stand-in for the query service, serving synthetic tcga-brca sized
+fixtures so patternq can be benchmarked (and developed against) offline.
+
+It implements the protocol patternq speaks:
+
+    POST /query/{db}               -> text/plain presigned URL of a gzip'd JSON (or Arrow) result
+    POST /datoms/{db}              -> JSON list of datoms
+    POST /matrix/{db}/{matrix-key} -> text/plain presigned URL of a gzip'd TSV matrix
+    GET  /results/{token}, /matrices/{matrix-key}   (the "presigned" downloads)
+
+Queries are recognized by their shape (:find, :in and the set of :where
+clauses) against the query dicts shipped in patternq.dataset and
+patternq.reference, and answered from an in-memory entity graph. Run as:
+
+    python benchmarks/mockserver.py [--scale 0.1] [--port 8765] [--latency 0] [--max-rows N]
+
+and point patternq at it with PATTERNQ_ENDPOINT=http://127.0.0.1:8765 and
+any PATTERNQ_API_KEY. At --scale 1 the fixtures have tcga-brca's sizes
+(1098 subjects, 20k genes, 90k variants, 22M gene expression values).
+With --max-rows, queries with larger results fail with a 504 timeout, as
+the service's do when they run too long.
+
+Results of scalar :find queries are served as Arrow IPC streams when the
+request asks for them (see patternq.formats), unless run with --json-only,
+which serves gzip'd JSON only, as the service does."""
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import patternq.backend as pqb
+import patternq.dataset as pqd
+import patternq.formats as pqf
+import patternq.query as pqq
+import patternq.reference as pqr
+import patternq.refresh as pqrefresh
+import patternq.snapshot as pqsnap
+
+dataset_name = "tcga-brca"
+first_eid = 17592186045418
+first_tx = 13194139534312
+so_features = ["missense_variant", "synonymous_variant", "stop_gained", "frameshift_variant",
+               "intron_variant", "splice_region_variant", "3_prime_UTR_variant",
+               "5_prime_UTR_variant", "upstream_gene_variant", "downstream_gene_variant",
+               "inframe_deletion", "inframe_insertion", "start_lost", "stop_lost",
+               "splice_acceptor_variant", "splice_donor_variant", "non_coding_transcript_exon_variant",
+               "NMD_transcript_variant", "intergenic_variant", "regulatory_region_variant"]
+gdc_sites = ["Breast", "Lymph node", "Axilla", "Chest wall", "Lung", "Liver", "Bone",
+             "Brain", "Skin", "Pleura", "Blood", "Not Reported"]
+# enum values of the generated entities, by attribute
+enums = {
+    ":subject/sex": [":subject.sex/female", ":subject.sex/male"],
+    ":subject/race": [":subject.race/white", ":subject.race/black",
+                      ":subject.race/asian", ":subject.race/not-reported"],
+    ":subject/ethnicity": [":subject.ethnicity/not-hispanic-or-latino",
+                           ":subject.ethnicity/hispanic-or-latino"],
+    ":subject/disease-stage": [":subject.disease-stage/stage-i", ":subject.disease-stage/stage-ii",
+                               ":subject.disease-stage/stage-iii", ":subject.disease-stage/stage-iv"],
+    ":variant/classification": [":variant.classification/missense", ":variant.classification/silent",
+                                ":variant.classification/nonsense", ":variant.classification/frame-shift-del",
+                                ":variant.classification/splice-site"],
+    ":variant/type": [":variant.type/snp", ":variant.type/del", ":variant.type/ins"],
+    ":variant/feature": [":variant.feature/transcript", ":variant.feature/regulatory-feature"],
+    ":variant/impact": [":variant.impact/modifier", ":variant.impact/low",
+                        ":variant.impact/moderate", ":variant.impact/high"],
+    ":clinical-observation/imaging": [":clinical-observation.imaging/ct", ":clinical-observation.imaging/mri"],
+    ":clinical-intervention/cancer-medication-category": [
+        ":clinical-intervention.cancer-medication-category/chemotherapy",
+        ":clinical-intervention.cancer-medication-category/hormone-therapy"],
+}
+gx_attrs = [":measurement/tpm", ":measurement/fpkm", ":measurement/rsem-raw-count"]
+
+
+def canonical(q_dict) -> str:
+    """A query's shape, independent of the order of its :where clauses."""
+    return json.dumps({":find": q_dict[":find"],
+                       ":in": q_dict.get(":in", ["$"]),
+                       ":where": sorted(json.dumps(clause) for clause in q_dict[":where"])},
+                      sort_keys=True)
+
+
+def write_result(qres, compression: str or None = None, batch_rows: int = 65536) -> bytes or None:
+    """`qres` as an Arrow IPC stream of record batches of up to `batch_rows`
+    relations, optionally with `compression` ("zstd" or "lz4") of their
+    buffers. None if its relations aren't columns of one type each (e.g.
+    pulls), or there are none to type them by."""
+    pa = pqf.pyarrow()
+    relations = qres["query_result"]
+    if not relations or any(isinstance(v, (dict, list)) for v in relations[0]):
+        return None
+    try:
+        arrays = [pa.array(list(column)) for column in zip(*relations)]
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        return None
+    meta = {k: v for k, v in qres.items() if k != "query_result"}
+    table = pa.Table.from_arrays(arrays, names=[str(i) for i in range(len(arrays))])
+    table = table.replace_schema_metadata({pqf.metadata_key: json.dumps(meta).encode()})
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+        writer.write_table(table, max_chunksize=batch_rows)
+    return sink.getvalue().to_pybytes()
+
+
+class Fixtures:
+    """Synthetic entity graph of one dataset with subjects, samples, clinical
+    events, variant, gene expression, copy number and purity measurements,
+    and the gene, variant and anatomic site reference data. Gene expression
+    measurements are held as arrays and only built as entities on demand."""
+
+    def __init__(self, scale: float = 0.1, seed: int = 0):
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self.entities = {}
+        self.txs = {}
+        self.idents = {}
+        self.unique = defaultdict(dict)
+        self.next_eid = first_eid
+        self.basis_t = 1000
+        self.n_subjects = max(10, round(1098 * scale))
+        self.n_genes = max(50, round(20000 * scale))
+        self.n_variants = max(100, round(90000 * scale))
+        self.build()
+
+    # -- entity graph
+
+    def new(self, attrs, unique=None):
+        eid = self.next_eid
+        self.next_eid += 1
+        self.entities[eid] = attrs
+        self.txs[eid] = first_tx + (eid - first_eid) // 1000
+        if unique:
+            self.unique[unique][attrs[unique]] = eid
+        return eid
+
+    def ident(self, keyword):
+        eid = self.idents.get(keyword)
+        if eid is None:
+            eid = self.idents[keyword] = self.new({":db/ident": keyword})
+        return eid
+
+    def pick(self, attr):
+        return self.ident(self.rng.choice(enums[attr]))
+
+    def build(self):
+        rng = self.rng
+        for attr_values in enums.values():
+            for keyword in attr_values:
+                self.ident(keyword)
+        self.sites = [self.new({":gdc-anatomic-site/name": site}) for site in gdc_sites]
+        self.so = [self.new({":so-sequence-feature/name": name}) for name in so_features]
+        self.genes, self.gene_products = [], []
+        for i in range(self.n_genes):
+            contig = f"chr{i % 22 + 1}"
+            start = rng.randint(1, 2 * 10**8)
+            gc = self.new({":genomic-coordinate/id": f"GRCh38:{contig}:+:{start}-{start + 20000}",
+                           ":genomic-coordinate/contig": contig,
+                           ":genomic-coordinate/strand": rng.choice("+-"),
+                           ":genomic-coordinate/start": start,
+                           ":genomic-coordinate/end": start + 20000,
+                           ":genomic-coordinate/assembly": self.ident(":assembly/GRCh38")})
+            gene = self.new({":gene/hgnc-symbol": f"GENE{i}", ":gene/id": f"ENSG{i:011d}",
+                             ":gene/name": f"synthetic gene {i}",
+                             ":gene/genomic-coordinates": [gc]}, unique=":gene/hgnc-symbol")
+            self.genes.append(gene)
+            self.gene_products.append(self.new({":gene-product/id": f"ENST{i:011d}",
+                                                ":gene-product/gene": gene}))
+        self.variants = []
+        for i in range(self.n_variants):
+            contig = f"chr{i % 22 + 1}"
+            pos = rng.randint(1, 2 * 10**8)
+            ref, alt = rng.sample("ACGT", 2)
+            gc = self.new({":genomic-coordinate/id": f"GRCh38:{contig}:+:{pos}-{pos}",
+                           ":genomic-coordinate/contig": contig,
+                           ":genomic-coordinate/start": pos,
+                           ":genomic-coordinate/end": pos})
+            attrs = {":variant/id": f"{contig}:g.{pos}{ref}>{alt}",
+                     ":variant/ref-allele": ref, ":variant/alt-allele": alt,
+                     ":variant/classification": self.pick(":variant/classification"),
+                     ":variant/type": self.pick(":variant/type"),
+                     ":variant/feature": self.pick(":variant/feature"),
+                     ":variant/impact": self.pick(":variant/impact"),
+                     ":variant/genomic-coordinates": [gc],
+                     ":variant/so-consequences": rng.sample(self.so, rng.randint(1, 3)),
+                     ":variant/gene": rng.choice(self.genes)}
+            if rng.random() < 0.3:
+                attrs[":variant/ref-amino-acid"] = rng.choice("ARNDCQEGHILKMFPSTWYV")
+                attrs[":variant/alt-amino-acid"] = rng.choice("ARNDCQEGHILKMFPSTWYV")
+            self.variants.append(self.new(attrs, unique=":variant/id"))
+        regimens = [self.new({":treatment-regimen/name": name})
+                    for name in ["AC-T", "TC", "tamoxifen", "letrozole"]]
+        timepoints = [self.new({":timepoint/id": f"{dataset_name}/{name}", ":timepoint/name": name,
+                                ":timepoint/relative-order": order,
+                                ":timepoint/treatment-regiment": rng.choice(regimens)})
+                      for order, name in enumerate(["baseline", "on-treatment", "progression"])]
+        disease = self.new({":meddra-disease/preferred-name": "Breast cancer"})
+        self.subjects, self.tumor_samples, samples, events = [], [], [], []
+        for i in range(self.n_subjects):
+            therapies = [self.new({":therapy/order": order,
+                                   ":therapy/treatment-regimen": rng.choice(regimens)})
+                         for order in range(rng.randint(0, 2))]
+            subject_id = f"TCGA-{'A1B2C3D4E5'[i % 5 * 2:i % 5 * 2 + 2]}-{i:04d}"
+            attrs = {":subject/id": subject_id,
+                     ":subject/sex": self.pick(":subject/sex"),
+                     ":subject/race": [self.pick(":subject/race")],
+                     ":subject/ethnicity": self.pick(":subject/ethnicity"),
+                     ":subject/meddra-disease": disease,
+                     ":subject/disease-stage": self.pick(":subject/disease-stage"),
+                     ":subject/age-at-diagnosis": rng.randint(30, 90),
+                     ":subject/dead": rng.random() < 0.15}
+            if therapies:
+                attrs[":subject/therapies"] = therapies
+            subject = self.new(attrs, unique=":subject/id")
+            self.subjects.append(subject)
+            for kind, code in [("tumor", "01A"), ("normal", "10A")]:
+                sample = self.new({":sample/id": f"{subject_id}-{code}",
+                                   ":sample/type": self.ident(f":sample.type/{kind}"),
+                                   ":sample/specimen": self.ident(":sample.specimen/fresh-frozen"),
+                                   ":sample/subject": subject,
+                                   ":sample/timepoint": timepoints[0],
+                                   ":sample/gdc-anatomic-site": rng.choice(self.sites)},
+                                  unique=":sample/id")
+                samples.append(sample)
+                if kind == "tumor":
+                    self.tumor_samples.append(sample)
+            for _ in range(2):
+                events.append(self.new({
+                    ":clinical-observation/subject": subject,
+                    ":clinical-observation/timepoint": rng.choice(timepoints),
+                    ":clinical-observation/imaging": self.pick(":clinical-observation/imaging"),
+                    ":clinical-observation/tumor-size": round(rng.uniform(0.5, 8.0), 1)}))
+            drugs = [self.new({":drug-regimen/drug": name, ":drug-regimen/cycles": rng.randint(1, 8)})
+                     for name in rng.sample(["doxorubicin", "paclitaxel", "tamoxifen"], 2)]
+            regimen = self.new({":treatment-regimen/name": "adjuvant",
+                                ":clinical-intervention/drug-regimens": drugs})
+            events.append(self.new({
+                ":clinical-intervention/subject": subject,
+                ":clinical-intervention/timepoint": rng.choice(timepoints),
+                ":clinical-intervention/cancer-medication-category":
+                    self.pick(":clinical-intervention/cancer-medication-category"),
+                ":clinical-intervention/treatment-regimen": regimen}))
+        self.samples = samples
+        # variant measurements, each variant seen in one or two tumor samples
+        mutations = []
+        for variant in self.variants:
+            for sample in rng.sample(self.tumor_samples, rng.choice([1, 1, 1, 2])):
+                mutations.append(self.new({":measurement/sample": sample,
+                                           ":measurement/variant": variant,
+                                           ":measurement/vaf": round(rng.random(), 3)}))
+        # gene expression, tumor samples x genes, as virtual entities
+        gx_rng = np.random.default_rng(rng.randrange(2**32))
+        self.tpm = np.round(gx_rng.lognormal(1.0, 2.0, (len(self.tumor_samples), self.n_genes)), 4)
+        self.gx_base = self.next_eid
+        self.next_eid += self.tpm.size
+        self.gx_index = {sample: i for i, sample in enumerate(self.tumor_samples)}
+        # copy number segments over runs of genes, per tumor sample
+        segment = max(1, self.n_genes // 20)
+        cnvs = [self.new({":cnv/id": f"cnv-{i}", ":cnv/genes": self.genes[start:start + segment]})
+                for i, start in enumerate(range(0, self.n_genes, segment))]
+        copy_numbers, purities = [], []
+        for sample in self.tumor_samples:
+            for cnv in cnvs:
+                copy_numbers.append(self.new({":measurement/sample": sample, ":measurement/cnv": cnv,
+                                              ":measurement/a-allele-cn": rng.randint(0, 4),
+                                              ":measurement/segment-mean-lrr": round(rng.gauss(0, 0.5), 4)}))
+            purities.append(self.new({":measurement/sample": sample,
+                                      ":measurement/tumor-purity": round(rng.uniform(0.2, 1.0), 3)}))
+        matrix = self.new({":measurement-matrix/name": "rna-seq tpm",
+                           ":measurement-matrix/measurement-type": self.ident(":measurement-type/tpm"),
+                           ":measurement-matrix/backing-file": f"{dataset_name}-rna-seq-tpm"})
+        self.matrix_keys = {f"{dataset_name}-rna-seq-tpm": self.tpm}
+        gx_set = {":measurement-set/name": "rna-seq",
+                  ":measurement-set/description": "RNA-seq gene expression",
+                  ":measurement-set/measurements": range(self.gx_base, self.gx_base + self.tpm.size),
+                  ":measurement-set/measurement-matrices": [matrix]}
+        sets = {"WES": [{":measurement-set/name": "baseline mutations",
+                         ":measurement-set/measurements": mutations}],
+                "RNA-seq": [gx_set],
+                "SNP array": [{":measurement-set/name": "copy number",
+                               ":measurement-set/measurements": copy_numbers},
+                              {":measurement-set/name": "tumor purity",
+                               ":measurement-set/measurements": purities}]}
+        techs = {"WES": ":assay.technology/WES", "RNA-seq": ":assay.technology/RNA-seq",
+                 "SNP array": ":assay.technology/SNP-array"}
+        assays = []
+        self.sample_sets = defaultdict(set)
+        for name, ms_list in sets.items():
+            ms_eids = []
+            for ms in ms_list:
+                ms_eid = self.new(ms, unique=":measurement-set/name")
+                ms_eids.append(ms_eid)
+            assays.append(self.new({":assay/name": name, ":assay/technology": self.ident(techs[name]),
+                                    ":assay/measurement-sets": ms_eids}))
+        clinical_set = self.new({":clinical-observation-set/name": "clinical",
+                                 ":clinical-observation-set/description": "synthetic clinical data"})
+        self.dataset = self.new({":dataset/name": dataset_name,
+                                 ":dataset/description": "synthetic stand-in for TCGA BRCA",
+                                 ":dataset/url": "https://example.org/tcga-brca",
+                                 ":dataset/subjects": self.subjects,
+                                 ":dataset/samples": samples,
+                                 ":dataset/assays": assays,
+                                 ":dataset/clinical-observation-sets": [clinical_set]},
+                                unique=":dataset/name")
+        populations = [self.new({":cell-population/name": f"population-{i}"}) for i in range(5)]
+        for i in range(max(20, round(2000 * self.scale))):
+            self.new({":single-cell/id": f"cell-{i}",
+                      ":single-cell/cell-populations": rng.sample(populations, rng.randint(1, 2))})
+        self.refs = self.index_refs()
+        for ms_eid in self.unique[":measurement-set/name"].values():
+            measurements = self.entities[ms_eid][":measurement-set/measurements"]
+            if isinstance(measurements, range):
+                for sample in self.gx_index:
+                    self.sample_sets[sample].add(ms_eid)
+                continue
+            for m in measurements:
+                self.sample_sets[self.entities[m][":measurement/sample"]].add(ms_eid)
+
+    def index_refs(self):
+        """attribute -> referenced entity -> referring entities, for refs
+        between materialized entities."""
+        refs = defaultdict(lambda: defaultdict(list))
+        for eid, attrs in self.entities.items():
+            for attr, value in attrs.items():
+                if isinstance(value, range):
+                    continue
+                for v in (value if isinstance(value, list) else [value]):
+                    if self.is_ref(attr, v):
+                        refs[attr][v].append(eid)
+        return refs
+
+    def entity(self, eid):
+        attrs = self.entities.get(eid)
+        if attrs is not None:
+            return attrs
+        i = eid - self.gx_base
+        if 0 <= i < self.tpm.size:
+            s, g = divmod(i, self.n_genes)
+            tpm = float(self.tpm[s, g])
+            return {":measurement/sample": self.tumor_samples[s],
+                    ":measurement/gene-product": self.gene_products[g],
+                    ":measurement/tpm": tpm,
+                    ":measurement/fpkm": round(tpm * 0.8, 4),
+                    ":measurement/rsem-raw-count": round(tpm * 30.0)}
+        return {}
+
+    def is_ref(self, attr, value):
+        return isinstance(value, int) and not isinstance(value, bool) and value >= first_eid
+
+    def pull(self, eid, pattern):
+        attrs = self.entity(eid)
+        result = {}
+        for elem in pattern:
+            if elem == "*":
+                result[":db/id"] = eid
+                for attr, value in attrs.items():
+                    if attr not in result:
+                        result[attr] = self.pull_value(attr, value, [":db/id"])
+            elif isinstance(elem, str):
+                if elem == ":db/id":
+                    result[":db/id"] = eid
+                elif elem in attrs:
+                    result[elem] = self.pull_value(elem, attrs[elem], [":db/id"])
+            elif isinstance(elem, dict):
+                for attr, sub_pattern in elem.items():
+                    ns, _, name = attr.partition("/")
+                    if name.startswith("_"):
+                        forward = f"{ns}/{name[1:]}"
+                        referrers = self.refs[forward].get(eid, [])
+                        if referrers:
+                            result[attr] = [self.pull(r, sub_pattern) for r in referrers]
+                    elif attr in attrs:
+                        result[attr] = self.pull_value(attr, attrs[attr], sub_pattern)
+        return result
+
+    def pull_value(self, attr, value, pattern):
+        if isinstance(value, (list, range)):
+            return [self.pull_value(attr, v, pattern) for v in value]
+        if self.is_ref(attr, value):
+            return self.pull(value, pattern)
+        return value
+
+    def attr_value(self, eid, attr):
+        value = self.entity(eid).get(attr)
+        if self.is_ref(attr, value) and ":db/ident" in self.entity(value):
+            return self.entity(value)[":db/ident"]
+        return value
+
+    def lookup(self, attr, value):
+        return self.unique[attr].get(value)
+
+    def dataset_of(self, name):
+        eid = self.lookup(":dataset/name", name)
+        return self.entity(eid) if eid else {}
+
+    def measurement_set(self, name, dataset=None):
+        eid = self.lookup(":measurement-set/name", name)
+        if eid is None:
+            return []
+        if dataset is not None:
+            assays = self.dataset_of(dataset).get(":dataset/assays", [])
+            if not any(eid in self.entity(a)[":assay/measurement-sets"] for a in assays):
+                return []
+        return self.entity(eid)[":measurement-set/measurements"]
+
+    def sample_measurements(self, ms_name, sample_eids, dataset=None):
+        measurements = self.measurement_set(ms_name, dataset)
+        if isinstance(measurements, range):
+            eids = []
+            for sample in sample_eids:
+                if sample in self.gx_index:
+                    start = self.gx_base + self.gx_index[sample] * self.n_genes
+                    eids.extend(range(start, start + self.n_genes))
+            return eids
+        wanted = set(sample_eids)
+        return [m for m in measurements if self.entity(m).get(":measurement/sample") in wanted]
+
+    # -- datoms
+
+    def datoms(self, index, components, offset=0, limit=1000):
+        """Datoms of the materialized then the virtual gene expression
+        entities, filtered by the leading components of the eavt, aevt or
+        avet index."""
+        wanted = dict(zip(index, components))
+        eids = [wanted["e"]] if "e" in wanted else self.entities
+        if "e" not in wanted and wanted.get("a", gx_attrs[0]) in gx_attrs + [
+                ":measurement/sample", ":measurement/gene-product"]:
+            eids = itertools.chain(eids, range(self.gx_base, self.gx_base + self.tpm.size))
+        out = []
+        for eid in eids:
+            for attr, value in self.entity(eid).items():
+                if "a" in wanted and wanted["a"] != attr:
+                    continue
+                for v in (value if isinstance(value, (list, range)) else [value]):
+                    if "v" in wanted and wanted["v"] != v:
+                        continue
+                    out.append({"e": eid, "a": attr, "v": v, "tx": self.txs.get(eid, first_tx),
+                                "added": True})
+                    if len(out) >= offset + limit:
+                        return out[offset:]
+        return out[offset:]
+
+    # -- transactions
+
+    def transact(self, tx_data):
+        """Apply one transaction of [":db/add", e, a, v], [":db/retract", e,
+        a, v] and [":db/retractEntity", e] operations, where e (or a ref v)
+        may be a string tempid naming a new entity (one that is also an e).
+        Advances basis_t, and the latest transaction asserting datoms of each
+        entity (see `txs`), and returns its t and the tempids' eids."""
+        if not hasattr(self, "many"):
+            self.many = {attr for attrs in self.entities.values()
+                         for attr, value in attrs.items() if isinstance(value, (list, range))}
+        t = max(self.basis_t, max(self.txs.values()) - first_tx + 1000) + 1
+        tx = first_tx - 1000 + t
+        tempids = {}
+        names = {op[1] for op in tx_data if isinstance(op[1], str)}
+
+        def resolve(x):
+            if isinstance(x, str) and x in names:
+                if x not in tempids:
+                    tempids[x] = self.new({})
+                return tempids[x]
+            return x
+
+        def retract(e, a, v):
+            attrs = self.entities[e]
+            if isinstance(attrs.get(a), list) and v in attrs[a]:
+                attrs[a].remove(v)
+                if not attrs[a]:
+                    del attrs[a]
+            elif attrs.get(a) == v:
+                del attrs[a]
+
+        for op, e, *av in tx_data:
+            e = resolve(e)
+            if op == ":db/retractEntity":
+                for a, value in list(self.entities[e].items()):
+                    for v in list(value) if isinstance(value, list) else [value]:
+                        retract(e, a, v)
+                for other, attrs in list(self.entities.items()):
+                    for a, value in list(attrs.items()):
+                        if isinstance(value, range):
+                            continue
+                        if e in (value if isinstance(value, list) else [value]) and self.is_ref(a, e):
+                            retract(other, a, e)
+                del self.entities[e]
+                continue
+            a, v = av[0], resolve(av[1])
+            if op == ":db/retract":
+                retract(e, a, v)
+                continue
+            attrs = self.entities[e]
+            if a in self.many:
+                attrs.setdefault(a, []).append(v)
+            else:
+                if a in attrs:
+                    retract(e, a, attrs[a])
+                attrs[a] = v
+            if a in self.unique:
+                self.unique[a][v] = e
+            # retracted datoms leave the current database, and with them
+            # their transactions
+            self.txs[e] = tx
+        self.refs = self.index_refs()
+        self.basis_t = t
+        return t, tempids
+
+    def matrix_tsv(self, key):
+        """Genes x tumor samples TSV of the matrix's values."""
+        values = self.matrix_keys[key]
+        sample_ids = [self.entity(s)[":sample/id"] for s in self.tumor_samples]
+        lines = ["\t".join(["hgnc"] + sample_ids)]
+        for g, gene in enumerate(self.genes):
+            lines.append("\t".join([self.entity(gene)[":gene/hgnc-symbol"]]
+                                   + [repr(float(v)) for v in values[:, g]]))
+        return ("\n".join(lines) + "\n").encode()
+
+    # -- query handlers, by the shipped query they answer
+
+    def handlers(self):
+        handlers = {
+            canonical(pqq.basis_t_q): lambda: [[self.ident(":db/ident")]],
+            canonical(pqb.schema_q): self.q_schema,
+            canonical(pqd.samplesq): self.q_samples,
+            canonical(pqd.datasetsq): self.q_datasets,
+            canonical(pqd.assay_summary_q): self.q_assay_summary,
+            canonical(pqd.clinical_summary_q): self.q_clinical_summary,
+            canonical(pqd.clinical_query): self.q_clinical,
+            canonical(pqd.patient_assays_q): self.q_patient_assays,
+            canonical(pqd.subjects_q): self.q_subjects,
+            canonical(pqd.measurements_q): self.q_measurements,
+            canonical(pqd.sample_measurements_q): self.q_sample_measurements,
+            canonical(pqd.gx_by_attr_q): self.q_gx_by_attr,
+            canonical(pqd.measurement_matrices_q): self.q_measurement_matrices,
+            canonical(pqd.variant_measurements_q): self.q_variant_measurements,
+            canonical(pqd.var2measq): self.q_measurements_of_variants,
+            canonical(pqd.variants_by_impact_query): self.q_variants_by_impact,
+            canonical(pqd.simple_gx_query): self.q_gx_for_genes,
+            canonical(pqd.cnv_query): self.q_cnv,
+            canonical(pqd.cohort_expression_for_genes_q): self.q_cohort_expression,
+            canonical(pqd.single_cell_popq): self.q_single_cell_populations,
+            canonical(pqr.gene_symbols_query): self.q_gene_symbols,
+            canonical(pqr.genes_query): self.q_genes,
+            canonical(pqr.gene_coords_query): self.q_gene_coordinates,
+            canonical(pqr.gdc_anatomic_sites_query): self.q_gdc_sites,
+            canonical(pqr.all_variants_q): self.q_all_variants,
+            canonical(pqr.variant_q): self.q_variants,
+            canonical(pqr.genes2variantsq): self.q_variants_for_genes,
+        }
+        for q_dict in [pqd.subjects_q, pqd.samplesq, pqd.assay_summary_q, pqd.clinical_query,
+                       pqd.measurements_q, pqr.variant_q]:
+            handlers[canonical(pqsnap.fingerprint_query(q_dict))] = \
+                self.fingerprint(handlers[canonical(q_dict)])
+        for q_dict in [pqd.subjects_q, pqd.samplesq]:
+            handlers[canonical(pqrefresh.restricted_query(q_dict))] = \
+                self.restricted(handlers[canonical(q_dict)])
+            handlers[canonical(pqrefresh.ids_query(q_dict))] = \
+                self.ids(handlers[canonical(q_dict)])
+            for via_ref in (False, True):
+                handlers[canonical(pqrefresh.changed_query(q_dict, via_ref))] = \
+                    self.changed(handlers[canonical(q_dict)], via_ref)
+        return handlers
+
+    def root_eid(self, pulled):
+        """Entity id of a pull result, from its :db/id or a unique attribute."""
+        if ":db/id" in pulled:
+            return pulled[":db/id"]
+        for attr, value in pulled.items():
+            if attr in self.unique and value in self.unique[attr]:
+                return self.unique[attr][value]
+
+    def fingerprint(self, handler):
+        """Answers the fingerprint query (see patternq.snapshot) of the pull
+        query answered by `handler`."""
+        def answer(*args):
+            eids = [self.root_eid(relation[0]) for relation in handler(*args)]
+            if not eids:
+                return []
+            count = sum(len(v) if isinstance(v, (list, range)) else 1
+                        for eid in eids for v in self.entity(eid).values())
+            return [[count, max(self.txs.get(eid, first_tx) for eid in eids)]]
+        return answer
+
+    def restricted(self, handler):
+        """Answers a pull query answered by `handler` restricted to the root
+        entities of an extra collection input (see patternq.refresh)."""
+        def answer(*args):
+            eids = set(args[-1])
+            return [r for r in handler(*args[:-1]) if self.root_eid(r[0]) in eids]
+        return answer
+
+    def ids(self, handler):
+        """Answers the query of the root entity ids of the pull query
+        answered by `handler` (see patternq.refresh)."""
+        def answer(*args):
+            return [[self.root_eid(r[0])] for r in handler(*args)]
+        return answer
+
+    def changed(self, handler, via_ref):
+        """Answers the query of the root entities of the pull query answered
+        by `handler` with datoms asserted after the transaction of an extra
+        input, or referring to entities with such datoms (see
+        patternq.refresh)."""
+        def answer(*args):
+            since_tx = args[-1]
+            roots = [self.root_eid(r[0]) for r in handler(*args[:-1])]
+            if not via_ref:
+                return [[root] for root in roots if self.txs.get(root, first_tx) > since_tx]
+            return [[root] for root in roots
+                    if any(self.is_ref(a, v) and self.txs.get(v, first_tx) > since_tx
+                           for a, value in self.entity(root).items() if not isinstance(value, range)
+                           for v in (value if isinstance(value, list) else [value]))]
+        return answer
+
+    def q_schema(self):
+        """Attribute entities, with value types and cardinality inferred from
+        the first value of each attribute."""
+        attributes = {}
+        for attrs in itertools.chain(self.entities.values(), [self.entity(self.gx_base)]):
+            for attr, value in attrs.items():
+                if attr in attributes:
+                    continue
+                many = isinstance(value, (list, range))
+                v = (value[0] if len(value) else None) if many else value
+                if self.is_ref(attr, v):
+                    value_type = ":db.type/ref"
+                elif isinstance(v, bool):
+                    value_type = ":db.type/boolean"
+                elif isinstance(v, int):
+                    value_type = ":db.type/long"
+                elif isinstance(v, float):
+                    value_type = ":db.type/double"
+                else:
+                    value_type = ":db.type/keyword" if attr == ":db/ident" else ":db.type/string"
+                attribute = {":db/id": 100 + len(attributes), ":db/ident": attr,
+                             ":db/valueType": {":db/ident": value_type},
+                             ":db/cardinality": {":db/ident": ":db.cardinality/many" if many
+                                                 else ":db.cardinality/one"}}
+                if attr in self.unique or attr == ":db/ident":
+                    attribute[":db/unique"] = {":db/ident": ":db.unique/identity"}
+                attributes[attr] = [attribute]
+        return list(attributes.values())
+
+    def pulls(self, eids, q_dict):
+        pattern = q_dict[":find"][0][2]
+        return [[self.pull(eid, pattern)] for eid in eids]
+
+    def q_samples(self, dataset):
+        return self.pulls(self.dataset_of(dataset).get(":dataset/samples", []), pqd.samplesq)
+
+    def q_datasets(self):
+        return self.pulls(self.unique[":dataset/name"].values(), pqd.datasetsq)
+
+    def q_assay_summary(self, dataset):
+        return self.pulls(self.dataset_of(dataset).get(":dataset/assays", []), pqd.assay_summary_q)
+
+    def q_clinical_summary(self, dataset):
+        return self.pulls(self.dataset_of(dataset).get(":dataset/clinical-observation-sets", []),
+                          pqd.clinical_summary_q)
+
+    def q_clinical(self, dataset, subject_ids):
+        members = set(self.dataset_of(dataset).get(":dataset/subjects", []))
+        events = []
+        for subject_id in subject_ids:
+            subject = self.lookup(":subject/id", subject_id)
+            if subject in members:
+                events.extend(self.refs[":clinical-intervention/subject"].get(subject, []))
+                events.extend(self.refs[":clinical-observation/subject"].get(subject, []))
+        return self.pulls(events, pqd.clinical_query)
+
+    def q_patient_assays(self, dataset, subject_ids):
+        assays = self.dataset_of(dataset).get(":dataset/assays", [])
+        assay_of = {ms: a for a in assays for ms in self.entity(a)[":assay/measurement-sets"]}
+        relations = []
+        for subject_id in subject_ids:
+            subject = self.lookup(":subject/id", subject_id)
+            for sample in self.refs[":sample/subject"].get(subject, []):
+                for ms in self.sample_sets.get(sample, ()):
+                    if ms in assay_of:
+                        a = assay_of[ms]
+                        relations.append([subject_id, self.entity(sample)[":sample/id"],
+                                          self.attr_value(a, ":assay/technology"),
+                                          self.entity(a)[":assay/name"],
+                                          self.entity(ms)[":measurement-set/name"]])
+        return relations
+
+    def q_subjects(self, dataset):
+        return self.pulls(self.dataset_of(dataset).get(":dataset/subjects", []), pqd.subjects_q)
+
+    def q_measurements(self, dataset, ms_name):
+        return self.pulls(self.measurement_set(ms_name, dataset), pqd.measurements_q)
+
+    def q_sample_measurements(self, dataset, ms_name, sample_ids):
+        samples = [self.lookup(":sample/id", sample_id) for sample_id in sample_ids]
+        return self.pulls(self.sample_measurements(ms_name, samples, dataset),
+                          pqd.sample_measurements_q)
+
+    def gx_relations(self, measurements, attr, fields):
+        relations = []
+        for m in measurements:
+            attrs = self.entity(m)
+            if attr not in attrs:
+                continue
+            row = {"sample-id": self.entity(attrs[":measurement/sample"])[":sample/id"],
+                   "hgnc": self.entity(self.entity(attrs[":measurement/gene-product"])
+                                       [":gene-product/gene"])[":gene/hgnc-symbol"],
+                   "value": attrs[attr]}
+            relations.append([row[field] for field in fields])
+        return relations
+
+    def q_gx_by_attr(self, ms_name, attr):
+        return self.gx_relations(self.measurement_set(ms_name), attr, ["sample-id", "hgnc", "value"])
+
+    def q_gx_for_genes(self, sample_id, ms_name, attr, genes):
+        sample = self.lookup(":sample/id", sample_id)
+        if sample not in self.gx_index or not isinstance(self.measurement_set(ms_name), range):
+            return []
+        start = self.gx_base + self.gx_index[sample] * self.n_genes
+        gene_idx = {self.entity(gene)[":gene/hgnc-symbol"]: i for i, gene in enumerate(self.genes)}
+        measurements = [start + gene_idx[g] for g in genes if g in gene_idx]
+        return self.gx_relations(measurements, attr, ["hgnc", "value"])
+
+    def q_cohort_expression(self, attr, genes):
+        if attr not in gx_attrs:
+            return []
+        gene_idx = {self.entity(gene)[":gene/hgnc-symbol"]: i for i, gene in enumerate(self.genes)}
+        return [[hgnc, self.entity(self.gx_base + s * self.n_genes + gene_idx[hgnc])[attr]]
+                for hgnc in dict.fromkeys(genes) if hgnc in gene_idx
+                for s in range(len(self.tumor_samples))]
+
+    def q_measurement_matrices(self, dataset):
+        relations = []
+        for a in self.dataset_of(dataset).get(":dataset/assays", []):
+            for ms in self.entity(a)[":assay/measurement-sets"]:
+                for mm in self.entity(ms).get(":measurement-set/measurement-matrices", []):
+                    relations.append([self.entity(a)[":assay/name"],
+                                      self.entity(ms)[":measurement-set/name"],
+                                      self.entity(mm)[":measurement-matrix/name"],
+                                      self.attr_value(mm, ":measurement-matrix/measurement-type"),
+                                      self.entity(mm)[":measurement-matrix/backing-file"]])
+        return relations
+
+    def q_variant_measurements(self, ms_name):
+        measurements = [m for m in self.measurement_set(ms_name)
+                        if ":measurement/variant" in self.entity(m)]
+        return self.pulls(measurements, pqd.variant_measurements_q)
+
+    def q_measurements_of_variants(self, variant_ids):
+        measurements = []
+        for variant_id in variant_ids:
+            variant = self.lookup(":variant/id", variant_id)
+            measurements.extend(self.refs[":measurement/variant"].get(variant, []))
+        return self.pulls(measurements, pqd.var2measq)
+
+    def q_variants_by_impact(self, sample_id, ms_name, impact):
+        sample = self.lookup(":sample/id", sample_id)
+        relations = []
+        for m in self.sample_measurements(ms_name, [sample]):
+            variant = self.entity(m).get(":measurement/variant")
+            if variant is None or self.attr_value(variant, ":variant/impact") != impact:
+                continue
+            attrs = self.entity(variant)
+            hgnc = self.entity(attrs[":variant/gene"])[":gene/hgnc-symbol"]
+            for so in attrs[":variant/so-consequences"]:
+                relations.append([sample_id, ms_name, attrs[":variant/id"], hgnc,
+                                  self.entity(so)[":so-sequence-feature/name"], impact,
+                                  self.entity(m)[":measurement/vaf"]])
+        return relations
+
+    def q_cnv(self, sample_id, ms_name):
+        sample = self.lookup(":sample/id", sample_id)
+        relations = []
+        for m in self.sample_measurements(ms_name, [sample]):
+            attrs = self.entity(m)
+            if ":measurement/cnv" not in attrs:
+                continue
+            for gene in self.entity(attrs[":measurement/cnv"])[":cnv/genes"]:
+                relations.append([self.entity(gene)[":gene/hgnc-symbol"],
+                                  attrs[":measurement/segment-mean-lrr"],
+                                  attrs[":measurement/a-allele-cn"]])
+        return relations
+
+    def q_single_cell_populations(self):
+        return [[attrs[":single-cell/id"], self.entity(cp)[":cell-population/name"]]
+                for attrs in self.entities.values() if ":single-cell/id" in attrs
+                for cp in attrs[":single-cell/cell-populations"]]
+
+    def q_gene_symbols(self):
+        return [[self.entity(gene)[":gene/hgnc-symbol"]] for gene in self.genes]
+
+    def q_genes(self):
+        return self.pulls(self.genes, pqr.genes_query)
+
+    def q_gene_coordinates(self):
+        relations = []
+        for gene in self.genes:
+            for gc in self.entity(gene)[":gene/genomic-coordinates"]:
+                attrs = self.entity(gc)
+                relations.append([self.entity(gene)[":gene/hgnc-symbol"],
+                                  attrs[":genomic-coordinate/contig"], attrs[":genomic-coordinate/strand"],
+                                  attrs[":genomic-coordinate/start"], attrs[":genomic-coordinate/end"]])
+        return relations
+
+    def q_gdc_sites(self):
+        return [[self.entity(site)[":gdc-anatomic-site/name"]] for site in self.sites]
+
+    def q_all_variants(self):
+        return self.pulls(self.variants, pqr.all_variants_q)
+
+    def q_variants(self, variant_ids):
+        eids = [self.lookup(":variant/id", variant_id) for variant_id in variant_ids]
+        return self.pulls([eid for eid in eids if eid is not None], pqr.variant_q)
+
+    def q_variants_for_genes(self, genes):
+        variants = []
+        for hgnc in genes:
+            gene = self.lookup(":gene/hgnc-symbol", hgnc)
+            variants.extend(self.refs[":variant/gene"].get(gene, []))
+        return self.pulls(variants, pqr.genes2variantsq)
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # results kept for download, most recent last
+    max_results = 64
+
+    def __init__(self, address, fixtures: Fixtures, latency: float = 0.0,
+                 max_rows: int or None = None, formats=None):
+        super().__init__(address, Handler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.max_rows = max_rows
+        self.formats = formats or ("arrow-zstd", "arrow", "json-gzip")
+        self.handlers = fixtures.handlers()
+        self.results = OrderedDict()
+        self.matrices = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def run_query(self, body, accepted=()):
+        """Result of a query request body, in the first of the `accepted`
+        formats this server offers that suits it, and its token."""
+        q_dict, args = body["query"], body.get("args", [])
+        formats = [f for f in accepted if f in self.formats and f in pqf.arrow_formats]
+        key = json.dumps([canonical(q_dict), args, self.fixtures.basis_t, formats], sort_keys=True)
+        token = hashlib.sha1(key.encode()).hexdigest()
+        with self.lock:
+            if token in self.results:
+                self.results.move_to_end(token)
+                return token
+        handler = self.handlers.get(canonical(q_dict))
+        if handler is None:
+            raise KeyError("No fixture answers this query.")
+        relations = handler(*args)
+        if self.max_rows is not None and len(relations) > self.max_rows:
+            raise QueryTimeout("Query canceled: timeout elapsed")
+        if not (isinstance(q_dict[":find"][0], list) and q_dict[":find"][0][0] == "pull"
+                or ":with" in q_dict):
+            # tuple finds return sets (handlers of :with queries already
+            # return one relation per :with binding)
+            relations = [list(r) for r in dict.fromkeys(tuple(r) for r in relations)]
+        result = {"query_result": relations, "basis_t": self.fixtures.basis_t}
+        data = None
+        if formats:
+            data = write_result(result, compression="zstd" if formats[0] == "arrow-zstd" else None)
+        if data is None:
+            data = gzip.compress(json.dumps(result).encode(), compresslevel=1)
+        with self.lock:
+            self.results[token] = data
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+        return token
+
+    def matrix(self, key):
+        with self.lock:
+            if key not in self.matrices:
+                self.matrices[key] = gzip.compress(self.fixtures.matrix_tsv(key), compresslevel=1)
+            return self.matrices[key]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, which with Nagle's
+    # algorithm and delayed ACKs stalls each keep-alive response ~40ms.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body: bytes, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, message):
+        self.send(status, json.dumps({"error": message}).encode(), "application/json")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self.error(401, "Missing bearer token.")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        route, _, rest = self.path.strip("/").partition("/")
+        db_name, _, matrix_key = rest.partition("/")
+        try:
+            if route == "query":
+                accepted = self.headers.get(pqf.format_header, "")
+                token = self.server.run_query(body, [f.strip() for f in accepted.split(",")])
+                return self.send(200, f"{self.server.url}/results/{token}".encode())
+            if route == "datoms":
+                datoms = self.server.fixtures.datoms(body["index"], body.get("components", []),
+                                                     body.get("offset", 0), body.get("limit", 1000))
+                return self.send(200, json.dumps(datoms).encode(), "application/json")
+            if route == "matrix" and matrix_key in self.server.fixtures.matrix_keys:
+                return self.send(200, f"{self.server.url}/matrices/{matrix_key}".encode())
+        except QueryTimeout as e:
+            return self.error(504, str(e))
+        except (KeyError, TypeError, ValueError) as e:
+            return self.error(400, f"{type(e).__name__}: {e}")
+        self.error(404, f"Unknown route {self.path}")
+
+    def do_GET(self):
+        route, _, name = self.path.strip("/").partition("/")
+        if route == "results":
+            with self.server.lock:
+                data = self.server.results.get(name)
+            if data is not None:
+                return self.send(200, data, "application/octet-stream")
+        elif route == "matrices" and name in self.server.fixtures.matrix_keys:
+            return self.send(200, self.server.matrix(name), "application/octet-stream")
+        self.error(404, f"Unknown download {self.path}")
+
+
+def start(scale: float = 0.1, seed: int = 0, port: int = 0, latency: float = 0.0,
+          max_rows: int or None = None, json_only: bool = False) -> MockServer:
+    """Build fixtures and serve them from a background thread, returning the
+    server (see its `url`)."""
+    server = MockServer(("127.0.0.1", port), Fixtures(scale, seed), latency=latency,
+                        max_rows=max_rows, formats=("json-gzip",) if json_only else None)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to each POST, to emulate the network")
+    parser.add_argument("--max-rows", type=int, default=None,
+                        help="time out queries with more result relations than this")
+    parser.add_argument("--json-only", action="store_true",
+                        help="serve results as gzip'd JSON only, whatever the request asks for")
+    opts = parser.parse_args()
+    server = MockServer(("127.0.0.1", opts.port), Fixtures(opts.scale, opts.seed),
+                        latency=opts.latency, max_rows=opts.max_rows,
+                        formats=("json-gzip",) if opts.json_only else None)
+    print(f"serving on {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""End to end benchmarks of the patternq.dataset and patternq.reference
+wrappers against the local mock server (see mockserver.py), reporting wall
+time split by phase and peak traced memory per wrapper:
+
+    request  POSTing the query and waiting for the presigned result URL
+    query    downloading and decoding results (summed over worker threads
+             for batched queries)
+    frame    the wrapper's own work building its DataFrame
+
+    python benchmarks/suite.py [--scale 0.1] [--repeat 3] [--only samples]
+                               [--json results.json] [--baseline results.json]
+                               [--local copy.sqlite] [--arrow]
+
+Import times of the patternq modules are measured first, in fresh
+interpreters (see bench_import.py), and a module that should not load pandas
+but does is flagged. The mock server runs in a subprocess so its work is
+neither timed nor traced. With --baseline, each wrapper's time is compared to a previous
+--json run and regressions beyond --tolerance are flagged. With --local, the
+mock database is first copied to a SQLite file and the wrappers are answered
+by a patternq.backend.LocalBackend over it. With --arrow, queries ask for
+Arrow results (see patternq.formats.enable), which the mock server returns
+for scalar :find queries."""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import patternq.backend as pqb
+import patternq.dataset as pqd
+import patternq.formats as pqf
+import patternq.query as pqq
+import patternq.reference as pqr
+
+import bench_import
+
+dataset = "tcga-brca"
+phases = ["request", "query", "frame"]
+
+
+class PhaseTimer:
+    """Times calls of wrapped functions as phases, excluding the time of
+    nested wrapped calls, so that phases add up to the time spent."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.local = threading.local()
+
+    def wrap(self, fn, phase):
+        def timed(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.close(stack, phase, time.perf_counter() - start)
+        return timed
+
+    def wrap_iter(self, fn, phase):
+        # generators do their work as they are consumed
+        def timed(*args, **kwargs):
+            items = fn(*args, **kwargs)
+            while True:
+                stack = self.local.__dict__.setdefault("stack", [])
+                stack.append(0.0)
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    self.close(stack, phase, time.perf_counter() - start)
+                yield item
+        return timed
+
+    def close(self, stack, phase, elapsed):
+        nested = stack.pop()
+        self.totals[phase] += elapsed - nested
+        if stack:
+            stack[-1] += elapsed
+
+
+def patched(timer):
+    """Wrap the client's request and download functions with `timer`,
+    returning the originals."""
+    originals = {name: getattr(pqq, name) for name in
+                 ["query_result_url", "matrix_url", "query", "query_batched", "datoms", "query_iter"]}
+    for name in ["query_result_url", "matrix_url"]:
+        setattr(pqq, name, timer.wrap(originals[name], "request"))
+    for name in ["query", "query_batched", "datoms"]:
+        setattr(pqq, name, timer.wrap(originals[name], "query"))
+    pqq.query_iter = timer.wrap_iter(originals["query_iter"], "query")
+    return originals
+
+
+def run(fn, repeat):
+    """Best of `repeat` timed runs of fn, with its phases, then one traced
+    run for peak memory."""
+    best = None
+    for _ in range(repeat):
+        timer = PhaseTimer()
+        originals = patched(timer)
+        try:
+            start = time.perf_counter()
+            result = fn()
+            total = time.perf_counter() - start
+        finally:
+            for name, original in originals.items():
+                setattr(pqq, name, original)
+        if best is None or total < best["total"]:
+            split = {phase: timer.totals.get(phase, 0.0) for phase in phases[:2]}
+            split["frame"] = max(total - sum(split.values()), 0.0)
+            best = {"total": total, **split, "rows": len(result)}
+    tracemalloc.start()
+    try:
+        fn()
+        best["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+    return best
+
+
+def cases(ids):
+    """(name, fn) of each benchmarked call, with arguments drawn from the
+    fixtures."""
+    subject, sample, variant, gene = ids["subjects"], ids["samples"], ids["variants"], ids["genes"]
+    return [
+        ("pqd.datasets", lambda: pqd.datasets()),
+        ("pqd.samples", lambda: pqd.samples(dataset)),
+        ("pqd.subjects", lambda: pqd.subjects(dataset)),
+        ("pqd.assay_summary", lambda: pqd.assay_summary(dataset)),
+        ("pqd.clinical_summary", lambda: pqd.clinical_summary(dataset)),
+        ("pqd.clinical_events_for_patients",
+         lambda: pqd.clinical_events_for_patients(dataset, subject, batch_size=100)),
+        ("pqd.patient_assays", lambda: pqd.patient_assays(dataset, subject, batch_size=100)),
+        ("pqd.measurements", lambda: pqd.measurements(dataset, "tumor purity")),
+        ("pqd.measurements[rna-seq]", lambda: pqd.measurements(dataset, "rna-seq")),
+        ("pqd.sample_measurements",
+         lambda: pqd.sample_measurements(dataset, "baseline mutations", sample[:200])),
+        ("pqd.gene_expression_measurements",
+         lambda: pqd.gene_expression_measurements("rna-seq", "tpm")),
+        ("pqd.gene_expression_measurements[compact]",
+         lambda: pqd.gene_expression_measurements("rna-seq", "tpm", compact=True)),
+        ("pqd.gene_expression_measurements[wide]",
+         lambda: pqd.gene_expression_measurements("rna-seq", "tpm", wide=True)),
+        ("pqd.gene_expression_measurements[wide,sparse]",
+         lambda: pqd.gene_expression_measurements("rna-seq", "tpm", wide=True, sparse=True)),
+        ("pqd.measurement_matrices", lambda: pqd.measurement_matrices(dataset)),
+        ("pqd.variant_measurements", lambda: pqd.variant_measurements("baseline mutations")),
+        ("pqd.measurements_of_variants", lambda: pqd.measurements_of_variants(variant[:2000])),
+        ("pqd.variants_by_impact",
+         lambda: pqd.variants_by_impact(sample[0], "baseline mutations", "moderate")),
+        ("pqd.gene_expression_for_genes",
+         lambda: pqd.gene_expression_for_genes(sample[0], "rna-seq", "tpm", gene[:500])),
+        ("pqd.cnv_by_gene_measurements", lambda: pqd.cnv_by_gene_measurements(sample[0], "copy number")),
+        ("pqd.cohort_gene_expression", lambda: pqd.cohort_gene_expression("tpm", gene[0])),
+        ("pqd.cohort_expression_for_genes",
+         lambda: pqd.cohort_expression_for_genes("tpm", gene[:200])),
+        ("pqd.single_cell_populations", lambda: pqd.single_cell_populations()),
+        ("pqr.gene_symbols", lambda: pqr.gene_symbols()),
+        ("pqr.genes", lambda: pqr.genes()),
+        ("pqr.gene_coordinates", lambda: pqr.gene_coordinates()),
+        ("pqr.gdc_anatomic_sites", lambda: pqr.gdc_anatomic_sites()),
+        ("pqr.all_variants", lambda: pqr.all_variants()),
+        ("pqr.variant_info", lambda: pqr.variant_info(variant[:2000])),
+        ("pqr.variants_for_genes", lambda: pqr.variants_for_genes(gene[:200])),
+        ("pqq.get_measurement_matrix",
+         lambda: pqq.get_measurement_matrix(ids["matrix"], cache=False)),
+        ("pqq.datoms_frame", lambda: pqq.datoms_frame("aevt", [":sample/id"])),
+    ]
+
+
+def fixture_ids():
+    samples = pqd.samples(dataset)
+    return {"subjects": pqd.subjects(dataset)["subject-id"].tolist(),
+            "samples": samples.loc[samples["sample-id"].str.endswith("01A"), "sample-id"].tolist(),
+            "variants": [v for v in pqr.all_variants()["variant-id"].drop_duplicates()],
+            "genes": pqr.gene_symbols(),
+            "matrix": pqd.measurement_matrices(dataset)["measurement-matrix-key"][0]}
+
+
+def start_server(scale, latency):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(here)] + sys.path[1:]))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, "mockserver.py"),
+                             "--scale", str(scale), "--port", "0", "--latency", str(latency)],
+                            stdout=subprocess.PIPE, text=True, env=env)
+    line = proc.stdout.readline()
+    if not line.startswith("serving on "):
+        proc.kill()
+        raise Exception(f"Mock server failed to start: {line!r}")
+    return proc, line.split()[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--only", default="", help="run wrappers whose name contains this")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against results of an earlier --json run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="flag wrappers more than this fraction slower than baseline")
+    parser.add_argument("--local", help="answer queries from a local copy at this path")
+    parser.add_argument("--arrow", action="store_true",
+                        help="ask for Arrow results, see patternq.formats")
+    opts = parser.parse_args()
+    proc, url = start_server(opts.scale, opts.latency)
+    if opts.arrow:
+        pqf.enable()
+    os.environ["PATTERNQ_ENDPOINT"] = url
+    os.environ.setdefault("PATTERNQ_API_KEY", "benchmark")
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)["results"]
+    results = {}
+    for module in bench_import.lean_modules:
+        name = f"import {module}"
+        if opts.only not in name:
+            continue
+        r = results[name] = bench_import.measure(module, opts.repeat)
+        line = f"{name:44s} {'':8s} {r['total']:8.3f}"
+        if name in baseline:
+            ratio = r["total"] / max(baseline[name]["total"], 1e-9)
+            line += f"  {ratio:5.2f}x" + ("  REGRESSION" if ratio > 1 + opts.tolerance else "")
+        if r["loaded"]:
+            line += f"  REGRESSION: loads {', '.join(r['loaded'])}"
+        print(line, flush=True)
+    try:
+        if opts.local:
+            start = time.perf_counter()
+            pqb.build_local(opts.local)
+            print(f"built {opts.local} in {time.perf_counter() - start:.3f}s", flush=True)
+            pqb.use(pqb.LocalBackend(opts.local))
+        ids = fixture_ids()
+        print(f"{'wrapper':44s} {'rows':>8s} {'total':>8s} {'request':>8s} {'query':>8s} "
+              f"{'frame':>8s} {'peak MB':>8s}")
+        for name, fn in cases(ids):
+            if opts.only not in name:
+                continue
+            r = results[name] = run(fn, opts.repeat)
+            line = (f"{name:44s} {r['rows']:8d} {r['total']:8.3f} {r['request']:8.3f} "
+                    f"{r['query']:8.3f} {r['frame']:8.3f} {r['peak_mb']:8.1f}")
+            if name in baseline:
+                ratio = r["total"] / max(baseline[name]["total"], 1e-9)
+                line += f"  {ratio:5.2f}x" + ("  REGRESSION" if ratio > 1 + opts.tolerance else "")
+            print(line, flush=True)
+    finally:
+        proc.terminate()
+        proc.wait()
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump({"scale": opts.scale, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""asyncio counterparts of query, datoms, get_measurement_matrix and the
+patternq.dataset / patternq.reference wrappers.
+
+Calls run on a client's worker threads over the client's pooled session,
+so they don't block the event loop and many can be awaited concurrently,
+e.g.:
+
+    import patternq.aio as pqa
+
+    async with pqa.Client(max_concurrency=32, timeout=120) as client:
+        samples, subjects = await asyncio.gather(
+            client.dataset.samples("tcga-brca", db_name="tcga-brca"),
+            client.dataset.subjects("tcga-brca", db_name="tcga-brca"))
+
+Module level functions use a shared default client, see `get_client`."""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+
+import patternq.dataset as pqd
+import patternq.query as pqq
+import patternq.reference as pqr
+
+default_client = None
+
+
+class AsyncModule:
+    """Exposes the functions of a wrapper module (e.g. patternq.dataset) as
+    coroutine functions running on a client."""
+
+    def __init__(self, client, module):
+        self._client = client
+        self._module = module
+
+    def __getattr__(self, name):
+        fn = getattr(self._module, name)
+        if name.startswith("_") or not callable(fn):
+            raise AttributeError(f"{self._module.__name__}.{name} is not a query function")
+        return functools.partial(self._client.call, fn)
+
+
+class Client:
+    """Runs patternq calls with at most `max_concurrency` in flight, over a
+    session with a connection pool of the same size. If `timeout` is set,
+    awaiting a call raises asyncio.TimeoutError after that many seconds
+    (the call's thread still runs to completion)."""
+
+    def __init__(self, max_concurrency: int = 16, timeout: float or None = None,
+                 session: requests.Session or None = None):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.session = session or pqq.make_session(pool_size=max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                           thread_name_prefix="patternq-aio")
+        self.dataset = AsyncModule(self, pqd)
+        self.reference = AsyncModule(self, pqr)
+
+    async def call(self, fn, *args, **kwargs):
+        """Await a patternq function on the client's threads, passing it the
+        client's session unless one is given."""
+        kwargs.setdefault("session", self.session)
+        loop = asyncio.get_running_loop()
+        # run in a copy of the caller's context, for its `pqi.context` attributes
+        ctx = contextvars.copy_context()
+        fut = loop.run_in_executor(self.executor, functools.partial(ctx.run, fn, *args, **kwargs))
+        if self.timeout is None:
+            return await fut
+        return await asyncio.wait_for(fut, self.timeout)
+
+    async def query(self, q_dict: Dict[str, List[Any]], args: List[Any] or None = None, **kwargs):
+        return await self.call(pqq.query, q_dict, args=args, **kwargs)
+
+    async def query_batched(self, q_dict: Dict[str, List[Any]], args: List[Any],
+                            batch_arg: int, **kwargs):
+        return await self.call(pqq.query_batched, q_dict, args, batch_arg, **kwargs)
+
+    async def datoms(self, index, components, **kwargs):
+        return await self.call(pqq.datoms, index, components, **kwargs)
+
+    async def get_measurement_matrix(self, matrix_key: str, **kwargs):
+        return await self.call(pqq.get_measurement_matrix, matrix_key, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+
+def get_client() -> Client:
+    """Returns the module wide default client, creating it on first use."""
+    global default_client
+    if default_client is None:
+        default_client = Client()
+    return default_client
+
+
+def set_client(client: Client):
+    """Sets the client used by the module level functions."""
+    global default_client
+    default_client = client
+    return True
+
+
+async def query(q_dict: Dict[str, List[Any]], args: List[Any] or None = None, **kwargs):
+    """Async `patternq.query.query` on the default client."""
+    return await get_client().query(q_dict, args=args, **kwargs)
+
+
+async def query_batched(q_dict: Dict[str, List[Any]], args: List[Any], batch_arg: int, **kwargs):
+    """Async `patternq.query.query_batched` on the default client."""
+    return await get_client().query_batched(q_dict, args, batch_arg, **kwargs)
+
+
+async def datoms(index, components, **kwargs):
+    """Async `patternq.query.datoms` on the default client."""
+    return await get_client().datoms(index, components, **kwargs)
+
+
+async def get_measurement_matrix(matrix_key: str, **kwargs):
+    """Async `patternq.query.get_measurement_matrix` on the default client."""
+    return await get_client().get_measurement_matrix(matrix_key, **kwargs)
+
+
+def __getattr__(name):
+    # pqa.dataset / pqa.reference resolve against the current default client.
+    if name == "dataset":
+        return get_client().dataset
+    if name == "reference":
+        return get_client().reference
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,273 @@
+"""Backends answering `patternq.query.query`, `query_iter` and `datoms`.
+
+By default queries go to the query service. A `LocalBackend` answers them
+instead from a SQLite copy of a database's datoms, built once with
+`build_local`, evaluating the query dicts with `patternq.datalog`, so the
+dataset and reference wrappers run unchanged with no network:
+
+    import patternq.backend as pqb
+
+    pqb.build_local("tcga-brca.sqlite", db_name="tcga-brca")
+    local = pqb.LocalBackend("tcga-brca.sqlite")
+
+    pqd.samples("tcga-brca", backend=local)   # for one call
+    pqb.use(local)                            # for the session
+    pqd.samples("tcga-brca", backend=pqb.remote)
+
+Local results are exact for the database as of the basis_t the copy was
+built at. Measurement matrices are only served by the query service."""
+import abc
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List
+
+import patternq.datalog as pqdl
+import patternq.helpers as pqh
+import patternq.instrument as pqi
+import patternq.query as pqq
+
+# attributes of the schema, with their value type, cardinality and uniqueness
+schema_q = {
+    ":find": [["pull", "?a", [":db/id", ":db/ident",
+                              {":db/valueType": [":db/ident"]},
+                              {":db/cardinality": [":db/ident"]},
+                              {":db/unique": [":db/ident"]}]]],
+    ":where": [["?a", ":db/valueType"]]
+}
+# datoms per page read from the service by `build_local`
+build_page_size = 10000
+# values looked up per SQL statement
+max_params = 500
+# query results a LocalBackend keeps in memory, most recent last
+local_results = 32
+
+
+class Backend(abc.ABC):
+    """Answers queries and datoms requests for a database. `remote`
+    backends are answered by `patternq.query` itself."""
+    name = None
+    remote = False
+
+    @abc.abstractmethod
+    def query(self, q_dict: Dict[str, List[Any]], args: List[Any] or None = None,
+              db_name: str or None = None, flatten_enums: bool = False) -> Dict[str, Any]:
+        """Result of a query, as {"query_result": [...], "basis_t": ...},
+        with enums flattened if `flatten_enums` (see `pqq.query`)."""
+
+    @abc.abstractmethod
+    def datoms(self, index: str, components: List[Any], offset: int = 0,
+               limit: int = 1000, db_name: str or None = None) -> List[Dict[str, Any]]:
+        """A page of datoms of `index` matching `components` (see `pqq.datoms`)."""
+
+
+class RemoteBackend(Backend):
+    """The query service, see `patternq.query.commons_endpoint`."""
+    name = "remote"
+    remote = True
+
+    def query(self, q_dict, args=None, db_name=None, flatten_enums=False):
+        return pqq.query(q_dict, args=args, db_name=db_name, flatten_enums=flatten_enums,
+                         backend=self)
+
+    def datoms(self, index, components, offset=0, limit=1000, db_name=None):
+        return pqq.datoms(index, components, offset=offset, limit=limit, db_name=db_name,
+                          backend=self)
+
+
+remote = RemoteBackend()
+
+
+class SQLiteStore:
+    """Datoms of a database in a SQLite file (see `build_local`), as the
+    store `patternq.datalog` evaluates queries against."""
+
+    def __init__(self, path: str):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No local database at {path}, see patternq.backend.build_local")
+        self.path = path
+        self._local = threading.local()
+        conn = self.connection()
+        self.attributes = {ident: pqdl.Attribute(ident, value_type, bool(many), unique)
+                           for ident, value_type, many, unique in
+                           conn.execute("SELECT ident, value_type, many, is_unique FROM attributes")}
+        self.booleans = {a.ident for a in self.attributes.values()
+                         if a.value_type == ":db.type/boolean"}
+        self.idents = dict(conn.execute("SELECT v, e FROM datoms WHERE a = ':db/ident'"))
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        self.basis_t = json.loads(meta["basis_t"])
+        self.db_name = meta.get("db_name")
+
+    def connection(self) -> sqlite3.Connection:
+        """A read only connection for the calling thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True,
+                                                      check_same_thread=False)
+        return conn
+
+    def decode(self, datoms):
+        return [(e, a, bool(v) if a in self.booleans else v, tx) for e, a, v, tx in datoms]
+
+    def select(self, where: str, params: List[Any], values=None, column: str or None = None,
+               index: str or None = None):
+        """Datoms matching the SQL condition `where`, and with `column` in
+        `values` if given, read through `index` if given."""
+        conn = self.connection()
+        if values is None:
+            table = f"datoms INDEXED BY {index}" if index else "datoms"
+            return self.decode(conn.execute(f"SELECT e, a, v, tx FROM {table} WHERE {where}", params))
+        values = list(values)
+        out = []
+        for i in range(0, len(values), max_params):
+            chunk = values[i:i + max_params]
+            conditions = ([where] if where else []) + [f"{column} IN ({','.join('?' * len(chunk))})"]
+            out.extend(conn.execute(f"SELECT e, a, v, tx FROM datoms WHERE {' AND '.join(conditions)}",
+                                    params + chunk))
+        return self.decode(out)
+
+    def match(self, a, es=None, vs=None):
+        if a is not None and a not in self.attributes and a != ":db/ident":
+            return []
+        where, params = ("a = ?", [a]) if a is not None else ("", [])
+        if es is not None:
+            return self.select(where, params, es, "e")
+        if vs is not None:
+            return self.select(where, params, vs, "v")
+        if a is not None:
+            # in entity order, as the service's aevt index gives them
+            return self.select(where, params, index="aevt")
+        return self.select("1", params)
+
+    def attribute(self, ident):
+        return self.attributes.get(ident)
+
+    def entid(self, ident):
+        return self.idents.get(ident)
+
+    def entity(self, eid) -> Dict[str, List[Any]]:
+        """Values of `eid` by attribute, in the order the service's eavt
+        index gave them when the copy was built (so "*" pulls list their
+        attributes as the service does)."""
+        attrs = defaultdict(list)
+        for _, a, v, _ in self.select("e = ? ORDER BY rowid", [eid]):
+            attrs[a].append(v)
+        return attrs
+
+    def referrers(self, attr, eid) -> List[int]:
+        return [e for e, _, _, _ in self.select("a = ? AND v = ?", [attr, eid])]
+
+
+def _copy_result(qres):
+    return dict(qres, query_result=[list(r) if isinstance(r, (list, tuple)) else r
+                                    for r in qres["query_result"]])
+
+
+class LocalBackend(Backend):
+    """Answers queries from a SQLite copy of a database built by
+    `build_local`, whatever db_name they are issued for. The copy doesn't
+    change, so the last `local_results` results are kept in memory, and
+    repeated queries get a copy of their relations (the maps of pulls are
+    shared, treat them as read only)."""
+    name = "local"
+
+    def __init__(self, path: str):
+        self.store = SQLiteStore(path)
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def query(self, q_dict, args=None, db_name=None, flatten_enums=False):
+        key = json.dumps([q_dict, args, flatten_enums], sort_keys=True, default=str)
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return _copy_result(self.results[key])
+        qres = pqdl.query(self.store, q_dict, args)
+        if flatten_enums:
+            qres = pqh.flatten_enum_idents(qres)
+        with self.lock:
+            self.results[key] = qres
+            while len(self.results) > local_results:
+                self.results.popitem(last=False)
+        return _copy_result(qres)
+
+    def datoms(self, index, components, offset=0, limit=1000, db_name=None):
+        order = {"eavt": "e, a, v", "aevt": "a, e, v", "avet": "a, v, e", "vaet": "v, a, e"}
+        if index not in order:
+            raise ValueError(f"Unknown datoms index {index}, expected one of {list(order)}")
+        columns = order[index].replace(" ", "").split(",")
+        clauses = [f"{c} = ?" for c in columns[:len(components)]]
+        sql = (f"SELECT e, a, v, tx FROM datoms {'WHERE ' + ' AND '.join(clauses) if clauses else ''}"
+               f" ORDER BY {order[index]} LIMIT ? OFFSET ?")
+        rows = self.store.connection().execute(sql, list(components) + [limit, offset])
+        return [{"e": e, "a": a, "v": v, "tx": tx, "added": True}
+                for e, a, v, tx in self.store.decode(rows)]
+
+
+def use(backend: Backend or None):
+    """Answer the session's queries with `backend` (None for the query
+    service), unless another is passed per call."""
+    pqq.default_backend = backend
+
+
+def build_local(path: str, db_name: str or None = None, page_size: int or None = None,
+                **kwargs) -> str:
+    """Copy the datoms of a database from the query service into a SQLite
+    file at `path`, for a `LocalBackend`. Raises if the database's basis_t
+    changed while the datoms were copied. Other kwargs are passed to
+    `pqq.query` and `pqq.iter_datoms`. Returns the path."""
+    if db_name is None:
+        db_name = pqq.db
+    if page_size is None:
+        page_size = build_page_size
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with pqi.phase("backend.build", db_name=db_name) as attrs:
+        basis_t = pqq.query(pqq.basis_t_q, db_name=db_name, cache=False, backend=remote,
+                            **kwargs)["basis_t"]
+        schema = pqq.query(schema_q, db_name=db_name, cache=False, backend=remote,
+                           **kwargs)["query_result"]
+        ident = lambda a, attr: (a.get(attr) or {}).get(":db/ident")  # noqa: E731
+        attributes = [(a[":db/ident"], ident(a, ":db/valueType"),
+                       ident(a, ":db/cardinality") == ":db.cardinality/many",
+                       ident(a, ":db/unique"), a.get(":db/id")) for (a,) in schema]
+        ident_of = {eid: ident for ident, _, _, _, eid in attributes}
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.executescript("""
+                CREATE TABLE datoms (e INTEGER NOT NULL, a TEXT NOT NULL, v, tx INTEGER);
+                CREATE TABLE attributes (ident TEXT PRIMARY KEY, value_type TEXT,
+                                         many INTEGER, is_unique TEXT);
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);""")
+            conn.executemany("INSERT INTO attributes VALUES (?, ?, ?, ?)",
+                             [a[:4] for a in attributes])
+            datoms = pqq.iter_datoms("eavt", [], page_size=page_size, db_name=db_name,
+                                     backend=remote, **kwargs)
+            rows = ((d["e"], ident_of.get(d["a"], d["a"]), d["v"], d["tx"])
+                    for d in datoms if d.get("added", True))
+            conn.executemany("INSERT INTO datoms VALUES (?, ?, ?, ?)", rows)
+            # pages are read at whatever basis_t is current when each is
+            # asked for, so they are only consistent if nothing was
+            # transacted during the walk
+            walked_t = pqq.query(pqq.basis_t_q, db_name=db_name, cache=False, backend=remote,
+                                 **kwargs)["basis_t"]
+            if walked_t != basis_t:
+                raise Exception(f"Database {db_name} moved from basis_t {basis_t} to "
+                                f"{walked_t} while its datoms were copied, build it again "
+                                f"to get a consistent copy.")
+            conn.executescript("""
+                CREATE INDEX eavt ON datoms (e, a);
+                CREATE INDEX aevt ON datoms (a, e);
+                CREATE INDEX avet ON datoms (a, v);""")
+            conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                             [("basis_t", json.dumps(basis_t)), ("db_name", db_name)])
+            attrs["rows"] = conn.execute("SELECT count(*) FROM datoms").fetchone()[0]
+            attrs["basis_t"] = basis_t
+            conn.commit()
+        finally:
+            conn.close()
+    os.replace(tmp, path)
+    return path
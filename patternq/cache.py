@@ -0,0 +1,284 @@
+"""Opt-in local on-disk cache of decoded query results.
+
+Entries are keyed by db_name, the normalized query dict and its args, and
+stored per basis_t, so a cached result is only served while the database
+has not advanced past the basis_t it was computed at. The cache directory
+is size bounded, evicting least recently used entries first.
+
+Measurement matrices are cached separately (see `store_matrix`), keyed
+by db_name and matrix key, and stored column-wise as memory mappable
+.npy blocks so repeated loads don't re-download or re-parse the TSV.
+
+Enable for the session via `enable()`, or per call by passing `cache=True`
+to `patternq.query.query` (and `cache=False` to bypass it)."""
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Dict, List
+
+CacheStats = namedtuple(
+    "CacheStats",
+    [
+        'hits',
+        'misses',
+        'stores',
+        'evictions'
+    ]
+)
+
+enabled = False
+cache_dir = None
+max_bytes = 2 * 1024 ** 3
+max_matrix_bytes = 20 * 1024 ** 3
+# seconds a database's observed basis_t is trusted before it is
+# re-checked against the query service.
+basis_check_interval = 60
+
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+_basis_ts = {}
+_lock = threading.Lock()
+
+
+def default_cache_dir() -> str:
+    path = os.getenv("PATTERNQ_CACHE_DIR")
+    if not path:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "patternq")
+    return path
+
+
+def enable(path: str or None = None, size_limit: int or None = None):
+    """Enable the query result cache for the duration of the session, stored
+    under `path` (default: PATTERNQ_CACHE_DIR or ~/.cache/patternq) and
+    bounded to `size_limit` bytes on disk."""
+    global enabled, cache_dir, max_bytes
+    cache_dir = path
+    if size_limit is not None:
+        max_bytes = size_limit
+    enabled = True
+    return True
+
+
+def disable():
+    global enabled
+    enabled = False
+    return True
+
+
+def directory(kind: str = "query") -> str:
+    path = os.path.join(cache_dir or default_cache_dir(), kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def stats() -> CacheStats:
+    """Returns hit/miss/store/eviction counts for the session."""
+    with _lock:
+        return CacheStats(**_stats)
+
+
+def reset_stats():
+    with _lock:
+        for k in _stats:
+            _stats[k] = 0
+
+
+def _count(stat: str, n: int = 1):
+    with _lock:
+        _stats[stat] += n
+
+
+def cache_key(db_name: str, q_dict: Dict[str, List[Any]], args: List[Any] or None,
+              **opts) -> str:
+    """Stable key for a query: the query dict and args are normalized by
+    serializing with sorted keys, so equal queries share a key regardless
+    of dict ordering."""
+    normalized = json.dumps([db_name, q_dict, args or [], opts],
+                            sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def known_basis_t(db_name: str):
+    """Returns the most recently observed basis_t for db_name if it was
+    observed within `basis_check_interval` seconds, otherwise None."""
+    with _lock:
+        observed = _basis_ts.get(db_name)
+    if observed and time.monotonic() - observed[1] < basis_check_interval:
+        return observed[0]
+    return None
+
+
+def note_basis_t(db_name: str, basis_t):
+    """Record the basis_t of a database as seen on a query result."""
+    if basis_t is None:
+        return
+    with _lock:
+        prev = _basis_ts.get(db_name)
+        if prev is None or basis_t >= prev[0]:
+            _basis_ts[db_name] = (basis_t, time.monotonic())
+
+
+def _entry_path(key: str, basis_t) -> str:
+    return os.path.join(directory(), f"{key}-{basis_t}.pkl")
+
+
+def lookup(key: str, basis_t):
+    """Returns the cached result for key at basis_t, or None."""
+    path = _entry_path(key, basis_t)
+    try:
+        with open(path, "rb") as f:
+            qres = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        _count("misses")
+        return None
+    # bump mtime, which serves as the LRU clock for eviction.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    _count("hits")
+    return qres
+
+
+def store(key: str, qres: Dict[str, Any]):
+    """Write a result to the cache under its basis_t, removing entries for
+    the same key at older basis_t, then evict down to the size limit."""
+    path = _entry_path(key, qres["basis_t"])
+    cache_path = os.path.dirname(path)
+    for name in os.listdir(cache_path):
+        if name.startswith(key + "-"):
+            try:
+                os.remove(os.path.join(cache_path, name))
+            except OSError:
+                pass
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(qres, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    _count("stores")
+    _count("evictions", evict(cache_path, max_bytes))
+
+
+def evict(path: str, size_limit: int) -> int:
+    """Remove least recently used files in `path` until the total size is
+    at most size_limit bytes, returning the number of files removed."""
+    entries = []
+    total = 0
+    for name in os.listdir(path):
+        if name.endswith(".tmp"):
+            continue
+        full_path = os.path.join(path, name)
+        try:
+            st = os.stat(full_path)
+            size = _dir_size(full_path) if os.path.isdir(full_path) else st.st_size
+        except OSError:
+            continue
+        entries.append((st.st_mtime, size, full_path))
+        total += size
+    removed = 0
+    for _, size, full_path in sorted(entries):
+        if total <= size_limit:
+            break
+        try:
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path)
+            else:
+                os.remove(full_path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def clear(kind: str = "query"):
+    """Remove all cached entries of `kind`."""
+    evict(directory(kind), 0)
+
+
+def matrix_path(db_name: str, matrix_key: str) -> str:
+    """Directory a measurement matrix is (or would be) cached in."""
+    digest = hashlib.sha256(f"{db_name}/{matrix_key}".encode("utf-8")).hexdigest()
+    return os.path.join(directory("matrix"), digest)
+
+
+def anndata_path(db_name: str, matrix_key: str, basis_t, **opts) -> str:
+    """h5ad file an AnnData of a measurement matrix is (or would be) written
+    to, keyed by the basis_t and options (e.g. dataset, sparse) it was
+    built with, in a directory of its own next to the matrix cache."""
+    key = cache_key(db_name, {"matrix": matrix_key}, None, basis_t=basis_t, **opts)
+    return os.path.join(directory("anndata"), f"{key}.h5ad")
+
+
+def store_matrix(db_name: str, matrix_key: str, df):
+    """Cache a measurement matrix DataFrame column-wise: numeric columns as
+    one column-major .npy block per dtype, the remaining (label) columns
+    pickled, plus a json manifest of the column layout. Then evicts
+    matrices down to `max_matrix_bytes`."""
+    import numpy as np
+    import pandas as pd
+    path = matrix_path(db_name, matrix_key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    blocks = {}
+    labels = []
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_numeric_dtype(dtype) and isinstance(dtype, np.dtype):
+            blocks.setdefault(dtype.str, []).append(col)
+        else:
+            labels.append(col)
+    manifest = {"db_name": db_name,
+                "matrix_key": matrix_key,
+                "columns": [str(col) for col in df.columns],
+                "labels": [str(col) for col in labels],
+                "blocks": []}
+    for i, (dtype, cols) in enumerate(blocks.items()):
+        block_file = f"block-{i}.npy"
+        np.save(os.path.join(tmp_path, block_file),
+                np.asfortranarray(df[cols].to_numpy(dtype=dtype)))
+        manifest["blocks"].append({"file": block_file,
+                                   "columns": [str(col) for col in cols]})
+    df[labels].to_pickle(os.path.join(tmp_path, "labels.pkl"))
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # stored concurrently by another caller.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    evict(directory("matrix"), max_matrix_bytes)
+    return path
+
+
+def load_matrix(db_name: str, matrix_key: str):
+    """Returns a cached measurement matrix as a DataFrame whose numeric
+    columns are memory mapped (copy on write) from the cache, or None if it
+    isn't cached."""
+    import numpy as np
+    import pandas as pd
+    path = matrix_path(db_name, matrix_key)
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+    except OSError:
+        return None
+    os.utime(path)
+    parts = [pd.read_pickle(os.path.join(path, "labels.pkl"))]
+    for block in manifest["blocks"]:
+        values = np.load(os.path.join(path, block["file"]), mmap_mode="c")
+        # column-major on disk, so the transposed block pandas stores is
+        # a view of the mapped file rather than a copy.
+        parts.append(pd.DataFrame(values, columns=block["columns"], copy=False))
+    df = pd.concat(parts, axis=1, copy=False)
+    if df.columns.tolist() != manifest["columns"]:
+        df = df[manifest["columns"]]
+    return df
@@ -0,0 +1,313 @@
+"""A small Datalog evaluator answering patternq's query dicts against a
+local store of datoms (see `patternq.backend.SQLiteStore`), in the shape
+the query service returns: {"query_result": [...], "basis_t": ...}.
+
+It covers what the shipped queries use: data patterns (with variable
+attributes and ident keywords in ref value position), scalar, collection,
+tuple and relation :in bindings, or, or-join, and, not, not-join,
+comparison predicates, pull patterns (with nested and reverse attributes),
+aggregates and :with. Clauses are joined in the order given, as Datomic
+does, so the order of :where matters here as it does on the service.
+
+A store provides:
+
+    match(a, es, vs)   -> [(e, a, v, tx), ...] datoms of attribute `a` (any
+                          attribute if None), with e in `es` and v in `vs`
+                          when those are given
+    attribute(ident)   -> Attribute, or None for an unknown attribute
+    entid(ident)       -> entity id of an ident keyword, or None
+    entity(eid)        -> {attribute: [values]}
+    referrers(a, eid)  -> entity ids referring to `eid` through `a`
+    basis_t"""
+import operator
+from collections import defaultdict, namedtuple
+from typing import Any, Dict, List
+
+import patternq.optimize as pqo
+
+Attribute = namedtuple("Attribute", ["ident", "value_type", "many", "unique"])
+Relation = namedtuple("Relation", ["vars", "rows"])
+
+predicates = {"=": operator.eq, "!=": operator.ne, "not=": operator.ne,
+              "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+aggregates = {
+    "count": len,
+    "count-distinct": lambda values: len(set(values)),
+    "min": min,
+    "max": max,
+    "sum": sum,
+    "avg": lambda values: sum(values) / len(values),
+    "distinct": lambda values: list(dict.fromkeys(values)),
+}
+
+
+def query(store, q_dict: Dict[str, List[Any]], args: List[Any] or None = None) -> Dict[str, Any]:
+    """Result of a query dict against `store`."""
+    rel = bind_inputs(q_dict.get(":in", ["$"]), args or [])
+    for clause in q_dict[":where"]:
+        rel = apply_clause(store, rel, clause)
+    return {"query_result": find(store, q_dict, rel), "basis_t": store.basis_t}
+
+
+# -- relations
+
+def join(left: Relation, right: Relation) -> Relation:
+    """Natural (hash) join of two relations, a product if they share no
+    variables."""
+    shared = [v for v in right.vars if v in left.vars]
+    extra = [i for i, v in enumerate(right.vars) if v not in left.vars]
+    vars = left.vars + tuple(right.vars[i] for i in extra)
+    if not shared:
+        return Relation(vars, [l + tuple(r[i] for i in extra)
+                               for l in left.rows for r in right.rows])
+    li = [left.vars.index(v) for v in shared]
+    ri = [right.vars.index(v) for v in shared]
+    index = defaultdict(list)
+    for r in right.rows:
+        index[tuple(r[i] for i in ri)].append(tuple(r[i] for i in extra))
+    return Relation(vars, [l + ext for l in left.rows
+                           for ext in index.get(tuple(l[i] for i in li), ())])
+
+
+def project(rel: Relation, vars) -> Relation:
+    idx = [rel.vars.index(v) for v in vars]
+    return Relation(tuple(vars), list(dict.fromkeys(tuple(row[i] for i in idx)
+                                                    for row in rel.rows)))
+
+
+def bind_inputs(in_specs, args) -> Relation:
+    rel = Relation((), [()])
+    args = iter(args)
+    for spec in in_specs:
+        if pqo.is_source(spec):
+            continue
+        value = next(args)
+        if pqo.is_var(spec):
+            bound = Relation((spec,), [(value,)])
+        elif spec[-1] == "...":
+            bound = Relation((spec[0],), [(v,) for v in dict.fromkeys(value)])
+        elif isinstance(spec[0], list):
+            bound = Relation(tuple(spec[0]), [tuple(v) for v in value])
+        else:
+            bound = Relation(tuple(spec), [tuple(value)])
+        rel = join(rel, bound)
+    return rel
+
+
+# -- clauses
+
+def apply_clause(store, rel: Relation, clause) -> Relation:
+    head = clause[0]
+    if head in ("or", "or-join"):
+        return apply_or(store, rel, clause)
+    if head in ("not", "not-join"):
+        return apply_not(store, rel, clause)
+    if head == "and":
+        for c in clause[1:]:
+            rel = apply_clause(store, rel, c)
+        return rel
+    if isinstance(head, list):
+        return apply_predicate(rel, clause)
+    return match_pattern(store, rel, clause)
+
+
+def branch_clauses(branch):
+    return branch[1:] if branch[0] == "and" else [branch]
+
+
+def apply_or(store, rel: Relation, clause) -> Relation:
+    if clause[0] == "or-join":
+        join_vars = pqo.form_vars(clause[1])
+        branches = clause[2:]
+    else:
+        join_vars = list(dict.fromkeys(pqo.form_vars(clause[1])))
+        branches = clause[1:]
+    seed = project(rel, [v for v in join_vars if v in rel.vars])
+    rows = []
+    for branch in branches:
+        branch_rel = seed
+        for c in branch_clauses(branch):
+            branch_rel = apply_clause(store, branch_rel, c)
+        rows.extend(project(branch_rel, join_vars).rows)
+    return join(rel, Relation(tuple(join_vars), list(dict.fromkeys(rows))))
+
+
+def apply_not(store, rel: Relation, clause) -> Relation:
+    if clause[0] == "not-join":
+        join_vars, clauses = pqo.form_vars(clause[1]), clause[2:]
+    else:
+        clauses = clause[1:]
+        join_vars = [v for v in dict.fromkeys(pqo.form_vars(clauses)) if v in rel.vars]
+    seed = project(rel, join_vars)
+    for c in clauses:
+        seed = apply_clause(store, seed, c)
+    excluded = set(project(seed, join_vars).rows)
+    idx = [rel.vars.index(v) for v in join_vars]
+    return Relation(rel.vars, [row for row in rel.rows
+                               if tuple(row[i] for i in idx) not in excluded])
+
+
+def apply_predicate(rel: Relation, clause) -> Relation:
+    op, *terms = clause[0]
+    if op not in predicates or len(clause) > 1:
+        raise ValueError(f"Unsupported function expression in local query: {clause}")
+    fn = predicates[op]
+    getters = [(lambda row, i=rel.vars.index(t): row[i]) if pqo.is_var(t)
+               else (lambda row, t=t: t) for t in terms]
+    return Relation(rel.vars, [row for row in rel.rows
+                               if fn(*(get(row) for get in getters))])
+
+
+def is_ref(store, attr) -> bool:
+    a = store.attribute(attr) if isinstance(attr, str) else None
+    return a is not None and a.value_type == ":db.type/ref"
+
+
+def resolve(store, value):
+    """Entity id of an ident keyword, otherwise the value itself."""
+    if isinstance(value, str) and value.startswith(":"):
+        eid = store.entid(value)
+        if eid is not None:
+            return eid
+    return value
+
+
+def match_pattern(store, rel: Relation, pattern) -> Relation:
+    """Join the datoms matching a data pattern [e a v tx] to `rel`."""
+    terms = (list(pattern) + ["_"] * 4)[:4]
+    index = {v: i for i, v in enumerate(rel.vars)}
+    e, a, v, _ = terms
+    # attribute of each row, for resolving ident keywords in ref value position
+    if pqo.is_var(a) and a in index:
+        attr_of = lambda row: row[index[a]]  # noqa: E731
+    else:
+        attr_of = lambda row: a  # noqa: E731
+
+    def key_value(pos, value, row):
+        if pos == 0 or (pos == 2 and is_ref(store, attr_of(row))):
+            return resolve(store, value)
+        return value
+
+    consts = {}
+    for pos, term in enumerate(terms):
+        if not pqo.is_var(term) and term != "_":
+            consts[pos] = term
+    if 0 in consts:
+        consts[0] = resolve(store, consts[0])
+    if 2 in consts and not pqo.is_var(a) and is_ref(store, a):
+        consts[2] = resolve(store, consts[2])
+    bound = [(pos, index[t]) for pos, t in enumerate(terms) if pqo.is_var(t) and t in index]
+    new_vars, new_pos, same = [], [], []
+    for pos, t in enumerate(terms):
+        if pqo.is_var(t) and t not in index:
+            if t in new_vars:
+                same.append((pos, new_pos[new_vars.index(t)]))
+            else:
+                new_vars.append(t)
+                new_pos.append(pos)
+
+    # constrain the store lookup by the constants and bound values
+    bound_values = {pos: {key_value(pos, row[i], row) for row in rel.rows} for pos, i in bound}
+    attrs = [consts[1]] if 1 in consts else sorted(bound_values.get(1, [])) or [None]
+    es = {consts[0]} if 0 in consts else bound_values.get(0)
+    vs = {consts[2]} if 2 in consts else bound_values.get(2)
+    if es is not None and vs is not None and len(vs) < len(es):
+        es = None
+    elif es is not None:
+        vs = None
+    datoms = [d for attr in attrs for d in store.match(attr, es, vs)]
+    datoms = [d for d in datoms
+              if all(d[pos] == c for pos, c in consts.items())
+              and all(d[p] == d[q] for p, q in same)]
+
+    vars = rel.vars + tuple(new_vars)
+    if not bound:
+        exts = list(dict.fromkeys(tuple(d[p] for p in new_pos) for d in datoms))
+        return Relation(vars, [row + ext for row in rel.rows for ext in exts])
+    by_key = defaultdict(list)
+    for d in datoms:
+        by_key[tuple(d[pos] for pos, _ in bound)].append(tuple(d[p] for p in new_pos))
+    rows = []
+    for row in rel.rows:
+        key = tuple(key_value(pos, row[i], row) for pos, i in bound)
+        for ext in by_key.get(key, ()):
+            rows.append(row + ext)
+    return Relation(vars, list(dict.fromkeys(rows)))
+
+
+# -- find
+
+def find(store, q_dict, rel: Relation) -> List[List[Any]]:
+    elements = q_dict[":find"]
+    with_vars = q_dict.get(":with", [])
+    element_vars = [e if pqo.is_var(e) else e[1] for e in elements]
+    tuples = project(rel, list(dict.fromkeys(element_vars + with_vars))).rows
+    idx = [list(dict.fromkeys(element_vars + with_vars)).index(v) for v in element_vars]
+    tuples = [tuple(t[i] for i in idx) for t in tuples]
+    is_agg = [isinstance(e, list) and e[0] in aggregates for e in elements]
+    if any(is_agg):
+        groups = defaultdict(list)
+        for t in tuples:
+            groups[tuple(x for x, agg in zip(t, is_agg) if not agg)].append(t)
+        tuples = []
+        for key, members in groups.items():
+            keys = iter(key)
+            tuples.append(tuple(aggregates[e[0]]([m[i] for m in members]) if agg else next(keys)
+                                for i, (e, agg) in enumerate(zip(elements, is_agg))))
+    elif not with_vars:
+        tuples = list(dict.fromkeys(tuples))
+    pulls = {}
+    result = []
+    for t in tuples:
+        relation = []
+        for e, x in zip(elements, t):
+            if isinstance(e, list) and e[0] == "pull":
+                relation.append(pull(store, x, e[2], pulls))
+            elif isinstance(e, list) and e[0] not in aggregates:
+                raise ValueError(f"Unsupported :find element in local query: {e}")
+            else:
+                relation.append(x)
+        result.append(relation)
+    return result
+
+
+def pull(store, eid, pattern, entities=None) -> Dict[str, Any]:
+    """Pull `pattern` from the entity `eid`. `entities` memoizes
+    `store.entity` across the pulls of a query."""
+    if entities is None:
+        entities = {}
+    if eid not in entities:
+        entities[eid] = store.entity(eid)
+    attrs = entities[eid]
+    result = {}
+    for elem in pattern:
+        if elem == "*":
+            result[":db/id"] = eid
+            for attr, values in attrs.items():
+                if attr not in result:
+                    result[attr] = pull_values(store, attr, values, None, entities)
+            continue
+        specs = elem.items() if isinstance(elem, dict) else [(elem, None)]
+        for attr, sub in specs:
+            if isinstance(attr, list):
+                attr = attr[0]
+            if attr == ":db/id":
+                result[attr] = eid
+                continue
+            ns, _, name = attr.partition("/")
+            if name.startswith("_"):
+                referrers = store.referrers(f"{ns}/{name[1:]}", eid)
+                if referrers:
+                    result[attr] = [pull(store, r, sub or [":db/id"], entities) for r in referrers]
+            elif attr in attrs:
+                result[attr] = pull_values(store, attr, attrs[attr], sub, entities)
+    return result
+
+
+def pull_values(store, attr, values, sub, entities):
+    if is_ref(store, attr):
+        values = [pull(store, v, sub or [":db/id"], entities) for v in values]
+    a = store.attribute(attr)
+    if a is not None and a.many:
+        return values
+    return values[0]
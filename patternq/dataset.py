@@ -2,16 +2,35 @@ import copy
 from typing import List
 from typing import Literal
 
-import pandas as pd
-
 import patternq.helpers as pqh
+import patternq.lazy as pql
 import patternq.query as pqq
 
+pd = pql.lazy_import("pandas")
+
 
 VariantImpact = Literal["modifier", "low", "moderate", "high"]
 RNASeqMeasurementAttribute = Literal["fpkm", "tpm", "rpkm", "rsem-normalized-count",
                                      "kallisto-abundance", "rsem-raw-count", "rsem-scaled-estimate"]
 
+
+def relations_frame(q_dict, args, columns, db_name: str or None = None,
+                    compact: bool = False, output: str = "frame", **kwargs):
+    """Frame of the relations of a query with scalar :find variables, or
+    records or the raw result, see `pqh.output_modes`.
+
+    With `compact=True` the result is streamed (see `pqq.query_iter`, which
+    does not use the result cache) and strings are dictionary encoded as the
+    relations arrive, giving categorical enum idents and repeated IDs, Arrow
+    backed strings, and the narrowest exact numeric dtypes (see
+    `pqh.compact_frame`). This is the path that lowers peak memory, rather
+    than just the size of the frame."""
+    if not compact or output != "frame":
+        qres = pqq.query(q_dict, args=args, db_name=db_name, **kwargs)
+        return pqh.relations_output(qres, columns, output)
+    relations = pqq.query_iter(q_dict, args=args, db_name=db_name, **kwargs)
+    return pqh.compact_frame(relations, columns)
+
 samplesq = {
     ":find": [["pull", "?s", ["*",
                               {":sample/specimen": [":db/ident"]},
@@ -26,15 +45,16 @@ samplesq = {
     ":where": [["?d", ":dataset/name", "?dataset-name"],
                ["?d", ":dataset/samples", "?s"]]
 }
+samples_fields = pqh.compile_pull(samplesq)
 
 
-def samples(dataset: str, db_name: str or None = None, **kwargs):
+def samples(dataset: str, db_name: str or None = None, output: str = "frame", **kwargs):
     """Return all samples"""
-    qres = pqq.query(samplesq, args=[dataset], db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    return qres_df
+    qres = pqq.query(samplesq, args=[dataset], db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = samples_fields(qres, output=output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
 
 
 datasetsq = {
@@ -42,13 +62,13 @@ datasetsq = {
                               ":dataset/url", ":dataset/doi"]]],
     ":where": [["?d", ":dataset/name"]]
 }
+datasets_fields = pqh.compile_pull(datasetsq)
 
 
-def datasets(db_name: str or None = None, **kwargs):
+def datasets(db_name: str or None = None, output: str = "frame", **kwargs):
     """Returns all datasets contained in a database"""
-    qres = pqq.query(datasetsq, db_name=db_name, **kwargs)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
+    qres = pqq.query(datasetsq, db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = datasets_fields(qres, output=output)
     return qres_df
 
 
@@ -64,14 +84,14 @@ assay_summary_q = {
         [["?d", ":dataset/name", "?dataset-name"],
          ["?d", ":dataset/assays", "?a"]]
 }
+assay_summary_fields = pqh.compile_pull(assay_summary_q)
 
 
-def assay_summary(dataset: str, db_name: str or None = None, **kwargs):
-    qres = pqq.query(assay_summary_q, db_name=db_name, args=[dataset])
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    qres_df = pqh.expand_many_nested(qres_df, "assay-measurement-sets")
+def assay_summary(dataset: str, db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(assay_summary_q, db_name=db_name, args=[dataset], flatten_enums=True, **kwargs)
+    qres_df = assay_summary_fields(qres, output=output)
+    if output == "frame":
+        qres_df = pqh.expand_many_nested(qres_df, "assay-measurement-sets")
     return qres_df
 
 
@@ -83,13 +103,12 @@ clinical_summary_q = {
         [["?d", ":dataset/name", "?dataset-name"],
          ["?d", ":dataset/clinical-observation-sets", "?co"]]
 }
+clinical_summary_fields = pqh.compile_pull(clinical_summary_q)
 
 
-def clinical_summary(dataset: str, db_name: str or None = None, **kwargs):
-    qres = pqq.query(clinical_summary_q, db_name=db_name, args=[dataset])
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
+def clinical_summary(dataset: str, db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(clinical_summary_q, db_name=db_name, args=[dataset], flatten_enums=True, **kwargs)
+    qres_df = clinical_summary_fields(qres, output=output)
     return qres_df
 
 clinical_query = {
@@ -124,26 +143,30 @@ clinical_query = {
         ["?d", ":dataset/name", "?dataset"],
         ["?d", ":dataset/subjects", "?p"],
         ["?p", ":subject/id", "?patient-id"],
-        ["or-join", ["?ce"],
+        ["or-join", ["?ce", "?p"],
             ["?ce", ":clinical-intervention/subject", "?p"],
             ["?ce", ":clinical-observation/subject", "?p"]
         ]
     ]
 }
+clinical_fields = pqh.compile_pull(clinical_query)
 
 def clinical_events_for_patients(dataset: str, subject_ids: List[str],
-                                   db_name=str or None, **kwargs):
-    qres = pqq.query(clinical_query, db_name=db_name, args=[dataset, subject_ids])
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    return qres_df
+                                   db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query_batched(clinical_query, db_name=db_name, args=[dataset, subject_ids],
+                             batch_arg=1, flatten_enums=True, **kwargs)
+    qres_df = clinical_fields(qres, output=output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
 
 
 patient_assays_q = {
     ":find": ["?subject-id", "?sample-id", "?a-tech", "?a-name", "?ms-name"],
     ":in": ["$", "?dataset", ["?subject-id", "..."]],
     ":where": [
+        ["?d", ":dataset/name", "?dataset"],
+        ["?d", ":dataset/assays", "?a"],
         ["?p", ":subject/id", "?subject-id"],
         ["?s", ":sample/subject", "?p"],
         ["?s", ":sample/id", "?sample-id"],
@@ -158,14 +181,18 @@ patient_assays_q = {
 
 
 def patient_assays(dataset: str, patient_ids: List[str],
-                   db_name: str or None = None, **kwargs):
-    qres = pqq.query(patient_assays_q, db_name=db_name,
-                     args=[dataset, patient_ids],
-                     **kwargs
-                     )
+                   db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query_batched(patient_assays_q, db_name=db_name,
+                             args=[dataset, patient_ids],
+                             batch_arg=1,
+                             **kwargs
+                             )
     col_vars = ["subject-id", "sample-id", "assay-tech",
                 "assay-name", "measurement-set-name"]
-    return pd.DataFrame(qres["query_result"], columns=col_vars)
+    qres_df = pqh.relations_output(qres, col_vars, output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
 
 
 subjects_q = {
@@ -188,19 +215,26 @@ subjects_q = {
         ["?d", ":dataset/subjects", "?s"]
     ]
 }
+subjects_fields = pqh.compile_pull(subjects_q)
 
 
-def subjects(dataset: str, db_name: str or None = None, **kwargs):
-    qres = pqq.query(subjects_q, args=[dataset],
-                     db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    if "subject-race" in qres_df.columns:
+def subjects_frame(qres, output: str = "frame"):
+    """Frame of a `subjects_q` result, a row per subject and race."""
+    qres_df = subjects_fields(qres, output=output)
+    if output == "frame" and "subject-race" in qres_df.columns:
         qres_df = qres_df.explode(column="subject-race")
     return qres_df
 
 
+def subjects(dataset: str, db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(subjects_q, args=[dataset],
+                     db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = subjects_frame(qres, output=output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
+
+
 measurements_q = {
     ":find": [["pull", "?m",
                ["*",
@@ -221,15 +255,17 @@ measurements_q = {
          ["?ms", ":measurement-set/name", "?ms-name"],
          ["?ms", ":measurement-set/measurements", "?m"]]
 }
+measurements_fields = pqh.compile_pull(measurements_q)
 
 
 def measurements(dataset: str, measurement_set: str,
-                 db_name: str or None = None, **kwargs):
+                 db_name: str or None = None, compact: bool = False, output: str = "frame", **kwargs):
+    """With `compact=True`, columns get compact dtypes (see `pqh.compact_column`),
+    making the frame smaller, though the full result is still decoded first."""
     qres = pqq.query(measurements_q,
                      args=[dataset, measurement_set],
-                     db_name=db_name, **kwargs)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
+                     db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = measurements_fields(qres, compact=compact, output=output)
     return qres_df
 
 
@@ -244,12 +280,13 @@ sample_measurements_q = sample_q
 
 
 def sample_measurements(dataset: str, measurement_set: str, sample_ids: List[str],
-                        db_name: str or None = None, **kwargs):
-    qres = pqq.query(sample_measurements_q, args=[dataset, measurement_set, sample_ids],
-                     db_name=db_name, **kwargs)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    return qres_df
+                        db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query_batched(sample_measurements_q, args=[dataset, measurement_set, sample_ids],
+                             batch_arg=2, db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = measurements_fields(qres, output=output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
 
 
 gx_by_attr_q = {
@@ -257,6 +294,7 @@ gx_by_attr_q = {
     ":in": ["$", "?meas-set", "?meas-attr"],
     ":where": [
         ["?ms", ":measurement-set/name", "?meas-set"],
+        ["?ms", ":measurement-set/measurements", "?m"],
         ["?m", "?meas-attr", "?value"],
         ["?m", ":measurement/gene-product", "?gp"],
         ["?gp", ":gene-product/gene", "?g"],
@@ -267,10 +305,38 @@ gx_by_attr_q = {
 }
 
 def gene_expression_measurements(measurement_set: str, measurement_attr: RNASeqMeasurementAttribute,
-                                 db_name: str or None = None, **kwargs):
+                                 db_name: str or None = None, compact: bool = False,
+                                 output: str = "frame", wide: bool = False, sparse: bool = False,
+                                 **kwargs):
+    """With `compact=True`, see `relations_frame`. With `wide=True`, returns
+    a samples x genes frame (with sparse columns if `sparse`) instead of
+    the long frame, see `gene_expression_matrix`."""
+    if wide:
+        X, sample_ids, genes = gene_expression_matrix(measurement_set, measurement_attr,
+                                                      db_name=db_name, sparse=sparse, **kwargs)
+        if sparse:
+            return pd.DataFrame.sparse.from_spmatrix(X, index=pd.Index(sample_ids, name="sample-id"),
+                                                     columns=pd.Index(genes, name="hgnc-symbol"))
+        return pd.DataFrame(X, index=pd.Index(sample_ids, name="sample-id"),
+                            columns=pd.Index(genes, name="hgnc-symbol"), copy=False)
     meas_attr_ident = f":measurement/{measurement_attr}"
-    qres = pqq.query(gx_by_attr_q, args=[measurement_set, meas_attr_ident], db_name=db_name, **kwargs)
-    return pd.DataFrame(qres["query_result"], columns=["sample-id", "hgnc-symbol", measurement_attr])
+    return relations_frame(gx_by_attr_q, [measurement_set, meas_attr_ident],
+                           ["sample-id", "hgnc-symbol", measurement_attr],
+                           db_name=db_name, compact=compact, output=output, **kwargs)
+
+
+def gene_expression_matrix(measurement_set: str, measurement_attr: RNASeqMeasurementAttribute,
+                           db_name: str or None = None, sparse: bool = False, shape=None,
+                           dtype="float64", **kwargs):
+    """Returns (X, sample_ids, hgnc_symbols) for a measurement set, X being a
+    samples x genes matrix of `measurement_attr` values, dense with NaN for
+    missing values, or CSR if `sparse`. The result is streamed (see
+    `pqq.query_iter`) straight into the matrix by `pqh.triples_matrix`,
+    preallocated with `shape` (samples, genes) if given."""
+    meas_attr_ident = f":measurement/{measurement_attr}"
+    triples = pqq.query_iter(gx_by_attr_q, args=[measurement_set, meas_attr_ident],
+                             db_name=db_name, **kwargs)
+    return pqh.triples_matrix(triples, sparse=sparse, shape=shape, dtype=dtype)
 
 
 measurement_matrices_q = {
@@ -291,12 +357,11 @@ measurement_matrices_q = {
 }
 
 
-def measurement_matrices(dataset: str, db_name: str or None = None, **kwargs):
-    qres = pqq.query(measurement_matrices_q, args=[dataset], db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
+def measurement_matrices(dataset: str, db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(measurement_matrices_q, args=[dataset], db_name=db_name, flatten_enums=True, **kwargs)
     columns = ["assay-name", "measurement-set-name", "measurement-matrix-name",
                "measurement-matrix-measurement-type", "measurement-matrix-key"]
-    return pd.DataFrame(qres["query_result"], columns=columns)
+    return pqh.relations_output(qres, columns, output)
 
 variant_measurements_q = {
     ":find": [
@@ -314,12 +379,11 @@ variant_measurements_q = {
         ["?v", ":variant/id", "?var-id"]
     ]
 }
+variant_measurements_fields = pqh.compile_pull(variant_measurements_q)
 
-def variant_measurements(measurement_set: str, db_name: str or None = None, **kwargs):
-    qres = pqq.query(variant_measurements_q, args=[measurement_set], db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
+def variant_measurements(measurement_set: str, db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(variant_measurements_q, args=[measurement_set], db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = variant_measurements_fields(qres, output=output)
     return qres_df
 
 
@@ -335,70 +399,80 @@ var2measq = {
         ["?m", ":measurement/variant", "?v"]
     ]
 }
+var2meas_fields = pqh.compile_pull(var2measq, clean=False)
 
-def measurements_of_variants(variant_ids: List[str], db_name: str or None = None, **kwargs):
-    qres = pqq.query(var2measq, args=[variant_ids], db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    return qres_df
+def measurements_of_variants(variant_ids: List[str], db_name: str or None = None,
+                             output: str = "frame", **kwargs):
+    qres = pqq.query_batched(var2measq, args=[variant_ids], batch_arg=0,
+                             db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = var2meas_fields(qres, output=output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
 
 
 variants_by_impact_query = {
     ":find": ["?sample-id", "?ms-name", "?var-id", "?hgnc", "?consequence", "?impact", "?vaf"],
     ":in": ["$", "?sample-id", "?ms-name", "?impact"],
     ":where": [
+        ["?s", ":sample/id", "?sample-id"],
+        ["?m", ":measurement/sample", "?s"],
+        ["?ms", ":measurement-set/name", "?ms-name"],
+        ["?ms", ":measurement-set/measurements", "?m"],
+        ["?m", ":measurement/variant", "?var"],
         ["?var", ":variant/impact", "?impact"],
+        ["?m", ":measurement/vaf", "?vaf"],
         ["?var", ":variant/id", "?var-id"],
-        ["?var", ":variant/so-consequences", "?soc"],
-        ["?soc", ":so-sequence-feature/name", "?consequence"],
         ["?var", ":variant/gene", "?g"],
         ["?g", ":gene/hgnc-symbol", "?hgnc"],
-        ["?m", ":measurement/variant", "?var"],
-        ["?m", ":measurement/vaf", "?vaf"],
-        ["?ms", ":measurement-set/measurements", "?m"],
-        ["?ms", ":measurement-set/name", "?ms-name"],
-        ["?m", ":measurement/sample", "?s"],
-        ["?s", ":sample/id", "?sample-id"]
+        ["?var", ":variant/so-consequences", "?soc"],
+        ["?soc", ":so-sequence-feature/name", "?consequence"]
     ]
 }
 
-def variants_by_impact(sample_id: str, measurement_set: str, impact: VariantImpact, db_name: str or None = None, **kwargs):
+def variants_by_impact(sample_id: str, measurement_set: str, impact: VariantImpact, db_name: str or None = None,
+                       compact: bool = False, output: str = "frame", **kwargs):
+    """With `compact=True`, see `relations_frame`."""
     impact_ident = f":variant.impact/{impact}"
-    qres = pqq.query(variants_by_impact_query, args=[sample_id, measurement_set, impact_ident], db_name=db_name, **kwargs)
     col_names = ["sample-id", "measurement-set-name", "variant-id", "hgnc-symbol", "so-consequence", "impact", "vaf"]
-    return pd.DataFrame(qres["query_result"], columns=col_names)
+    return relations_frame(variants_by_impact_query, [sample_id, measurement_set, impact_ident],
+                           col_names, db_name=db_name, compact=compact, output=output, **kwargs)
 
 
 simple_gx_query = {
     ":find": ["?hgnc-symbol", "?value"],
     ":in": ["$", "?sample-id", "?ms-name", "?meas-attr", ["?hgnc-symbol", "..."]],
     ":where": [
-        ["?g," ":gene/hgnc-symbol", "?hgnc"],
-        ["?gp", ":gene-product/gene", "?g"],
-        ["?m", ":measurement/gene", "?g"],
-        ["?m", "?meas-attr", "?value"],
-        ["?m", "?measurement/sample", "?s"],
         ["?s", ":sample/id", "?sample-id"],
         ["?ms", ":measurement-set/name", "?ms-name"],
-        ["?ms", ":measurement-set/measurements", "?m"]
+        ["?g", ":gene/hgnc-symbol", "?hgnc-symbol"],
+        ["?gp", ":gene-product/gene", "?g"],
+        ["?m", ":measurement/gene-product", "?gp"],
+        ["?m", ":measurement/sample", "?s"],
+        ["?ms", ":measurement-set/measurements", "?m"],
+        ["?m", "?meas-attr", "?value"]
     ]
 }
 
 def gene_expression_for_genes(sample_id: str, measurement_set: str, measurement_attr: RNASeqMeasurementAttribute,
-                             genes: List[str], db_name: str or None = None, **kwargs):
+                             genes: List[str], db_name: str or None = None, output: str = "frame", **kwargs):
     measurement_attr_ident = f":measurement/{measurement_attr}"
-    qres = pqq.query(simple_gx_query, args=[sample_id, measurement_set, measurement_attr_ident, genes],
-                     db_name=db_name, **kwargs)
-    return pd.DataFrame(qres["query_result"], columns=["hgnc-symbol", measurement_attr])
+    qres = pqq.query_batched(simple_gx_query, args=[sample_id, measurement_set, measurement_attr_ident, genes],
+                             batch_arg=3, db_name=db_name, **kwargs)
+    qres_df = pqh.relations_output(qres, ["hgnc-symbol", measurement_attr], output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
 
 cnv_query = {
     ":find": ["?hgnc", "?lrr", "?cn"],
     ":in": ["$", "?sample-id", "?ms-name"],
     ":where": [
+        ["?s", ":sample/id", "?sample-id"],
+        ["?m", ":measurement/sample", "?s"],
         ["?ms", ":measurement-set/name", "?ms-name"],
+        ["?ms", ":measurement-set/measurements", "?m"],
         ["?m", ":measurement/cnv", "?cnv"],
-        ["?m", ":measurement/sample", "?s"],
-        ["?s", ":sample/id", "?sample-id"],
         ["?m", ":measurement/a-allele-cn", "?cn"],
         ["?m", ":measurement/segment-mean-lrr", "?lrr"],
         ["?cnv", ":cnv/genes", "?g"],
@@ -406,14 +480,18 @@ cnv_query = {
     ]
 }
 
-def cnv_by_gene_measurements(sample_id: str, measurement_set: str, db_name: str or None = None, **kwargs):
-    qres = pqq.query(cnv_query, args=[sample_id, measurement_set], db_name=db_name, **kwargs)
-    return pd.DataFrame(qres["query_result"], columns=["hgnc-symbol", "log2-r-ratio", "copy-number"])
+def cnv_by_gene_measurements(sample_id: str, measurement_set: str, db_name: str or None = None,
+                             compact: bool = False, output: str = "frame", **kwargs):
+    """With `compact=True`, see `relations_frame`."""
+    return relations_frame(cnv_query, [sample_id, measurement_set],
+                           ["hgnc-symbol", "log2-r-ratio", "copy-number"],
+                           db_name=db_name, compact=compact, output=output, **kwargs)
 
 
-cohort_expression_q = {
-    ":find": ["?value"],
-    ":in": ["$", "?meas-attr", "?hgnc"],
+cohort_expression_for_genes_q = {
+    ":find": ["?hgnc", "?value"],
+    ":with": ["?m"],
+    ":in": ["$", "?meas-attr", ["?hgnc", "..."]],
     ":where": [
         ["?g", ":gene/hgnc-symbol", "?hgnc"],
         ["?gp", ":gene-product/gene", "?g"],
@@ -422,17 +500,64 @@ cohort_expression_q = {
     ]
 }
 
+# result rows per gene assumed when sizing cohort expression queries, until
+# some have been observed for the measurement attribute and database.
+cohort_rows_per_gene = 10000
+# result rows beyond which a cohort expression query is split into
+# concurrent queries over fewer genes.
+cohort_max_rows = 1000000
+_cohort_rows_observed = {}
+
+
+def cohort_expression_for_genes(measurement_attr: RNASeqMeasurementAttribute, genes: List[str],
+                                db_name: str or None = None, output: str = "frame",
+                                max_rows: int or None = None, **kwargs):
+    """Retrieve all gene expression values of a certain measurement attribute
+    for each of the HGNC symbols in `genes`, with the hgnc-symbol of each
+    value, one row per measurement (values are not deduplicated as in
+    `cohort_gene_expression`). Like `cohort_gene_expression`, this does not
+    filter by assay, measurement set or samples.
+
+    All genes are queried in one round trip unless the expected result
+    (from the rows per gene seen in earlier calls, or `cohort_rows_per_gene`)
+    exceeds `max_rows` (default `cohort_max_rows`), in which case the genes
+    are split over concurrent queries. A query that times out is split in
+    half and retried. Other kwargs are passed to `pqq.query_batched`."""
+    genes = list(dict.fromkeys(genes))
+    if max_rows is None:
+        max_rows = cohort_max_rows
+    meas_attr_ident = f":measurement/{measurement_attr}"
+    key = (db_name or pqq.db, measurement_attr)
+    rows_per_gene = _cohort_rows_observed.get(key, cohort_rows_per_gene)
+    batch_size = max(1, int(max_rows // max(rows_per_gene, 1)))
+    qres = pqq.query_batched(cohort_expression_for_genes_q, args=[meas_attr_ident, genes], batch_arg=1,
+                             batch_size=batch_size, split_on_timeout=True,
+                             db_name=db_name, **kwargs)
+    if genes and qres["query_result"]:
+        _cohort_rows_observed[key] = len(qres["query_result"]) / len(genes)
+    result = pqh.relations_output(qres, ["hgnc-symbol", measurement_attr], output)
+    if output == "frame":
+        result = pqh.add_provenance(result, qres)
+    return result
+
+
 def cohort_gene_expression(measurement_attr: RNASeqMeasurementAttribute, gene: str,
-                           db_name: str or None = None, **kwargs):
+                           db_name: str or None = None, output: str = "frame", **kwargs):
     """This query will retrieve all gene expression values of a certain measurement
     attribute, for the provided `gene` parameter. This is a simplified query,
     intended to be performant in large cohort datasets, and does not filter based on,
-    assay measurement set, or samples, etc."""
-    meas_attr_ident = f":measurement/{measurement_attr}"
-    qres = pqq.query(cohort_expression_q, args=[meas_attr_ident, gene], db_name=db_name, **kwargs)
-    result = pd.DataFrame(qres["query_result"], columns=[measurement_attr])
-    result["hgnc-symbol"] = gene
-    return result
+    assay measurement set, or samples, etc. See `cohort_expression_for_genes`
+    to retrieve several genes at once; with `output="raw"` this returns its
+    raw result, one relation per measurement."""
+    result = cohort_expression_for_genes(measurement_attr, [gene], db_name=db_name,
+                                         output=output, **kwargs)
+    if output == "raw":
+        return result
+    if output == "records":
+        values = dict.fromkeys(record[measurement_attr] for record in result)
+        return [{measurement_attr: value, "hgnc-symbol": gene} for value in values]
+    result = result.drop_duplicates(measurement_attr, ignore_index=True)
+    return result[[measurement_attr, "hgnc-symbol"]]
 
 
 single_cell_popq = {
@@ -445,6 +570,6 @@ single_cell_popq = {
     ]
 }
 
-def single_cell_populations(db_name: str or None = None, **kwargs):
+def single_cell_populations(db_name: str or None = None, output: str = "frame", **kwargs):
     qres = pqq.query(single_cell_popq, db_name=db_name, **kwargs)
-    return pd.DataFrame(qres["query_result"], columns=["single-cell-id", "cell-population-name"])
+    return pqh.relations_output(qres, ["single-cell-id", "cell-population-name"], output)
@@ -0,0 +1,162 @@
+"""Formats query results are downloaded in. Queries ask the service for
+`accepted()` formats, most preferred first, in the `format_header` request
+header:
+
+    arrow-zstd   an Arrow IPC stream with zstd compressed buffers
+    arrow        an Arrow IPC stream
+    json-gzip    gzip'd JSON, which every service returns
+
+Downloads are recognized by their leading bytes (see `is_arrow`), so a
+service that ignores the header and returns gzip'd JSON is read as before.
+
+An Arrow result holds the relations of a query with scalar :find elements
+as one column per element, and the result's other top level entries
+(basis_t) as JSON in the schema metadata under `metadata_key`. Its
+relations are read as an `ArrowRelations` sequence, which `frame` converts
+to a DataFrame column by column rather than relation by relation.
+
+Arrow formats are opt-in, as raw results (and those of `pqq.query`) then
+hold an `ArrowRelations` sequence rather than a list, and reading them
+imports pyarrow (and numpy). Ask for them for the session with `enable()`."""
+import importlib.util
+import io
+import json
+from collections.abc import Sequence
+from typing import Any, Dict, Iterable, Iterator, List
+
+import patternq.lazy as pql
+
+# whether Arrow formats are asked for, see `enable`
+enabled = False
+# formats asked for once enabled, most preferred first
+result_formats = ["arrow-zstd", "arrow", "json-gzip"]
+format_header = "X-Result-Formats"
+metadata_key = b"patternq"
+# leading bytes of an Arrow IPC stream (the first message's continuation marker)
+arrow_magic = b"\xff\xff\xff\xff"
+arrow_formats = ("arrow-zstd", "arrow")
+
+
+def arrow_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def pyarrow(purpose: str = "Arrow results"):
+    """pyarrow, or an ImportError saying `purpose` requires it (and how to
+    install it) if it isn't installed."""
+    return pql.require("pyarrow", purpose, extra="pyarrow")
+
+
+def enable():
+    """Ask for query results in Arrow formats for the duration of the
+    session. Requires pyarrow."""
+    global enabled
+    pyarrow()
+    enabled = True
+    return True
+
+
+def disable():
+    global enabled
+    enabled = False
+    return True
+
+
+def accepted() -> List[str]:
+    """Formats to ask for: `result_formats` when enabled and pyarrow is
+    installed, ending with json-gzip, otherwise json-gzip only."""
+    arrow = enabled and arrow_available()
+    formats = [f for f in result_formats
+               if f != "json-gzip" and (arrow or f not in arrow_formats)]
+    return formats + ["json-gzip"]
+
+
+def is_arrow(head: bytes) -> bool:
+    """Whether a download starting with `head` is an Arrow IPC stream."""
+    return head[:4] == arrow_magic
+
+
+class ArrowRelations(Sequence):
+    """The relations of an Arrow result, as a read only sequence of lists
+    (converted from the table's columns when first read as relations)."""
+
+    def __init__(self, table):
+        self.table = table
+        self._rows = None
+
+    def rows(self) -> List[List[Any]]:
+        if self._rows is None:
+            columns = [c.to_pylist() for c in self.table.columns]
+            self._rows = [list(r) for r in zip(*columns)]
+        return self._rows
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __getitem__(self, i):
+        return self.rows()[i]
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __reduce__(self):
+        return ArrowRelations, (self.table,)
+
+    def frame(self, columns: List[str]):
+        """The relations as a DataFrame with `columns`, numeric columns
+        without nulls sharing the Arrow buffers."""
+        return self.table.rename_columns(columns).to_pandas(split_blocks=True)
+
+
+def concat(relations: List[ArrowRelations]) -> ArrowRelations:
+    pa = pyarrow()
+    return ArrowRelations(pa.concat_tables([r.table for r in relations]))
+
+
+def result_meta(schema) -> Dict[str, Any]:
+    return json.loads((schema.metadata or {}).get(metadata_key, b"{}"))
+
+
+def read_result(body: bytes) -> Dict[str, Any]:
+    """The result in an Arrow IPC stream, with `ArrowRelations`."""
+    pa = pyarrow()
+    table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+    qres = result_meta(table.schema)
+    qres["query_result"] = ArrowRelations(table.replace_schema_metadata())
+    return qres
+
+
+class ChunksReader(io.RawIOBase):
+    """A file reading an iterable of byte chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b""
+                return 0
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def iter_relations(chunks: Iterable[bytes], meta: Dict[str, Any] or None = None) -> Iterator[List[Any]]:
+    """Relations of an Arrow IPC stream read from byte chunks, one record
+    batch at a time. `meta` is populated with the result's top level
+    entries once the schema is read."""
+    pa = pyarrow()
+    reader = pa.ipc.open_stream(io.BufferedReader(ChunksReader(chunks)))
+    if meta is not None:
+        meta.update(result_meta(reader.schema))
+    for batch in reader:
+        columns = [c.to_pylist() for c in batch.columns]
+        for relation in zip(*columns):
+            yield list(relation)
@@ -1,8 +1,16 @@
+from array import array
 from functools import partial
+from itertools import islice
 from datetime import datetime
-import pandas as pd
 from collections import namedtuple
 
+import patternq.formats as pqf
+import patternq.instrument as pqi
+import patternq.lazy as pql
+
+np = pql.lazy_import("numpy")
+pd = pql.lazy_import("pandas")
+
 clean_names_dict = {
     ":": "",
     "?": "",
@@ -19,7 +27,6 @@ PatternQProvenance = namedtuple(
     ]
 )
 
-
 # as in clojure walk/postwalk.
 def walk(inner, outer, coll):
     if isinstance(coll, list) or isinstance(coll, tuple):
@@ -35,47 +42,149 @@ def postwalk(fn, coll):
 
 
 def maybe_flatten_enum(elem):
+    """Returns the ident of an enum map, {:db/ident :some/ident}, otherwise
+    elem. Also serves as a json `object_hook` to flatten enums while decoding."""
     if isinstance(elem, dict):
         if ":db/ident" in elem:
             return elem[":db/ident"]
     return elem
 
+
+# set on query results whose enums have already been flattened, e.g. at
+# decode time by `patternq.query.query(..., flatten_enums=True)`.
+enums_flattened_key = "enums_flattened"
+
+
+def _flatten_ident(elem):
+    while isinstance(elem, dict) and ":db/ident" in elem:
+        elem = elem[":db/ident"]
+    return elem
+
+
+def _items(coll):
+    return enumerate(coll) if isinstance(coll, list) else coll.items()
+
+
+def _flatten(root):
+    """`root` with its enum maps flattened, copying only the containers
+    that hold one (directly or nested), and sharing the rest. Walks an
+    explicit stack of [original, container, items, copy, key in parent]
+    frames, so deeply nested results don't hit the recursion limit."""
+    container = _flatten_ident(root)
+    if not isinstance(container, (list, dict)):
+        return container
+    stack = [[root, container, iter(_items(container)), None, None]]
+    while True:
+        frame = stack[-1]
+        for k, v in frame[2]:
+            if not isinstance(v, (list, dict)):
+                continue
+            flat = _flatten_ident(v)
+            if isinstance(flat, (list, dict)):
+                stack.append([v, flat, iter(_items(flat)), None, k])
+                break
+            if frame[3] is None:
+                frame[3] = frame[1].copy()
+            frame[3][k] = flat
+        else:
+            original, container, _, copied, key = stack.pop()
+            result = container if copied is None else copied
+            if not stack:
+                return result
+            if result is not original:
+                parent = stack[-1]
+                if parent[3] is None:
+                    parent[3] = parent[1].copy()
+                parent[3][key] = result
+
+
 def flatten_enum_idents(qres):
     """Given query results as parsed by json, flattens all enums to contain
     only the ident value, i.e. :some/ident rather than a dictionary of
-    {:db/ident :some/ident}"""
-    return postwalk(maybe_flatten_enum, qres)
+    {:db/ident :some/ident}
+
+    Returns a new structure, leaving qres as it was. Containers without
+    enums are shared with qres rather than copied."""
+    if isinstance(qres, dict) and qres.get(enums_flattened_key):
+        return qres
+    with pqi.phase("flatten_enum_idents"):
+        flat = _flatten(qres)
+        if isinstance(flat, dict) and "query_result" in flat:
+            flat = dict(flat, **{enums_flattened_key: True})
+        return flat
+
 
 def expand_many_nested(qres_df, attribute):
     """Given query results as previously JSON normalized in a data frame, we extract
-    the nested entities, normalize them separately, then join them back in appropriately."""
-    qres_df = qres_df.explode(column=attribute)
-    qres_df["nested-db-id###"] = qres_df[attribute].apply(lambda l: l[":db/id"])
-    nested_entities = pd.json_normalize(qres_df[attribute].tolist())
-    nested_entities = clean_column_names(nested_entities)
-    result = qres_df.merge(
-        nested_entities,
-        left_on="nested-db-id###",
-        right_on="db-id",
-        how="left"
-    )
-    result = result.drop(columns=['db-id_x', 'db-id_y', 'db-id', 'nested-db-id###'], errors='ignore')
-    return result
+    the nested entities, normalize them separately, then join them back in appropriately.
+
+    Each parent row is repeated once per entity in its `attribute` list (once,
+    with missing nested fields, when the list is empty or the attribute is
+    missing). Nested entities shared by several parents are normalized once,
+    deduplicated by :db/id."""
+    with pqi.phase("expand_many_nested", attribute=attribute) as attrs:
+        n = len(qres_df)
+        if attribute in qres_df.columns:
+            values = qres_df[attribute].tolist()
+        else:
+            values = [np.nan] * n
+        lengths = np.ones(n, dtype=np.intp)
+        items = []
+        for i, value in enumerate(values):
+            if isinstance(value, dict):
+                value = [value]
+            if isinstance(value, list) and value:
+                lengths[i] = len(value)
+                items.extend(value)
+            else:
+                items.append(np.nan)
+        parent_idx = np.repeat(np.arange(n), lengths)
+        # one row per distinct nested entity, items point at theirs or -1.
+        positions = {}
+        entities = []
+        codes = np.full(len(items), -1, dtype=np.intp)
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            key = item.get(":db/id", ("item", i))
+            code = positions.get(key)
+            if code is None:
+                code = positions[key] = len(entities)
+                entities.append(item)
+            codes[i] = code
+        nested_entities = clean_column_names(pd.json_normalize(entities))
+        nested_entities = nested_entities.drop(columns=["db-id"], errors="ignore")
+        nested_entities = nested_entities.reindex(codes).reset_index(drop=True)
+        result = qres_df.iloc[parent_idx].reset_index(drop=True)
+        result[attribute] = pd.Series(items, dtype=object)
+        result = result.drop(columns=["db-id"], errors="ignore")
+        # same suffixes as a merge would give overlapping columns
+        overlap = result.columns.intersection(nested_entities.columns)
+        if len(overlap):
+            result = result.rename(columns={col: f"{col}_x" for col in overlap})
+            nested_entities = nested_entities.rename(columns={col: f"{col}_y" for col in overlap})
+        attrs["rows"] = len(result)
+        return pd.concat([result, nested_entities], axis=1)
+
+
+def clean_name(name):
+    """Clean a single column name, see `clean_column_names`."""
+    for orig, new in clean_names_dict.items():
+        name = name.replace(orig, new)
+    return name
+
 
 def clean_column_names(df):
     """Clean the column names as returned by common patternq queries, with or
     without json normalize processing from pandas"""
-    new_col_names = {}
-    for col in df.columns:
-        for orig, new in clean_names_dict.items():
-            sofar = new_col_names.get(col, col)
-            new_col_names[col] = sofar.replace(orig, new)
-    # A little clunky, but we do an inplace rename and return to
-    # keep the appearance of a functional style while avoiding
-    # memcopy. Not an issue for how patternq uses this lib, but
-    # external users should be mindful when applying to their
-    # own data.
-    df.rename(columns=new_col_names, inplace=True)
+    with pqi.phase("clean_column_names"):
+        new_col_names = {col: clean_name(col) for col in df.columns}
+        # A little clunky, but we do an inplace rename and return to
+        # keep the appearance of a functional style while avoiding
+        # memcopy. Not an issue for how patternq uses this lib, but
+        # external users should be mindful when applying to their
+        # own data.
+        df.rename(columns=new_col_names, inplace=True)
     return df
 
 
@@ -84,24 +193,398 @@ def pull2fields(qres):
     where the values are the results of a pull expression, flatten the
     pull expression into fields using common assumptions.
     """
-    query_result = qres["query_result"]
-    query_result = flatten_enum_idents(query_result)
-    flat_df = pd.DataFrame(query_result, columns=["pull"])
-    return pd.json_normalize(flat_df['pull'])
+    query_result = flatten_enum_idents(qres)["query_result"]
+    with pqi.phase("pull2fields", rows=len(query_result)):
+        flat_df = pd.DataFrame(query_result, columns=["pull"])
+        return pd.json_normalize(flat_df['pull'])
 
 
-def add_provenance(df, qres):
-    """Adds provenance ysing pandas documented _metadata field support,
-    ref: https://pandas.pydata.org/pandas-docs/stable/development/extending.html#define-original-properties
+def pull_pattern(q_dict):
+    """Returns the pull pattern of a query whose :find is a single pull
+    expression, e.g. [["pull", "?s", pattern]]."""
+    find = q_dict[":find"]
+    if len(find) == 1 and isinstance(find[0], list) and find[0][0] == "pull":
+        return find[0][2]
+    raise ValueError("Query :find is not a single pull expression.")
+
+
+def compile_pull(pattern, clean=True):
+    """Compile a pull pattern (or a query with a single pull expression in
+    :find) into a function of a query result, returning the same frame as
+    `pull2fields` followed by `clean_column_names` (or just `pull2fields`,
+    if not clean).
+
+    The extractor fills one pre-sized list per output column in a single
+    pass over the entities, looking attributes up in a tree of the pattern's
+    attributes with their joined and cleaned column names computed up front.
+    Attributes not named by the pattern (e.g. from "*") are added to the
+    tree on first sight. Columns appear in the order json_normalize gives
+    them: per entity, top level values before flattened nested maps, in
+    order of first appearance.
+
+    `extract(qres, compact=True)` builds the frame with compact dtypes, see
+    `compact_column`. With `output="records"` the extractor returns a list
+    of dicts keyed by the same column names instead (None for missing
+    fields), without using pandas, and with `output="raw"` the query result
+    itself."""
+    if isinstance(pattern, dict):
+        pattern = pull_pattern(pattern)
+    # attribute -> (column name, tree of nested attributes)
+    tree = {}
+
+    def node(parent, prefix, key):
+        entry = parent.get(key)
+        if entry is None:
+            entry = (f"{prefix}.{key}" if prefix else key, {})
+            parent[key] = entry
+        return entry
+
+    def seed(pat, parent, prefix):
+        for elem in pat:
+            if isinstance(elem, str) and elem != "*":
+                node(parent, prefix, elem)
+            elif isinstance(elem, dict):
+                for attr, sub_pat in elem.items():
+                    if isinstance(attr, str):
+                        name, children = node(parent, prefix, attr)
+                        seed(sub_pat if isinstance(sub_pat, list) else [], children, name)
+
+    seed(pattern, tree, "")
+    cleaned = {}
+
+    def extract(qres, compact=False, output="frame"):
+        check_output(output)
+        if output == "raw":
+            return qres
+        query_result = flatten_enum_idents(qres)["query_result"]
+        with pqi.phase("extract", rows=len(query_result), compact=compact, output=output):
+            if output == "records":
+                return build_records(query_result)
+            return build(query_result, compact)
+
+    def build_records(query_result):
+        records = []
+        names = {}
+
+        def flatten_nested(parent, prefix, entity, record):
+            for key, value in entity.items():
+                name, children = parent.get(key) or node(parent, prefix, key)
+                if isinstance(value, dict):
+                    flatten_nested(children, name, value, record)
+                else:
+                    record[name] = value
+
+        for relation in query_result:
+            entity = relation[0]
+            record = {}
+            if isinstance(entity, dict):
+                nested = [(key, value) for key, value in entity.items() if isinstance(value, dict)]
+                for key, value in entity.items():
+                    if not isinstance(value, dict):
+                        record[key] = value
+                for key, value in nested:
+                    name, children = node(tree, "", key)
+                    flatten_nested(children, name, value, record)
+            names.update(dict.fromkeys(record))
+            records.append(record)
+        if clean:
+            for name in names:
+                if name not in cleaned:
+                    cleaned[name] = clean_name(name)
+            names = {name: cleaned[name] for name in names}
+        else:
+            names = {name: name for name in names}
+        return [{col: record.get(name) for name, col in names.items()} for record in records]
+
+    def build(query_result, compact):
+        n = len(query_result)
+        nan = float("nan")
+        columns = {}
+
+        def flatten_nested(i, parent, prefix, entity):
+            for key, value in entity.items():
+                entry = parent.get(key)
+                if entry is None:
+                    entry = node(parent, prefix, key)
+                name, children = entry
+                if isinstance(value, dict):
+                    flatten_nested(i, children, name, value)
+                    continue
+                col = columns.get(name)
+                if col is None:
+                    col = columns[name] = [nan] * n
+                col[i] = value
+
+        for i, relation in enumerate(query_result):
+            entity = relation[0]
+            if not isinstance(entity, dict):
+                continue
+            nested = None
+            for key, value in entity.items():
+                if isinstance(value, dict):
+                    if nested is None:
+                        nested = []
+                    nested.append((key, value))
+                    continue
+                col = columns.get(key)
+                if col is None:
+                    col = columns[key] = [nan] * n
+                col[i] = value
+            if nested:
+                for key, value in nested:
+                    name, children = node(tree, "", key)
+                    flatten_nested(i, children, name, value)
+        if not columns:
+            # no fields at all, built as json_normalize would for the
+            # matching column index.
+            df = pd.DataFrame([{}] * n)
+            return clean_column_names(df) if clean else df
+        if compact:
+            columns = {name: compact_column(col) for name, col in columns.items()}
+        df = pd.DataFrame(columns, index=pd.RangeIndex(n))
+        if clean:
+            for name in columns:
+                if name not in cleaned:
+                    cleaned[name] = clean_name(name)
+            df.columns = [cleaned[name] for name in columns]
+        return df
+
+    return extract
+
+
+# ways wrappers can return results: a DataFrame, a list of dicts keyed by
+# column name (built without pandas), or the query result as returned by
+# `pqq.query`.
+output_modes = ("frame", "records", "raw")
 
-    _Note_: _metadata will propagate, and despite 'protected member' name
-    convention, this is how pandas documents adding metadata that will
-    propagate through dataframe transformations."""
+
+def check_output(output):
+    if output not in output_modes:
+        raise ValueError(f"output must be one of {output_modes}, not {output!r}")
+
+
+def relations_output(qres, columns, output="frame"):
+    """The relations of a query with scalar :find variables as a frame with
+    `columns`, as records, or raw, see `output_modes`."""
+    check_output(output)
+    if output == "raw":
+        return qres
+    if output == "records":
+        return [dict(zip(columns, relation)) for relation in qres["query_result"]]
+    if isinstance(qres["query_result"], pqf.ArrowRelations):
+        return qres["query_result"].frame(columns)
+    return pd.DataFrame(qres["query_result"], columns=columns)
+
+
+# string columns with at most this ratio of distinct values to rows are made
+# categorical in compact frames, other string columns are Arrow backed.
+categorical_ratio = 0.5
+
+
+def string_dtype():
+    """string[pyarrow] when pyarrow is installed, else pandas' python backed
+    string dtype."""
+    try:
+        import pyarrow  # noqa: F401
+        return pd.StringDtype("pyarrow")
+    except ImportError:
+        return pd.StringDtype("python")
+
+
+def coded_column(codes, uniques):
+    """Given dictionary codes (-1 for missing) into a list of unique values,
+    returns the column as a categorical when its values are enum idents or
+    repeat often (see `categorical_ratio`), Arrow backed strings for other
+    string values, and an object array otherwise."""
+    codes = np.asarray(codes, dtype=np.intp)
+    n = len(codes)
+    if uniques and all(isinstance(u, str) for u in uniques):
+        if all(u.startswith(":") for u in uniques) \
+                or len(uniques) <= categorical_ratio * n:
+            return pd.Categorical.from_codes(codes, categories=pd.Index(uniques, dtype=object))
+        return pd.array(uniques, dtype=string_dtype()).take(codes, allow_fill=True)
+    values = np.empty(len(uniques) + 1, dtype=object)
+    values[:-1] = uniques
+    values[-1] = np.nan
+    return values[codes]
+
+
+def narrow_numeric(values):
+    """Returns `values` as the narrowest numeric array holding them exactly
+    (float32 only when no precision is lost), or None when they are not all
+    numeric."""
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind == "boolean":
+        arr = np.asarray(values)
+        return arr if arr.dtype == bool else None
+    if kind not in ("integer", "floating", "mixed-integer-float"):
+        return None
+    if kind == "integer":
+        try:
+            return pd.to_numeric(np.asarray(values, dtype=np.int64), downcast="integer")
+        except (TypeError, ValueError, OverflowError):
+            # missing values, held as NaN
+            pass
+    arr = np.asarray(values, dtype=np.float64)
+    narrow = arr.astype(np.float32)
+    if np.array_equal(narrow.astype(np.float64), arr, equal_nan=True):
+        return narrow
+    return arr
+
+
+def compact_column(values):
+    """Compact dtype for a list of column values: numbers in the narrowest
+    exact dtype, strings dictionary encoded as in `coded_column`. Other
+    values (e.g. lists of card-many attributes) are left as they are.
+
+    This only makes the resulting column smaller: `values` were already
+    decoded in full, so peak memory still holds every decoded string. Only
+    the streamed path (`compact_frame` over `pqq.query_iter`) avoids that."""
+    arr = narrow_numeric(values)
+    if arr is not None:
+        return arr
+    try:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    except TypeError:
+        return values
+    return coded_column(codes, uniques.tolist())
+
+
+def compact_frame(relations, columns):
+    """Build a frame with compact dtypes (see `compact_column`) from an
+    iterable of relations, e.g. as streamed by `pqq.query_iter`. Columns
+    whose first value is a string are dictionary encoded as the relations
+    arrive, so each distinct string is kept once and the decoded duplicates
+    are released as the stream is consumed. Strings are still decoded one
+    by one, it is the streaming that keeps peak memory down: given a list
+    of relations already decoded, the result is only a smaller frame."""
+    with pqi.phase("compact_frame") as attrs:
+        df = _compact_frame(relations, columns)
+        attrs["rows"] = len(df)
+    return df
+
+
+def _compact_frame(relations, columns):
+    encoders = None
+    codes = [array("q") for _ in columns]
+    values = [[] for _ in columns]
+    for relation in relations:
+        if encoders is None:
+            encoders = [{} if isinstance(value, str) else None for value in relation]
+        for j, value in enumerate(relation):
+            encoder = encoders[j]
+            if encoder is None:
+                values[j].append(value)
+                continue
+            if value is None:
+                codes[j].append(-1)
+                continue
+            code = encoder.get(value)
+            if code is None:
+                code = encoder[value] = len(encoder)
+            codes[j].append(code)
+    if encoders is None:
+        return pd.DataFrame(columns=columns)
+    data = {}
+    for j, name in enumerate(columns):
+        if encoders[j] is None:
+            data[name] = compact_column(values[j])
+        else:
+            data[name] = coded_column(codes[j], list(encoders[j]))
+    return pd.DataFrame(data)
+
+
+# triples buffered before being written into a dense matrix.
+matrix_flush_size = 32768
+
+
+def triples_matrix(triples, sparse: bool = False, shape=None, dtype="float64"):
+    """Pivot an iterable of (row label, column label, value) triples, e.g. as
+    streamed by `pqq.query_iter`, into a matrix, returning
+    (X, row_labels, column_labels). Labels get integer codes in order of
+    first sight; no long frame of the triples is built.
+
+    Dense matrices are preallocated (with `shape`, if the number of rows and
+    columns is known, otherwise grown by doubling), NaN where no value was
+    given, and filled in batches of `matrix_flush_size` triples. With `sparse=True`, X is a CSR
+    matrix of the given values built from coded coordinates. Where a row
+    and column repeat, the last value wins."""
+    with pqi.phase("triples_matrix", sparse=sparse) as attrs:
+        X, row_labels, col_labels, n = _triples_matrix(triples, sparse, shape, dtype)
+        attrs["rows"] = n
+    return X, row_labels, col_labels
+
+
+def batch_codes(labels, codes):
+    """Integer codes of a batch of labels, adding labels not in `codes` with
+    the next codes, in order of first sight."""
+    local_codes, uniques = pd.factorize(np.asarray(labels, dtype=object))
+    mapping = np.fromiter((codes.setdefault(u, len(codes)) for u in uniques),
+                          dtype=np.int64, count=len(uniques))
+    return mapping[local_codes]
+
+
+def _triples_matrix(triples, sparse, shape, dtype):
+    row_codes = {}
+    col_codes = {}
+    # coded coordinates and values, in batches
+    rows, cols, vals = [], [], []
+    X = None if sparse else np.full(shape or (64, 1024), np.nan, dtype=dtype)
+    n = 0
+
+    def flush():
+        nonlocal X
+        need = (len(row_codes), len(col_codes))
+        if need[0] > X.shape[0] or need[1] > X.shape[1]:
+            capacity = list(X.shape)
+            for axis in (0, 1):
+                if capacity[axis] < need[axis]:
+                    capacity[axis] = max(capacity[axis], 1)
+                while capacity[axis] < need[axis]:
+                    capacity[axis] *= 2
+            grown = np.full(capacity, np.nan, dtype=dtype)
+            grown[:X.shape[0], :X.shape[1]] = X
+            X = grown
+        X[rows.pop(), cols.pop()] = vals.pop()
+
+    triples = iter(triples)
+    while True:
+        batch = list(islice(triples, matrix_flush_size))
+        if not batch:
+            break
+        values = [t[2] for t in batch]
+        if None in values:
+            batch = [t for t in batch if t[2] is not None]
+            values = [t[2] for t in batch]
+        rows.append(batch_codes([t[0] for t in batch], row_codes))
+        cols.append(batch_codes([t[1] for t in batch], col_codes))
+        vals.append(np.array(values, dtype=np.float64))
+        n += len(batch)
+        if not sparse:
+            flush()
+    shape = (len(row_codes), len(col_codes))
+    if sparse:
+        import scipy.sparse as sp
+        r, c, v = (np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+                   for parts in (rows, cols, vals))
+        # keep the last of repeated coordinates, which csr would sum
+        _, first_of_reversed = np.unique((r * shape[1] + c)[::-1], return_index=True)
+        keep = len(r) - 1 - first_of_reversed
+        X = sp.csr_matrix((v[keep].astype(dtype), (r[keep], c[keep])), shape=shape)
+    elif X.shape != shape:
+        X = X[:shape[0], :shape[1]].copy()
+    return X, list(row_codes), list(col_codes), n
+
+
+def add_provenance(df, qres):
+    """Adds provenance to the frame's `attrs`, which pandas carries through
+    most transformations of the frame, see
+    https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.attrs.html"""
     now = datetime.now()
     metadata = PatternQProvenance(qres["db_name"],
                                   qres["basis_t"],
                                   now.strftime("%Y-%m-%d %H:%M:%S"))
-    df.patternq_provenance = metadata
+    df.attrs["patternq_provenance"] = metadata
     return df
 
 
@@ -109,8 +592,8 @@ def get_provenance(df):
     """Returns patternq provenance metadata if contained in dataframe,
     otherwise None"""
     try:
-        return df.patternq_provenance
-    except:
+        return df.attrs.get("patternq_provenance")
+    except AttributeError:
         return None
 
 def print_provenance(df):
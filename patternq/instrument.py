@@ -0,0 +1,189 @@
+"""Instrumentation of patternq calls: queries, downloads, decoding and the
+frame transforms report timed phases, with bytes transferred, row counts
+and basis_t where known, to hooks registered here. Errors and notices are
+reported as events too, and logged to the "patternq" logger.
+
+    import patternq.instrument as pqi
+
+    pqi.enable()                      # aggregate into the default collector
+    pqd.sample_measurements(..., timeout=120)
+    pqi.summary()                     # count, total and percentiles per phase
+
+    pqi.add_hook(print)               # or any callable taking an Event
+    pqi.log_events()                  # or log them, to the "patternq" logger
+
+Phases are named after where they happen, e.g. query.request (server
+execution and presigned URL turnaround), query.download, query.decompress,
+query.parse, extract, expand_many_nested."""
+import contextvars
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger("patternq")
+
+Event = namedtuple(
+    "Event",
+    [
+        'kind',       # "phase", "error" or "info"
+        'name',
+        'duration',   # seconds, for phases
+        'attrs',      # e.g. db_name, bytes, rows, basis_t
+        'timestamp'
+    ]
+)
+
+hooks = []
+# attributes added to every event emitted within `context`
+context_attrs = contextvars.ContextVar("patternq_context", default={})
+
+
+def add_hook(hook):
+    """Call `hook(event)` with every event."""
+    if hook not in hooks:
+        hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+    return True
+
+
+def emit(kind: str, name: str, duration: float or None = None, **attrs):
+    if not hooks:
+        return
+    event = Event(kind, name, duration, {**context_attrs.get(), **attrs}, time.time())
+    for hook in list(hooks):
+        try:
+            hook(event)
+        except Exception:
+            logger.exception(f"patternq instrumentation hook {hook!r} failed")
+
+
+@contextmanager
+def phase(name: str, **attrs):
+    """Times the block as phase `name`. Yields the event's attrs dict, so
+    the block can add e.g. bytes or rows as they become known."""
+    if not hooks:
+        yield attrs
+        return
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except GeneratorExit:
+        # a streaming generator closed before it was exhausted
+        attrs["closed"] = True
+        raise
+    except BaseException as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        emit("phase", name, time.perf_counter() - start, **attrs)
+
+
+@contextmanager
+def context(**attrs):
+    """Adds `attrs` (e.g. a notebook cell or job name) to the events of
+    calls made within the block."""
+    token = context_attrs.set({**context_attrs.get(), **attrs})
+    try:
+        yield
+    finally:
+        context_attrs.reset(token)
+
+
+def error(name: str, message: str, **attrs):
+    """Reports an error event, also logged as a warning."""
+    logger.warning(message)
+    emit("error", name, message=message, **attrs)
+
+
+def info(name: str, message: str, **attrs):
+    """Reports a notice, also logged at info level."""
+    logger.info(message)
+    emit("info", name, message=message, **attrs)
+
+
+class Collector:
+    """Hook keeping the most recent `max_events` events, summarized per
+    phase by `summary`."""
+
+    def __init__(self, max_events: int = 100_000):
+        self.events = deque(maxlen=max_events)
+        self.lock = threading.Lock()
+
+    def __call__(self, event: Event):
+        with self.lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """DataFrame with one row per phase: count, total and percentile
+        durations in seconds, and total bytes and rows, plus a count of
+        errors per event name."""
+        import numpy as np
+        import pandas as pd
+        with self.lock:
+            events = list(self.events)
+        durations, totals, errors = {}, {}, {}
+        for event in events:
+            if event.kind == "error":
+                errors[event.name] = errors.get(event.name, 0) + 1
+            if event.kind != "phase":
+                continue
+            durations.setdefault(event.name, []).append(event.duration)
+            total = totals.setdefault(event.name, {"bytes": 0, "rows": 0})
+            for key in total:
+                total[key] += event.attrs.get(key) or 0
+        rows = []
+        for name, ds in durations.items():
+            ds = np.asarray(ds)
+            row = {"phase": name, "count": len(ds), "total_s": ds.sum()}
+            for p, value in zip(percentiles, np.percentile(ds, percentiles)):
+                row[f"p{p}_s"] = value
+            row["max_s"] = ds.max()
+            row.update(totals[name])
+            row["errors"] = errors.pop(name, 0)
+            rows.append(row)
+        for name, count in errors.items():
+            rows.append({"phase": name, "count": 0, "errors": count})
+        return pd.DataFrame(rows, columns=["phase", "count", "total_s"]
+                            + [f"p{p}_s" for p in percentiles]
+                            + ["max_s", "bytes", "rows", "errors"])
+
+
+collector = Collector()
+
+
+def enable():
+    """Aggregate events of this session in the default collector."""
+    add_hook(collector)
+    return collector
+
+
+def disable():
+    remove_hook(collector)
+    return True
+
+
+def summary(**kwargs):
+    """Per phase summary of the default collector, see `Collector.summary`."""
+    return collector.summary(**kwargs)
+
+
+def log_events(log: logging.Logger or None = None, level: int = logging.DEBUG):
+    """Log every phase event to `log` (the "patternq" logger by default),
+    returning the hook for `remove_hook`."""
+    log = log or logger
+
+    def log_hook(event: Event):
+        if event.kind == "phase":
+            log.log(level, f"{event.name} {event.duration:.3f}s {event.attrs}")
+    return add_hook(log_hook)
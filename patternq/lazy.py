@@ -0,0 +1,50 @@
+"""Deferred imports of heavy dependencies (pandas, numpy), so that importing
+patternq to fetch a few values, e.g. with `pqq.query` or an
+`output="records"` wrapper call, doesn't pay for them:
+
+    pd = pql.lazy_import("pandas")
+
+imports pandas on the first attribute access of `pd`, e.g. pd.DataFrame."""
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module, importing it on first attribute access. Once
+    imported, the module's attributes are copied onto the stand-in so later
+    lookups don't go through __getattr__."""
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """The module `name` if it is already imported, else a stand-in that
+    imports it when first used."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+def imported(name: str) -> bool:
+    """Whether module `name` has actually been imported."""
+    return name in sys.modules
+
+
+def require(name: str, purpose: str, extra: str or None = None) -> types.ModuleType:
+    """Imports module `name`, an optional dependency needed for `purpose`,
+    raising an ImportError saying how to install it if it is missing."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        package = name.split(".")[0]
+        hint = f"patternq[{extra}]" if extra else package
+        raise ImportError(f"{package} is required for {purpose}, install it with: "
+                          f"pip install '{hint}'") from e
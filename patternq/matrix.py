@@ -0,0 +1,160 @@
+"""Measurement matrices as AnnData objects, with sample attributes as obs and
+gene attributes as var, stored sparse when the data is sparse and backed by
+an on-disk h5ad file so that genes x samples can be sliced without loading
+the full matrix."""
+from __future__ import annotations
+
+import os
+
+import patternq.cache as pqc
+import patternq.dataset as pqd
+import patternq.lazy as pql
+import patternq.query as pqq
+import patternq.reference as pqr
+
+np = pql.lazy_import("numpy")
+pd = pql.lazy_import("pandas")
+
+# matrices with at most this fraction of nonzero values are stored sparse.
+sparse_density = 0.5
+
+
+def matrix_key_of(matrix) -> str:
+    """Accepts a matrix key, or a row of the `pqd.measurement_matrices` frame."""
+    if isinstance(matrix, str):
+        return matrix
+    return matrix["measurement-matrix-key"]
+
+
+def matrix_arrays(df: pd.DataFrame, sample_ids=None):
+    """Given a measurement matrix frame as returned by `get_measurement_matrix`,
+    returns (X, obs_names, var_names) with observations (samples, or cells)
+    as rows.
+
+    Two layouts are handled: dense matrices with a label column followed by
+    one numeric column per sample (or per gene), and long/sparse matrices of
+    (observation, feature, value) columns. When `sample_ids` are provided
+    they decide the orientation, otherwise columns of a dense matrix are
+    taken to be observations and the first label column of a long matrix."""
+    import scipy.sparse as sp
+    sample_ids = set(sample_ids) if sample_ids is not None else set()
+    labels = [col for col, dtype in df.dtypes.items()
+              if not pd.api.types.is_numeric_dtype(dtype)]
+    values = [col for col in df.columns if col not in labels]
+    if len(labels) == 2 and len(values) == 1:
+        obs_col, var_col = labels
+        if sample_ids and sample_ids.isdisjoint(df[obs_col].head(1000)) \
+                and not sample_ids.isdisjoint(df[var_col].head(1000)):
+            obs_col, var_col = var_col, obs_col
+        obs_codes, obs_names = pd.factorize(df[obs_col])
+        var_codes, var_names = pd.factorize(df[var_col])
+        X = sp.csr_matrix((df[values[0]].to_numpy(), (obs_codes, var_codes)),
+                          shape=(len(obs_names), len(var_names)))
+        return X, pd.Index(obs_names).astype(str), pd.Index(var_names).astype(str)
+    if labels:
+        row_names = pd.Index(df[labels[0]]).astype(str)
+    else:
+        row_names = df.index.astype(str)
+    X = df[values].to_numpy()
+    col_names = pd.Index(values).astype(str)
+    if sample_ids and sample_ids.isdisjoint(col_names) and not sample_ids.isdisjoint(row_names):
+        return X, row_names, col_names
+    return X.T, col_names, row_names
+
+
+def h5ad_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Coerce a wrapper frame into obs/var annotations h5ad can store:
+    string labels, and non-string objects (e.g. lists from card-many
+    attributes) in object columns rendered as strings."""
+    df = df.copy()
+    df.columns = [str(col) for col in df.columns]
+    df.index = df.index.astype(str)
+    df.index.name = None
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].map(lambda v: v if isinstance(v, str) or v is None
+                                  or (isinstance(v, float) and np.isnan(v)) else str(v))
+    return df
+
+
+def annotations(obs_names, var_names, samples: pd.DataFrame or None = None,
+                db_name: str or None = None, **kwargs):
+    """obs and var frames for an AnnData: `samples` (indexed by sample id)
+    joined on the obs names and `pqr.genes` on the var names (HGNC symbols),
+    or bare names if samples is None."""
+    obs = pd.DataFrame(index=pd.Index(obs_names).astype(str))
+    var = pd.DataFrame(index=pd.Index(var_names).astype(str))
+    if samples is not None:
+        obs = samples.reindex(obs.index)
+        genes = pqr.genes(db_name=db_name, **kwargs)
+        genes = genes.drop_duplicates("gene-hgnc-symbol").set_index("gene-hgnc-symbol")
+        var = genes.reindex(var.index)
+    return h5ad_safe(obs), h5ad_safe(var)
+
+
+def anndata(matrix, dataset: str or None = None, db_name: str or None = None,
+            backed: bool = True, sparse: bool or None = None, **kwargs):
+    """Returns the measurement matrix `matrix` (a matrix key, or a row of
+    `pqd.measurement_matrices(dataset)`) as an AnnData object.
+
+    If `dataset` is given, obs are joined from `pqd.samples(dataset)` on
+    sample id and var from `pqr.genes()` on HGNC symbol. X is sparse (CSR)
+    when `sparse=True`, or when `sparse` is None and at most `sparse_density`
+    of the values are nonzero. With `backed=True` the AnnData is written to
+    an h5ad file (see `pqc.anndata_path`) and returned opened in backed
+    mode, so that slices are read from disk on demand. The file is reused
+    by later calls with the same options while the database's basis_t
+    doesn't change. kwargs are passed through to the queries."""
+    import anndata as ad
+    import scipy.sparse as sp
+    if db_name is None:
+        db_name = pqq.db
+    matrix_key = matrix_key_of(matrix)
+    h5ad_path = None
+    if backed:
+        basis_t = pqq.current_basis_t(db_name, session=kwargs.get("session"))
+        h5ad_path = pqc.anndata_path(db_name, matrix_key, basis_t, dataset=dataset, sparse=sparse)
+        if os.path.exists(h5ad_path):
+            return ad.read_h5ad(h5ad_path, backed="r")
+    df = pqq.get_measurement_matrix(matrix_key, db_name=db_name,
+                                    session=kwargs.get("session"))
+    samples = None
+    if dataset is not None:
+        samples = pqd.samples(dataset, db_name=db_name, **kwargs)
+        samples = samples.drop_duplicates("sample-id").set_index("sample-id")
+    X, obs_names, var_names = matrix_arrays(
+        df, sample_ids=samples.index if samples is not None else None)
+    if sparse is None:
+        nonzero = X.nnz if sp.issparse(X) else np.count_nonzero(X)
+        sparse = nonzero <= sparse_density * max(X.shape[0] * X.shape[1], 1)
+    if sparse and not sp.issparse(X):
+        X = sp.csr_matrix(X)
+    elif not sparse and sp.issparse(X):
+        X = X.toarray()
+    obs, var = annotations(obs_names, var_names, samples, db_name=db_name, **kwargs)
+    adata = ad.AnnData(X=X, obs=obs, var=var)
+    if not backed:
+        return adata
+    tmp_path = f"{h5ad_path}.{os.getpid()}.tmp"
+    adata.write_h5ad(tmp_path)
+    os.replace(tmp_path, h5ad_path)
+    pqc.evict(os.path.dirname(h5ad_path), pqc.max_matrix_bytes)
+    return ad.read_h5ad(h5ad_path, backed="r")
+
+
+def gene_expression_anndata(measurement_set: str, measurement_attr: pqd.RNASeqMeasurementAttribute,
+                            dataset: str or None = None, db_name: str or None = None,
+                            sparse: bool = False, **kwargs):
+    """Returns gene expression values of a measurement set as an in-memory
+    AnnData of samples x genes, with X streamed from the query result by
+    `pqd.gene_expression_matrix` (dense, or CSR if `sparse`). If `dataset`
+    is given, obs and var are annotated as in `anndata`."""
+    import anndata as ad
+    X, sample_ids, genes = pqd.gene_expression_matrix(measurement_set, measurement_attr,
+                                                      db_name=db_name, sparse=sparse, **kwargs)
+    samples = None
+    if dataset is not None:
+        samples = pqd.samples(dataset, db_name=db_name, **kwargs)
+        samples = samples.drop_duplicates("sample-id").set_index("sample-id")
+    obs, var = annotations(sample_ids, genes, samples, db_name=db_name, **kwargs)
+    return ad.AnnData(X=X, obs=obs, var=var)
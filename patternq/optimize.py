@@ -0,0 +1,381 @@
+"""Client-side analysis of Datalog queries: validation of variable bindings,
+and a reordering of :where clauses that starts from the bound inputs and
+joins the most selective clause next, as estimated from attribute
+statistics sampled from the datoms index (or from the shape of each clause
+alone, without sampling).
+
+    import patternq.optimize as pqo
+
+    print(pqo.explain(pqd.gx_by_attr_q, args=["rna-seq", ":measurement/tpm"],
+                      sample_stats=True))
+    pqq.query(q_dict, args=args, optimize=True)   # for one query
+    pqo.enable(sample_stats=True)                 # for every query
+
+Only data patterns are reordered. Other clauses (predicates, function
+calls, rules, or, not) stay in place, and data patterns are not moved
+across them, so the reordered query returns the same relations."""
+import json
+import math
+import re
+import threading
+from collections import namedtuple
+from typing import Any, Dict, List
+
+import patternq.instrument as pqi
+import patternq.query as pqq
+
+AttrStats = namedtuple(
+    "AttrStats",
+    [
+        'count',       # datoms of the attribute
+        'per_entity',  # datoms per entity having the attribute
+        'per_value'    # datoms per distinct value
+    ]
+)
+
+Step = namedtuple(
+    "Step",
+    [
+        'clause',
+        'position',    # of the clause in the original :where
+        'rows',        # estimated relations of the clause joined with
+                       # the bindings it shares variables with
+        'stats'        # AttrStats used for the estimate, or None
+    ]
+)
+
+Plan = namedtuple(
+    "Plan",
+    [
+        'query',       # the query with reordered :where
+        'steps',
+        'problems'
+    ]
+)
+
+enabled = False
+sample = False
+# datoms read per attribute for the per entity and per value ratios.
+sample_size = 1000
+# attribute statistics assumed without sampling, and for attributes not
+# known until the query runs (an unbound attribute variable).
+default_stats = AttrStats(1e6, 1, 10)
+unknown_attr_stats = AttrStats(1e9, 50, 1000)
+# datoms per value assumed for keyword (enum ident) values without sampling.
+default_enum_per_value = 1e4
+# bindings assumed for a collection input whose args are not known.
+default_collection_size = 1000
+
+_var_re = re.compile(r"^\?[^\s,()\[\]{}\"';]+$")
+_attr_stats = {}
+_lock = threading.Lock()
+
+
+def enable(sample_stats: bool = False):
+    """Optimize every query issued with `pqq.query` or `pqq.query_iter`,
+    using sampled attribute statistics if `sample_stats`."""
+    global enabled, sample
+    enabled = True
+    sample = sample_stats
+    return True
+
+
+def disable():
+    global enabled
+    enabled = False
+    return True
+
+
+def is_var(x) -> bool:
+    return isinstance(x, str) and x.startswith("?")
+
+
+def is_source(x) -> bool:
+    return isinstance(x, str) and x.startswith("$")
+
+
+def form_vars(form) -> List[str]:
+    """Variables of a (nested) query form, in order of appearance."""
+    if is_var(form):
+        return [form]
+    if isinstance(form, (list, tuple)):
+        return [var for f in form for var in form_vars(f)]
+    return []
+
+
+def find_vars(q_dict) -> List[str]:
+    found = []
+    for elem in q_dict.get(":find", []):
+        if isinstance(elem, list) and elem and elem[0] == "pull":
+            # the pull pattern holds attributes, not variables
+            found.extend(form_vars(elem[1]))
+        else:
+            found.extend(form_vars(elem))
+    return found
+
+
+def input_bindings(q_dict, args: List[Any] or None = None) -> Dict[str, Any]:
+    """Variable of each :in binding, with its estimated number of values,
+    and its value for scalar bindings with known args."""
+    bindings = {}
+    args = list(args) if args is not None else None
+    arg_i = 0
+    for binding in q_dict.get(":in", []):
+        if is_source(binding):
+            continue
+        arg = args[arg_i] if args is not None and arg_i < len(args) else None
+        arg_i += 1
+        if is_var(binding):
+            bindings[binding] = {"count": 1, "value": arg}
+        elif isinstance(binding, list) and binding[-1:] == ["..."]:
+            n = len(arg) if arg is not None else default_collection_size
+            bindings[binding[0]] = {"count": max(n, 1), "value": None}
+        elif isinstance(binding, list) and binding and isinstance(binding[0], list):
+            n = len(arg) if arg is not None else default_collection_size
+            for var in form_vars(binding):
+                bindings[var] = {"count": max(n, 1), "value": None}
+        else:
+            for var in form_vars(binding):
+                bindings[var] = {"count": 1, "value": None}
+    return bindings
+
+
+def is_pattern(clause) -> bool:
+    """Whether a :where clause is a data pattern, e.g. ["?e", ":a/b", "?v"],
+    rather than a predicate, function call, rule or or/not clause."""
+    if not isinstance(clause, list):
+        return False
+    terms = clause[1:] if clause and is_source(clause[0]) else clause
+    if not terms or any(isinstance(t, (list, dict)) for t in terms):
+        return False
+    return is_var(terms[0]) or terms[0] == "_" or isinstance(terms[0], int)
+
+
+def pattern_terms(clause):
+    """e, a and v of a data pattern, None where the pattern omits them."""
+    terms = clause[1:] if is_source(clause[0]) else clause
+    terms = list(terms) + [None] * (3 - len(terms))
+    return terms[0], terms[1], terms[2]
+
+
+def check(q_dict) -> List[str]:
+    """Problems with the variable bindings of a query: malformed variable
+    names, :find variables not bound by :where or :in, inputs that don't
+    constrain :where, and :where clauses sharing no variables with the
+    rest, which join as a cross product."""
+    problems = []
+    where = q_dict.get(":where", [])
+    inputs = input_bindings(q_dict)
+    all_vars = form_vars(q_dict.get(":find", [])) + form_vars(q_dict.get(":in", [])) + form_vars(where)
+    for var in dict.fromkeys(all_vars):
+        if not _var_re.match(var):
+            problems.append(f"malformed variable {var!r}")
+    where_vars = set(form_vars(where))
+    for var in dict.fromkeys(find_vars(q_dict)):
+        if var not in where_vars and var not in inputs:
+            problems.append(f":find variable {var} is not bound by :where or :in")
+    for var in inputs:
+        if var not in where_vars:
+            problems.append(f"input {var} is not used in :where, so does not constrain the query")
+    groups = _joined_groups(where)
+    if len(groups) > 1:
+        listed = "; ".join(", ".join(json.dumps(where[i]) for i in group) for group in groups)
+        problems.append(f":where clauses share no variables between groups, "
+                        f"which join as a cross product: {listed}")
+    return problems
+
+
+def _joined_groups(where) -> List[List[int]]:
+    """Clause positions of :where, grouped by shared variables."""
+    parent = list(range(len(where)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    first_seen = {}
+    for i, clause in enumerate(where):
+        for var in form_vars(clause):
+            if var in first_seen:
+                parent[root(i)] = root(first_seen[var])
+            else:
+                first_seen[var] = i
+    groups = {}
+    for i, clause in enumerate(where):
+        if form_vars(clause):
+            groups.setdefault(root(i), []).append(i)
+    return list(groups.values())
+
+
+def validate(q_dict):
+    """Raises ValueError listing the problems found by `check`."""
+    problems = check(q_dict)
+    if problems:
+        raise ValueError("Invalid query: " + "; ".join(problems))
+    return True
+
+
+def attribute_stats(attr: str, db_name: str or None = None, refresh: bool = False,
+                    **kwargs) -> AttrStats:
+    """Statistics of attribute `attr`, estimated from the aevt index: the
+    datom count by probing offsets (doubling, then bisecting), and datoms
+    per entity and per value from the first `sample_size` datoms. Kept for
+    the session, per db_name. Other kwargs are passed to `pqq.datoms`."""
+    if db_name is None:
+        db_name = pqq.db
+    key = (db_name, attr)
+    with _lock:
+        if key in _attr_stats and not refresh:
+            return _attr_stats[key]
+    with pqi.phase("optimize.stats", db_name=db_name, attr=attr) as attrs:
+        page = pqq.datoms("aevt", [attr], offset=0, limit=sample_size,
+                          db_name=db_name, **kwargs) or []
+        count = len(page)
+        if count == sample_size:
+            count = _probe_count(attr, db_name, **kwargs)
+        es, vs = set(), set()
+        for datom in page:
+            e, v = (datom["e"], datom["v"]) if isinstance(datom, dict) else (datom[0], datom[2])
+            es.add(e)
+            vs.add(v if not isinstance(v, (list, dict)) else json.dumps(v, sort_keys=True))
+        stats = AttrStats(count, len(page) / max(len(es), 1), len(page) / max(len(vs), 1))
+        attrs["count"] = count
+    with _lock:
+        _attr_stats[key] = stats
+    return stats
+
+
+def _probe_count(attr, db_name, bisections: int = 4, **kwargs) -> int:
+    def has_datom(offset):
+        return bool(pqq.datoms("aevt", [attr], offset=offset, limit=1,
+                               db_name=db_name, **kwargs))
+    low = sample_size
+    high = low * 2
+    while has_datom(high):
+        low, high = high, high * 2
+    for _ in range(bisections):
+        mid = (low + high) // 2
+        if has_datom(mid):
+            low = mid
+        else:
+            high = mid
+    return (low + high) // 2
+
+
+def clear_stats():
+    with _lock:
+        _attr_stats.clear()
+    return True
+
+
+def plan(q_dict, args: List[Any] or None = None, db_name: str or None = None,
+         sample_stats: bool = False, **kwargs) -> Plan:
+    """Reorder the data patterns of :where greedily, each next clause being
+    the one sharing variables with the bindings so far that has the fewest
+    estimated relations once joined with them. Bindings not yet joined are kept
+    apart, as the query engine does, starting from one per input. Scalar
+    args resolve attribute variables and bound values. With
+    `sample_stats`, estimates use `attribute_stats`, else `default_stats`."""
+    where = q_dict.get(":where", [])
+    inputs = input_bindings(q_dict, args)
+    # [variables, estimated relations] of each set of joined bindings
+    groups = [[{var}, float(b["count"])] for var, b in inputs.items()]
+
+    def group_of(var):
+        for group in groups:
+            if var in group[0]:
+                return group
+        return None
+
+    def value_of(term):
+        if is_var(term):
+            return inputs.get(term, {}).get("value")
+        return term
+
+    def stats_of(a):
+        attr = value_of(a)
+        if is_var(a) and not isinstance(attr, str):
+            return default_stats if group_of(a) else unknown_attr_stats
+        if not isinstance(attr, str) or attr == "_":
+            return unknown_attr_stats
+        if sample_stats:
+            return attribute_stats(attr, db_name=db_name, **kwargs)
+        return default_stats
+
+    def estimate(clause):
+        e, a, v = pattern_terms(clause)
+        stats = stats_of(a)
+        e_bound = isinstance(e, int) or (is_var(e) and group_of(e) is not None)
+        v_bound = v is not None and v != "_" and (not is_var(v) or group_of(v) is not None)
+        per_value = stats.per_value
+        if not sample_stats and isinstance(value_of(v), str) and value_of(v).startswith(":"):
+            per_value = default_enum_per_value
+        if e_bound and v_bound:
+            fanout = min(stats.per_entity, per_value, 1)
+        elif e_bound:
+            fanout = stats.per_entity
+        elif v_bound:
+            fanout = per_value
+        else:
+            fanout = stats.count
+        joined = [group for group in groups if group[0] & set(form_vars(clause))]
+        return fanout * math.prod(group[1] for group in joined), joined, stats
+
+    def join(clause, rows, joined):
+        for group in joined:
+            groups.remove(group)
+        groups.append([set(form_vars(clause)).union(*(g[0] for g in joined)), rows])
+
+    steps = []
+    with pqi.phase("optimize", clauses=len(where), sample_stats=sample_stats):
+        segment = []
+        for position, clause in enumerate(where + [None]):
+            if clause is not None and is_pattern(clause):
+                segment.append(position)
+                continue
+            while segment:
+                estimates = [(estimate(where[i]), n) for n, i in enumerate(segment)]
+                # scan a clause sharing no variables with the bindings so far
+                # only when no other clause is left
+                connected = [(e[0], n) for e, n in estimates if e[1]]
+                rows, n = min(connected or [(e[0], n) for e, n in estimates])
+                i = segment.pop(n)
+                rows, joined, stats = estimate(where[i])
+                join(where[i], rows, joined)
+                steps.append(Step(where[i], i, rows, stats))
+            if clause is not None:
+                # other clauses stay in place, joining the bindings of their
+                # variables
+                joined = [group for group in groups if group[0] & set(form_vars(clause))]
+                rows = math.prod(group[1] for group in joined)
+                join(clause, rows, joined)
+                steps.append(Step(clause, position, rows, None))
+    reordered = dict(q_dict)
+    reordered[":where"] = [step.clause for step in steps]
+    return Plan(reordered, steps, check(q_dict))
+
+
+def optimize(q_dict, args: List[Any] or None = None, db_name: str or None = None,
+             sample_stats: bool = False, **kwargs):
+    """The query with :where reordered by `plan`, after `validate`."""
+    validate(q_dict)
+    return plan(q_dict, args, db_name=db_name, sample_stats=sample_stats, **kwargs).query
+
+
+def explain(q_dict, args: List[Any] or None = None, db_name: str or None = None,
+            sample_stats: bool = False, **kwargs) -> str:
+    """Text description of the `plan` for a query: its problems, and its
+    :where clauses in the planned order, with the original position,
+    estimated relations after each and the attribute statistics used."""
+    p = plan(q_dict, args, db_name=db_name, sample_stats=sample_stats, **kwargs)
+    lines = [f"problem: {problem}" for problem in p.problems]
+    lines.append(f"{'step':>4s} {'from':>4s} {'est rows':>10s} {'attr count':>10s} "
+                 f"{'per e':>6s} {'per v':>6s}  clause")
+    for n, step in enumerate(p.steps):
+        s = step.stats
+        stat_cols = (f"{s.count:10.0f} {s.per_entity:6.1f} {s.per_value:6.1f}" if s
+                     else f"{'':10s} {'':6s} {'':6s}")
+        lines.append(f"{n:4d} {step.position:4d} {step.rows:10.0f} {stat_cols}  "
+                     f"{json.dumps(step.clause)}")
+    return "\n".join(lines)
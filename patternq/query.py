@@ -1,16 +1,63 @@
+from __future__ import annotations
+
+import contextvars
+import itertools
 import json
 import os
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from io import BytesIO
 from tempfile import NamedTemporaryFile
 import gzip as gz
 
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Iterator
+
+import patternq.cache as pqc
+import patternq.formats as pqf
+import patternq.helpers as pqh
+import patternq.instrument as pqi
+import patternq.lazy as pql
+import patternq.optimize as pqo
+import patternq.stream as pqs
 
-import pandas as pd
+np = pql.lazy_import("numpy")
+pd = pql.lazy_import("pandas")
 
 
 db = None
+default_session = None
+# answers queries and datoms requests when no backend is passed, None for
+# the query service (see `patternq.backend`)
+default_backend = None
+
+# Connection pool and retry defaults for the module-wide session, see
+# `configure_session`. Query and datoms calls are reads, so POST is
+# safe to retry on throttling and transient server errors. Timeouts
+# (504, or no response within the read timeout) are not retried, a query
+# that timed out would most likely time out again: query_batched splits
+# them instead.
+pool_size = 10
+max_retries = 3
+backoff_factor = 0.5
+retry_statuses = (429, 500, 502, 503)
+
+# Defaults for query_batched: collection values sent per request, and
+# requests issued concurrently.
+default_batch_size = 1000
+default_max_workers = 8
+# responses taken to mean that the query service timed out.
+timeout_statuses = (408, 504)
+# whether concurrent identical queries share one request, see `single_flight`.
+coalesce = True
+# futures of the queries in flight, by cache key and whether cached
+_in_flight = {}
+_in_flight_lock = threading.Lock()
 
 def commons_endpoint() -> str:
     default = "https://data-commons.rcrf-dev.org"
@@ -39,6 +86,45 @@ def make_headers(accept="text/plain") -> Dict[str, str]:
 #        return resp.json()
 
 
+def make_session(pool_size: int = pool_size, max_retries: int = max_retries,
+                 backoff_factor: float = backoff_factor) -> requests.Session:
+    """Create a requests session with a keep-alive connection pool of
+    `pool_size` connections per host, retrying with exponential backoff
+    on `retry_statuses` and connection errors, but not on read timeouts."""
+    retry = Retry(total=max_retries,
+                  read=0,
+                  backoff_factor=backoff_factor,
+                  status_forcelist=retry_statuses,
+                  allowed_methods=frozenset(["GET", "POST"]),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    new_session = requests.Session()
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    return new_session
+
+
+def configure_session(**kwargs) -> requests.Session:
+    """Replace the module wide session used by query, datoms and
+    get_measurement_matrix with one built by `make_session(**kwargs)`,
+    e.g. to enlarge the pool for concurrent use."""
+    global default_session
+    if default_session is not None:
+        default_session.close()
+    default_session = make_session(**kwargs)
+    return default_session
+
+
+def get_session() -> requests.Session:
+    """Returns the module wide pooled session, creating it on first use."""
+    global default_session
+    if default_session is None:
+        default_session = make_session()
+    return default_session
+
+
 def set_db(db_name: str):
     """Sets a database as default query target for the duration of the session."""
     global db
@@ -46,99 +132,593 @@ def set_db(db_name: str):
     db = db_name
     return True
 
-def query(q_dict: Dict[str, List[Any]], args:List[Any] or None = None, session: requests.Session or None = None,
-          timeout: int = 30, db_name: str or None = None):
-    """Issue a query to the Pattern.org Data Commons query service.
-    If `session` is provided, will use an existing requests session and its connection pool.
-    Use this to batch multiple queries.
-
-    TODO: can strengthen type signature of query by referring to Datomic Datalog
-    query grammar."""
+def query_result_url(q_dict: Dict[str, List[Any]], args: List[Any] or None = None,
+                     session: requests.Session or None = None,
+                     timeout: int = 30, db_name: str or None = None):
+    """Issue a query to the query service, returning the presigned URL
+    the result can be downloaded from, in one of the `pqf.accepted` formats
+    (gzip'd JSON if the service doesn't offer the others)."""
     if not session:
-        session = requests
+        session = get_session()
     req_body = {"query": q_dict,
                 "timeout": timeout * 1000}  # sec -> msec
     if args:
         req_body['args'] = args
-    # use default module wide db if no db_name arg is passed.
     if db_name is None:
         db_name = db
     # build request and issue to query server
     headers = make_headers()
+    headers[pqf.format_header] = ", ".join(pqf.accepted())
     endpoint = f"{commons_endpoint()}/query/{db_name}"
-    resp = requests.post(
-        endpoint,
-        json.dumps(req_body),
-        headers=headers,
-        timeout=(timeout + 2)  # little buffer past candel query timeout
-    )
+    with pqi.phase("query.request", db_name=db_name) as attrs:
+        resp = session.post(
+            endpoint,
+            json.dumps(req_body),
+            headers=headers,
+            timeout=(timeout + 2)  # little buffer past candel query timeout
+        )
+        attrs["status"] = resp.status_code
     if resp.status_code == 200:
-        dl_path = resp.content
-        dl_resp = requests.get(dl_path)
-        qres = json.loads(gz.decompress(dl_resp.content))
+        return resp.content
+    else:
+        report_error("query", resp, db_name=db_name)
+
+
+def report_error(name: str, resp: requests.Response, **attrs):
+    """Report an error response of the query service as an error event,
+    then raise it."""
+    try:
+        body = json.loads(resp.content)
+    except ValueError:
+        body = resp.content
+    pqi.error(name, f"{name} encountered an error (HTTP {resp.status_code}): {body}",
+              status=resp.status_code, body=body, **attrs)
+    resp.raise_for_status()
+
+
+# a minimal query, issued to learn the current basis_t of a database.
+basis_t_q = {
+    ":find": ["?e"],
+    ":where": [["?e", ":db/ident", ":db/ident"]]
+}
+
+
+def current_basis_t(db_name: str or None = None, session: requests.Session or None = None,
+                    timeout: int = 30):
+    """Returns the current basis_t of the database, reusing the basis_t
+    observed on recent query results where available."""
+    if db_name is None:
+        db_name = db
+    basis_t = pqc.known_basis_t(db_name)
+    if basis_t is None:
+        qres = query(basis_t_q, session=session, timeout=timeout,
+                     db_name=db_name, cache=False)
+        basis_t = qres["basis_t"]
+    return basis_t
+
+
+def query(q_dict: Dict[str, List[Any]], args:List[Any] or None = None, session: requests.Session or None = None,
+          timeout: int = 30, db_name: str or None = None, cache: bool or None = None,
+          flatten_enums: bool = False, optimize: bool or None = None, backend=None):
+    """Issue a query to the Pattern.org Data Commons query service.
+    If `session` is provided, will use an existing requests session and its connection pool,
+    otherwise the module wide pooled session from `get_session` is used.
+
+    Results are served from the local result cache (see `patternq.cache`)
+    when it is enabled, unless `cache=False`; `cache=True` uses the cache for
+    this call even if it is not enabled for the session.
+
+    With `flatten_enums=True`, enum maps are flattened to their idents while
+    the JSON is decoded (as `pqh.flatten_enum_idents` would afterwards).
+
+    With `optimize=True` (or when enabled with `pqo.enable`), the query is
+    validated and its :where clauses reordered by `pqo.optimize` first.
+
+    Concurrent calls for the same query, args and db_name (e.g. from several
+    threads or `patternq.aio` tasks) share one request and its result,
+    unless `coalesce` is set to False; treat the relations as read only.
+
+    The query is answered by `backend` if given, else by `default_backend`
+    if set, e.g. a `patternq.backend.LocalBackend`, and otherwise
+    by the query service (local results skip the cache and coalescing).
+
+    TODO: can strengthen type signature of query by referring to Datomic Datalog
+    query grammar."""
+    if not session:
+        session = get_session()
+    # use default module wide db if no db_name arg is passed.
+    if db_name is None:
+        db_name = db
+    backend = resolve_backend(backend)
+    q_dict = optimized(q_dict, args, optimize, db_name=db_name, session=session, timeout=timeout,
+                       backend=backend)
+    if backend is not None:
+        return local_query(backend, q_dict, args, db_name, flatten_enums)
+    use_cache = pqc.enabled if cache is None else cache
+    key = pqc.cache_key(db_name, q_dict, args, flatten_enums=flatten_enums)
+    fetch = partial(fetch_result, q_dict, args, key, session=session, timeout=timeout,
+                    db_name=db_name, use_cache=use_cache, flatten_enums=flatten_enums)
+    with pqi.phase("query", db_name=db_name) as attrs:
+        if not coalesce:
+            return fetch(attrs)
+        qres, shared = single_flight((key, use_cache), partial(fetch, attrs))
+        if shared:
+            attrs["coalesced"] = True
+            if qres is not None:
+                attrs["rows"] = len(qres["query_result"])
+                attrs["basis_t"] = qres.get("basis_t")
+                # the relations are shared with the other callers
+                qres = dict(qres)
+        return qres
+
+
+def fetch_result(q_dict: Dict[str, List[Any]], args: List[Any] or None, key: str,
+                 attrs: Dict[str, Any], session: requests.Session, timeout: int,
+                 db_name: str, use_cache: bool, flatten_enums: bool):
+    """Result of a query from the cache if `use_cache`, or from the query
+    service, noting its size and basis_t in the phase `attrs`."""
+    if use_cache:
+        qres = pqc.lookup(key, current_basis_t(db_name, session=session, timeout=timeout))
+        attrs["cached"] = qres is not None
+        if qres is not None:
+            attrs["rows"] = len(qres["query_result"])
+            attrs["basis_t"] = qres.get("basis_t")
+            return qres
+    dl_path = query_result_url(q_dict, args=args, session=session,
+                               timeout=timeout, db_name=db_name)
+    if dl_path:
+        with pqi.phase("query.download", db_name=db_name) as dl_attrs:
+            dl_resp = session.get(dl_path)
+            dl_attrs["bytes"] = attrs["bytes"] = len(dl_resp.content)
+        if pqf.is_arrow(dl_resp.content):
+            with pqi.phase("query.parse", db_name=db_name, format="arrow") as parse_attrs:
+                qres = pqf.read_result(dl_resp.content)
+                parse_attrs["rows"] = attrs["rows"] = len(qres["query_result"])
+        else:
+            with pqi.phase("query.decompress", db_name=db_name) as gz_attrs:
+                body = gz.decompress(dl_resp.content)
+                gz_attrs["bytes"] = len(body)
+            object_hook = pqh.maybe_flatten_enum if flatten_enums else None
+            with pqi.phase("query.parse", db_name=db_name, flatten_enums=flatten_enums) as parse_attrs:
+                qres = json.loads(body, object_hook=object_hook)
+                parse_attrs["rows"] = attrs["rows"] = len(qres.get("query_result") or [])
+        attrs["basis_t"] = qres.get("basis_t")
         qres["db_name"] = db_name
+        if flatten_enums:
+            qres[pqh.enums_flattened_key] = True
+        pqc.note_basis_t(db_name, qres.get("basis_t"))
+        if use_cache:
+            pqc.store(key, qres)
         return qres
+
+
+def single_flight(key, fn):
+    """Call `fn()`, unless a call for the same `key` is already in flight on
+    another thread (including the worker threads of `patternq.aio`), in
+    which case wait for it and share its result, or raise its exception.
+    Returns the result and whether it was shared."""
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        return future.result(), True
+    try:
+        result = fn()
+    except BaseException as e:
+        with _in_flight_lock:
+            del _in_flight[key]
+        future.set_exception(e)
+        raise
+    with _in_flight_lock:
+        del _in_flight[key]
+    future.set_result(result)
+    return result, False
+
+
+def resolve_backend(backend):
+    """The backend a call is answered by, None for the query service."""
+    if backend is None:
+        backend = default_backend
+    if backend is None or backend.remote:
+        return None
+    return backend
+
+
+def local_query(backend, q_dict: Dict[str, List[Any]], args: List[Any] or None,
+                db_name: str, flatten_enums: bool = False) -> Dict[str, Any]:
+    """Result of a query answered by a (non remote) backend."""
+    with pqi.phase("query", db_name=db_name, backend=backend.name) as attrs:
+        qres = backend.query(q_dict, args=args, db_name=db_name, flatten_enums=flatten_enums)
+        attrs["rows"] = len(qres["query_result"])
+        attrs["basis_t"] = qres.get("basis_t")
+    qres["db_name"] = db_name
+    return qres
+
+
+def optimized(q_dict, args, optimize: bool or None, **kwargs):
+    """`q_dict` as optimized by `pqo.optimize`, if `optimize` (or, if None,
+    if optimization is enabled for the session)."""
+    if not (pqo.enabled if optimize is None else optimize):
+        return q_dict
+    return pqo.optimize(q_dict, args, sample_stats=pqo.sample, **kwargs)
+
+
+def merge_results(qress: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Concatenate the relations of several query results, in order, into
+    one result. Raises if the results were computed at different basis_t,
+    as their union would not be a consistent view of the database."""
+    basis_ts = {qres["basis_t"] for qres in qress}
+    if len(basis_ts) > 1:
+        raise Exception(f"Batched query results came from different database "
+                        f"basis_t values {sorted(basis_ts)}, re-run the query "
+                        f"to get a consistent result.")
+    merged = dict(qress[0])
+    if all(isinstance(qres["query_result"], pqf.ArrowRelations) for qres in qress):
+        merged["query_result"] = pqf.concat([qres["query_result"] for qres in qress])
     else:
-        print("Query encountered an error:")
+        merged["query_result"] = [relation for qres in qress
+                                  for relation in qres["query_result"]]
+    return merged
+
+
+def is_timeout(e: Exception) -> bool:
+    """Whether a query failed by timing out, on the query service or while
+    waiting for it."""
+    if isinstance(e, requests.exceptions.Timeout):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        if e.response.status_code in timeout_statuses:
+            return True
+        text = e.response.text.lower()
+        return "timeout" in text or "timed out" in text
+    if isinstance(e, requests.exceptions.ConnectionError):
+        # read timeouts raised through the session's Retry end as
+        # connection errors
+        return "timed out" in str(e).lower()
+    return False
+
+
+def query_batched(q_dict: Dict[str, List[Any]], args: List[Any], batch_arg: int,
+                  batch_size: int or None = None, max_workers: int or None = None,
+                  split_on_timeout: bool = False, **kwargs):
+    """Issue a query with a collection binding at `args[batch_arg]` as
+    concurrent queries over chunks of at most `batch_size` values, using up
+    to `max_workers` threads, and merge the results in chunk order. Other
+    kwargs are passed to `query`.
+
+    With `split_on_timeout=True`, a chunk whose query times out (see
+    `is_timeout`) is split in half and its halves queried concurrently,
+    down to single values.
+
+    Note that relations returned for more than one chunk (possible when the
+    collection variable is not part of :find) will appear more than once."""
+    if batch_size is None:
+        batch_size = default_batch_size
+    if max_workers is None:
+        max_workers = default_max_workers
+    coll = list(args[batch_arg])
+
+    def query_chunk(chunk):
+        chunk_args = list(args)
+        chunk_args[batch_arg] = chunk
         try:
-            print(resp.content)
-            print(json.loads(resp.content))
-        finally:
-            resp.raise_for_status()
+            return query(q_dict, args=chunk_args, **kwargs)
+        except Exception as e:
+            if not (split_on_timeout and len(chunk) > 1 and is_timeout(e)):
+                raise
+        pqi.info("query_batched", f"Query of {len(chunk)} collection values timed out, "
+                                  f"splitting it in two.", values=len(chunk))
+        half = len(chunk) // 2
+        halves = [chunk[:half], chunk[half:]]
+        contexts = [contextvars.copy_context() for _ in halves]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            return merge_results(list(executor.map(lambda ctx, h: ctx.run(query_chunk, h),
+                                                   contexts, halves)))
+
+    if len(coll) <= batch_size:
+        return query_chunk(coll)
+    chunks = [coll[i:i + batch_size] for i in range(0, len(coll), batch_size)]
+
+    # run each chunk in a copy of the caller's context, so its events carry
+    # the caller's `pqi.context` attributes.
+    contexts = [contextvars.copy_context() for _ in chunks]
+    with pqi.phase("query_batched", batches=len(chunks)) as attrs:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            qress = list(executor.map(lambda ctx, chunk: ctx.run(query_chunk, chunk),
+                                      contexts, chunks))
+        merged = merge_results(qress)
+        attrs["rows"] = len(merged["query_result"])
+        attrs["basis_t"] = merged.get("basis_t")
+    return merged
+
+
+def query_iter(q_dict: Dict[str, List[Any]], args: List[Any] or None = None,
+               chunk_size: int or None = None, meta: Dict[str, Any] or None = None,
+               session: requests.Session or None = None,
+               timeout: int = 30, db_name: str or None = None, cache: bool or None = None,
+               flatten_enums: bool = False, optimize: bool or None = None,
+               backend=None) -> Iterator[Any]:
+    """Like `query`, but streams the result download through an incremental
+    gzip and JSON decoder (or Arrow IPC reader, see `patternq.formats`),
+    yielding `query_result` relations one at a time, or as lists of up to
+    `chunk_size` relations. Peak memory is bounded by
+    the chunk size rather than the size of the result.
+
+    If a `meta` dict is provided, it is populated with `db_name` and the
+    other top level result entries such as `basis_t` as the stream is
+    consumed. `flatten_enums`, `optimize` and `backend` are as for `query`.
+    `cache` is accepted as for `query`, so wrappers can pass their kwargs
+    through, but streamed results are neither read from nor stored in the
+    result cache."""
+    if not session:
+        session = get_session()
+    if db_name is None:
+        db_name = db
+    if meta is None:
+        meta = {}
+    meta["db_name"] = db_name
+    backend = resolve_backend(backend)
+    q_dict = optimized(q_dict, args, optimize, db_name=db_name, session=session, timeout=timeout,
+                       backend=backend)
+    if backend is not None:
+        qres = local_query(backend, q_dict, args, db_name, flatten_enums)
+        meta.update((k, v) for k, v in qres.items() if k != "query_result")
+        relations = qres["query_result"]
+        if chunk_size:
+            relations = pqs.chunked(relations, chunk_size)
+        yield from relations
+        return
+    dl_path = query_result_url(q_dict, args=args, session=session,
+                               timeout=timeout, db_name=db_name)
+    if not dl_path:
+        return
+    # download, decompression and parsing are interleaved with the consumer,
+    # so the stream is reported as one phase, from first to last relation.
+    with pqi.phase("query.stream", db_name=db_name) as attrs, \
+            session.get(dl_path, stream=True, timeout=(timeout + 2)) as dl_resp:
+        dl_resp.raise_for_status()
+        attrs["bytes"] = 0
+        attrs["rows"] = 0
+
+        def counted(chunks):
+            for chunk in chunks:
+                attrs["bytes"] += len(chunk)
+                yield chunk
+        body = counted(dl_resp.iter_content(chunk_size=pqs.read_size))
+        head = next(body, b"")
+        body = itertools.chain([head], body)
+        if pqf.is_arrow(head):
+            attrs["format"] = "arrow"
+            relations = pqf.iter_relations(body, meta=meta)
+        else:
+            decoder = json.JSONDecoder(object_hook=pqh.maybe_flatten_enum if flatten_enums else None)
+            relations = pqs.iter_result(pqs.decode_chunks(pqs.gunzip_chunks(body)),
+                                        meta=meta, decoder=decoder)
+        if chunk_size:
+            relations = pqs.chunked(relations, chunk_size)
+        for relation in relations:
+            attrs["rows"] += len(relation) if chunk_size else 1
+            yield relation
+        attrs["basis_t"] = meta.get("basis_t")
 
 def datoms(index, components, offset=0, limit=1000,
-           session=None, timeout=30, db_name=None):
+           session=None, timeout=30, db_name=None, backend=None):
     if not session:
-        session = requests
+        session = get_session()
     req_body = {"index": index,
                 "components": components,
                 "offset": offset,
                 "limit": limit}
     if db_name is None:
         db_name = db
+    backend = resolve_backend(backend)
+    if backend is not None:
+        with pqi.phase("datoms", db_name=db_name, index=index, offset=offset,
+                       backend=backend.name) as attrs:
+            page = backend.datoms(index, components, offset=offset, limit=limit, db_name=db_name)
+            attrs["rows"] = len(page)
+            return page
     headers = make_headers(accept="application/json")
     endpoint = f"{commons_endpoint()}/datoms/{db_name}"
-    resp = requests.post(
-        endpoint,
-        json.dumps(req_body),
-        headers=headers,
-        timeout=(timeout + 2)
-    )
-    if resp.status_code == 200:
-        return json.loads(resp.content)
-    else:
-        print("Datoms call encountered an error:")
-        try:
-            print(resp.content)
-            print(json.loads(resp.content))
-        finally:
-            resp.raise_for_status()
+    with pqi.phase("datoms", db_name=db_name, index=index, offset=offset) as attrs:
+        resp = session.post(
+            endpoint,
+            json.dumps(req_body),
+            headers=headers,
+            timeout=(timeout + 2)
+        )
+        attrs["status"] = resp.status_code
+        attrs["bytes"] = len(resp.content)
+        if resp.status_code == 200:
+            page = json.loads(resp.content)
+            attrs["rows"] = len(page or [])
+            return page
+    report_error("datoms", resp, db_name=db_name)
 
 
-def get_measurement_matrix(matrix_key: str, session: requests.Session or None = None,
-                           db_name: str or None = None):
+def iter_datoms(index, components, page_size=1000, prefetch=2, offset=0,
+                session=None, timeout=30, db_name=None, backend=None):
+    """Yields the datoms of `index` matching `components`, paging through
+    the index `page_size` datoms at a time. Up to `prefetch` following pages
+    are requested in the background while the current page is consumed."""
     if not session:
-        session = requests
+        session = get_session()
+    if db_name is None:
+        db_name = db
+    fetch_page = partial(datoms, index, components, limit=page_size,
+                         session=session, timeout=timeout, db_name=db_name, backend=backend)
+    executor = ThreadPoolExecutor(max_workers=prefetch + 1)
+    pending = deque()
+    next_offset = offset
+
+    def request_page():
+        nonlocal next_offset
+        pending.append(executor.submit(contextvars.copy_context().run, fetch_page,
+                                       offset=next_offset))
+        next_offset += page_size
+
+    try:
+        for _ in range(prefetch + 1):
+            request_page()
+        while pending:
+            page = pending.popleft().result() or []
+            if len(page) < page_size:
+                yield from page
+                return
+            request_page()
+            yield from page
+    finally:
+        for f in pending:
+            f.cancel()
+        executor.shutdown(wait=False)
+
+
+datom_fields = ["e", "a", "v", "tx", "added"]
+
+
+def datoms_frame(index, components, **kwargs) -> pd.DataFrame:
+    """Like `iter_datoms`, but accumulates datoms column-wise, with entity
+    and transaction ids in int64 arrays, and returns a DataFrame with
+    columns e, a, v, tx (and added, when the datoms carry it)."""
+    es = array("q")
+    txs = array("q")
+    attrs = []
+    vals = []
+    addeds = []
+    for datom in iter_datoms(index, components, **kwargs):
+        if isinstance(datom, dict):
+            datom = [datom.get(field) for field in datom_fields]
+        es.append(datom[0])
+        attrs.append(datom[1])
+        vals.append(datom[2])
+        txs.append(datom[3])
+        if len(datom) > 4 and datom[4] is not None:
+            addeds.append(datom[4])
+    columns = {"e": np.frombuffer(es, dtype=np.int64),
+               "a": pd.Categorical(attrs),
+               "v": pd.Series(vals, dtype=None if vals else object),
+               "tx": np.frombuffer(txs, dtype=np.int64)}
+    if addeds and len(addeds) == len(es):
+        columns["added"] = np.array(addeds, dtype=bool)
+    return pd.DataFrame(columns)
+
+
+def matrix_url(matrix_key: str, session: requests.Session or None = None,
+               db_name: str or None = None):
+    """Returns the presigned URL the gzip'd TSV backing `matrix_key` can be
+    downloaded from."""
+    if not session:
+        session = get_session()
     req_body = {}
     if db_name is None:
         db_name = db
     headers = make_headers(accept="text/plain")
     endpoint = f"{commons_endpoint()}/matrix/{db_name}/{matrix_key}"
-    # TODO: cache/store to named temporary file?
-    fd = NamedTemporaryFile(mode="wb", delete=False)
-    print(f"Writing measurement matrix to local disk as: {fd.name}")
-    try:
-        resp = requests.post(
+    with pqi.phase("matrix.request", db_name=db_name) as attrs:
+        resp = session.post(
             endpoint,
             json.dumps(req_body),
             headers=headers,
         )
-        s3_presigned_url = resp.content
-        r = requests.get(s3_presigned_url, stream=True)
-        for chunk in r.iter_content(chunk_size=1024*8):
-            fd.write(chunk)
+        attrs["status"] = resp.status_code
+    if resp.status_code != 200:
+        report_error("matrix", resp, db_name=db_name, matrix_key=matrix_key)
+    return resp.content
+
+
+def project_matrix(df: pd.DataFrame, columns: List[str] or None = None,
+                   rows: List[str] or None = None) -> pd.DataFrame:
+    """Select `columns` (the leading row label column is always kept) and
+    the rows whose label is in `rows` from a measurement matrix frame."""
+    label = df.columns[0]
+    if columns is not None:
+        df = df[[label] + [col for col in columns if col != label]]
+    if rows is not None:
+        df = df[df[label].isin(rows)]
+    return df
+
+
+def iter_measurement_matrix(matrix_key: str, chunksize: int,
+                            columns: List[str] or None = None, rows: List[str] or None = None,
+                            session: requests.Session or None = None,
+                            db_name: str or None = None) -> Iterator[pd.DataFrame]:
+    """Yields the measurement matrix as DataFrames of up to `chunksize` rows
+    (before `rows` filtering), parsed while the download is in progress, so
+    matrices larger than memory can be filtered or aggregated."""
+    if not session:
+        session = get_session()
+    s3_presigned_url = matrix_url(matrix_key, session=session, db_name=db_name)
+    with session.get(s3_presigned_url, stream=True) as r:
+        r.raise_for_status()
+        with gz.GzipFile(fileobj=r.raw) as body:
+            header = body.readline().decode("utf-8").rstrip("\r\n").split("\t")
+            usecols = None
+            if columns is not None:
+                wanted = set(columns)
+                usecols = [col for i, col in enumerate(header) if i == 0 or col in wanted]
+            reader = pd.read_csv(body, sep='\t', header=None, names=header,
+                                 usecols=usecols, chunksize=chunksize)
+            for chunk in reader:
+                yield project_matrix(chunk, columns=columns, rows=rows)
+
+
+def get_measurement_matrix(matrix_key: str, session: requests.Session or None = None,
+                           db_name: str or None = None, cache: bool or None = None,
+                           columns: List[str] or None = None, rows: List[str] or None = None,
+                           chunksize: int or None = None):
+    """Returns the measurement matrix backed by `matrix_key` as a DataFrame.
+    When the cache is enabled (see `patternq.cache.enable`), or with
+    `cache=True`, the matrix is stored in the local matrix cache on first
+    download (see `patternq.cache.store_matrix`), and later calls load it
+    memory mapped from there instead of downloading and parsing again.
+
+    `columns` and `rows` project the matrix to the given columns and to rows
+    whose (leading column) label is listed. With `chunksize`, returns an
+    iterator of row blocks streamed from the download instead, see
+    `iter_measurement_matrix`."""
+    if not session:
+        session = get_session()
+    if db_name is None:
+        db_name = db
+    if chunksize:
+        return iter_measurement_matrix(matrix_key, chunksize, columns=columns, rows=rows,
+                                       session=session, db_name=db_name)
+    use_cache = pqc.enabled if cache is None else cache
+    if use_cache:
+        cached = pqc.load_matrix(db_name, matrix_key)
+        if cached is not None:
+            return project_matrix(cached, columns=columns, rows=rows)
+    fd = NamedTemporaryFile(mode="wb", delete=False, suffix=".tsv.gz.tmp",
+                            dir=pqc.directory("matrix") if use_cache else None)
+    try:
+        s3_presigned_url = matrix_url(matrix_key, session=session, db_name=db_name)
+        with pqi.phase("matrix.download", db_name=db_name) as attrs, \
+                session.get(s3_presigned_url, stream=True) as r:
+            r.raise_for_status()
+            attrs["bytes"] = 0
+            for chunk in r.iter_content(chunk_size=1024*8):
+                fd.write(chunk)
+                attrs["bytes"] += len(chunk)
         fd.close()
-        return pd.read_csv(fd.name, compression='gzip', header=0, sep='\t')
+        usecols = None
+        with pqi.phase("matrix.parse", db_name=db_name) as attrs:
+            if columns is not None and not use_cache:
+                header = pd.read_csv(fd.name, compression='gzip', sep='\t', nrows=0).columns
+                wanted = set(columns)
+                usecols = [col for i, col in enumerate(header) if i == 0 or col in wanted]
+            df = pd.read_csv(fd.name, compression='gzip', header=0, sep='\t', usecols=usecols)
+            attrs["rows"] = len(df)
     except requests.exceptions.RequestException as e:
         # just re-raise until we decide how to handle
         raise e
+    finally:
+        fd.close()
+        os.remove(fd.name)
+    if use_cache:
+        pqi.info("matrix.cache", f"Caching measurement matrix on local disk under: "
+                                 f"{pqc.matrix_path(db_name, matrix_key)}",
+                 db_name=db_name, matrix_key=matrix_key)
+        pqc.store_matrix(db_name, matrix_key, df)
+    return project_matrix(df, columns=columns, rows=rows)
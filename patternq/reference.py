@@ -1,7 +1,6 @@
+import copy
 from typing import List
 
-import pandas as pd
-
 import patternq.helpers as pqh
 import patternq.query as pqq
 
@@ -29,18 +28,17 @@ genes_query = {
     ":where":
         [["?g", ":gene/hgnc-symbol"]]
 }
+genes_fields = pqh.compile_pull(genes_query)
 
 
-def genes(db_name: str or None = None, **kwargs):
+def genes(db_name: str or None = None, output: str = "frame", **kwargs):
     """Returns all genes and associated attributes from reference
     data in database specified by db_name, or default database
     for session."""
     qres = pqq.query(genes_query,
                      db_name=db_name,
-                     **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
+                     flatten_enums=True, **kwargs)
+    qres_df = genes_fields(qres, output=output)
     return qres_df
 
 
@@ -57,11 +55,9 @@ gene_coords_query = {
     ]
 }
 
-def gene_coordinates(db_name: str or None = None, **kwargs):
-    qres = pqq.query(gene_coords_query, db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pd.DataFrame(qres["query_result"], columns=["hgnc-symbol", "contig", "strand", "start", "end"])
-    return qres_df
+def gene_coordinates(db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(gene_coords_query, db_name=db_name, flatten_enums=True, **kwargs)
+    return pqh.relations_output(qres, ["hgnc-symbol", "contig", "strand", "start", "end"], output)
 
 
 gdc_anatomic_sites_query = {
@@ -89,6 +85,7 @@ variant_pull = [":variant/ref-allele",
                 {":variant/genomic-coordinates": [":genomic-coordinate/id"]},
                 {":variant/so-consequences": [":so-sequence-feature/name", ":db/id"]},
                 {":variant/gene": [":gene/hgnc-symbol"]}]
+variant_fields = pqh.compile_pull(variant_pull)
 
 all_variants_q = {
     ":find": [["pull", "?v", variant_pull]],
@@ -97,30 +94,28 @@ all_variants_q = {
 }
 
 
-def all_variants(db_name: str or None = None, **kwargs):
-    qres = pqq.query(all_variants_q, db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    if "variant-so-consequences" in qres_df.columns:
+def all_variants(db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query(all_variants_q, db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = variant_fields(qres, output=output)
+    if output == "frame" and "variant-so-consequences" in qres_df.columns:
         qres_df = pqh.expand_many_nested(qres_df, "variant-so-consequences")
     return qres_df
 
 
-variant_q = all_variants_q.copy()
+variant_q = copy.deepcopy(all_variants_q)
 variant_q[":in"] = ["$", ["?variant-id", "..."]]
 variant_q[":where"][0].append("?variant-id")
 
 
-def variant_info(variant_ids: List[str], db_name: str or None = None, **kwargs):
-    qres = pqq.query(variant_q, args=[variant_ids], db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    # TODO: investigate how this is working, atm it breaks things.
-    # if "variant-so-consequences" in qres_df.columns:
-    #    qres_df = pqh.expand_many_nested(qres_df, "variant-so-consequences")
-    return qres_df
+def variant_info(variant_ids: List[str], db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query_batched(variant_q, args=[variant_ids], batch_arg=0,
+                             db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = variant_fields(qres, output=output)
+    if output != "frame":
+        return qres_df
+    if "variant-so-consequences" in qres_df.columns:
+        qres_df = pqh.expand_many_nested(qres_df, "variant-so-consequences")
+    return pqh.add_provenance(qres_df, qres)
 
 genes2variantsq = {
     ":find": [["pull", "?v", variant_pull]],
@@ -130,9 +125,10 @@ genes2variantsq = {
      ["?v", ":variant/gene", "?g"]]
 }
 
-def variants_for_genes(genes: List[str], db_name: str or None = None, **kwargs):
-    qres = pqq.query(genes2variantsq, args=[genes], db_name=db_name, **kwargs)
-    qres = pqh.flatten_enum_idents(qres)
-    qres_df = pqh.pull2fields(qres)
-    qres_df = pqh.clean_column_names(qres_df)
-    return qres_df
+def variants_for_genes(genes: List[str], db_name: str or None = None, output: str = "frame", **kwargs):
+    qres = pqq.query_batched(genes2variantsq, args=[genes], batch_arg=0,
+                             db_name=db_name, flatten_enums=True, **kwargs)
+    qres_df = variant_fields(qres, output=output)
+    if output != "frame":
+        return qres_df
+    return pqh.add_provenance(qres_df, qres)
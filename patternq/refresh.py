@@ -0,0 +1,150 @@
+"""Incremental refresh of frames held in memory, e.g. by a long running
+service, from the transactions since the basis_t in their provenance (see
+`pqh.add_provenance`):
+
+    import patternq.refresh as pqrefresh
+
+    subjects = pqd.subjects("tcga-brca")
+    ...
+    subjects = pqrefresh.subjects(subjects, "tcga-brca")
+
+Rather than pulling every entity again, a refresh asks the query service
+for the frame's root entities (see `ids_query`), and for those with datoms
+asserted since the frame's basis_t, on themselves or the entities they
+refer to (see `changed_query`). Only changed and new entities are pulled
+again, and the rows of entities that left the dataset or were retracted
+are dropped. Patched rows are appended, under a new index label per
+entity (frames like `pqd.subjects` have one row per value of a
+cardinality many attribute, all under the entity's label), to a new frame
+whose provenance is the basis_t read at; other rows keep their labels.
+
+The current database only holds asserted datoms, so changes that only
+retract (e.g. a value retracted without a new one asserted), and changes
+to entities referred to through more than one ref (e.g. the treatment
+regimen of a sample's timepoint), are not picked up."""
+from typing import Any, Callable, Dict, List
+
+import patternq.dataset as pqd
+import patternq.helpers as pqh
+import patternq.instrument as pqi
+import patternq.lazy as pql
+import patternq.query as pqq
+
+pd = pql.lazy_import("pandas")
+
+# the column of refreshable frames holding each row's entity id
+id_column = "db-id"
+# transaction entity ids are t plus the transaction partition's base id
+tx_base = 3 * 2 ** 42
+
+
+def t_to_tx(t: int) -> int:
+    """The id of the transaction entity of t."""
+    return tx_base + t
+
+
+def root_var(q_dict: Dict[str, List[Any]]) -> str:
+    """The variable pulled by a pull query."""
+    return q_dict[":find"][0][1]
+
+
+def restricted_query(q_dict: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+    """`q_dict` restricted to the root entities bound by an extra collection
+    input."""
+    return dict(q_dict, **{":in": q_dict.get(":in", ["$"]) + [[root_var(q_dict), "..."]]})
+
+
+def ids_query(q_dict: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+    """Query of the ids of the root entities of `q_dict`, taking the same
+    args."""
+    return {":find": [root_var(q_dict)],
+            ":in": q_dict.get(":in", ["$"]),
+            ":where": q_dict[":where"]}
+
+
+def changed_query(q_dict: Dict[str, List[Any]], via_ref: bool = False) -> Dict[str, List[Any]]:
+    """Query of the root entities of `q_dict` with datoms asserted after
+    the transaction of an extra input, or if `via_ref`, referring to
+    entities with such datoms."""
+    root = root_var(q_dict)
+    where = list(q_dict[":where"])
+    e = root
+    if via_ref:
+        where.append([root, "?refresh-ref", "?refresh-e"])
+        where.append(["?refresh-ref", ":db/valueType", ":db.type/ref"])
+        e = "?refresh-e"
+    where.append([e, "?refresh-a", "?refresh-v", "?refresh-tx"])
+    where.append([[">", "?refresh-tx", "?refresh-since-tx"]])
+    return {":find": [root],
+            ":in": q_dict.get(":in", ["$"]) + ["?refresh-since-tx"],
+            ":where": where}
+
+
+def patch(df, new, ids):
+    """`df` without the rows of the entities `ids`, and with the rows of
+    `new` appended under a new index label per entity, as a new frame."""
+    kept = df[~df[id_column].isin(ids)]
+    if not len(new):
+        return kept
+    start = int(df.index.max()) + 1 if len(df) else 0
+    codes, _ = pd.factorize(new[id_column])
+    new = new.set_axis(pd.Index(start + codes))
+    return pd.concat([kept, new])
+
+
+def refresh(df, q_dict: Dict[str, List[Any]], args: List[Any], frame: Callable,
+            db_name: str or None = None, batch_size: int or None = None,
+            max_workers: int or None = None, **kwargs):
+    """Patch `df`, the frame `frame(qres)` built from the result of the pull
+    query `q_dict` with `args`, with the changes to its entities since its
+    provenance's basis_t (see the module docstring). `df` needs an
+    integer index and an `id_column`. Changed entities are pulled by
+    `pqq.query_batched` with `batch_size` and `max_workers`, other kwargs
+    (e.g. session, timeout) are passed to every query. Results are never
+    read from the cache. Returns the patched frame, leaving `df` as it was."""
+    provenance = pqh.get_provenance(df)
+    if provenance is None:
+        raise ValueError("Frame has no provenance to refresh from, see pqh.add_provenance")
+    if id_column not in df.columns:
+        raise ValueError(f"Frame has no {id_column} column to match entities by")
+    if len(df) and not pd.api.types.is_integer_dtype(df.index):
+        raise ValueError("Frame needs an integer index to append patched rows to")
+    if db_name is None:
+        db_name = provenance.unify_db_name
+    kwargs = dict(kwargs, db_name=db_name, cache=False)
+    since = provenance.unify_basis_t
+    basis_t = pqq.query(pqq.basis_t_q, **kwargs)["basis_t"]
+    if basis_t == since:
+        return df
+    with pqi.phase("refresh", db_name=db_name, since=since, basis_t=basis_t) as attrs:
+        args = list(args)
+        ids = {r[0] for r in pqq.query(ids_query(q_dict), args=args, **kwargs)["query_result"]}
+        changed = set()
+        for via_ref in (False, True):
+            qres = pqq.query(changed_query(q_dict, via_ref), args=args + [t_to_tx(since)], **kwargs)
+            changed.update(r[0] for r in qres["query_result"])
+        present = set(df[id_column])
+        stale = sorted(changed | (ids - present))
+        attrs["changed"] = len(stale)
+        attrs["removed"] = len(present - ids)
+        new = df.iloc[:0]
+        if stale:
+            qres = pqq.query_batched(restricted_query(q_dict), args + [stale], len(args),
+                                     batch_size=batch_size, max_workers=max_workers,
+                                     flatten_enums=True, **kwargs)
+            new = frame(qres)
+        attrs["rows"] = len(new)
+        df = patch(df, new, set(stale) | (present - ids))
+    # later transactions may already show in the patched rows, but are
+    # asked for again by the next refresh.
+    return pqh.add_provenance(df, {"db_name": db_name, "basis_t": basis_t})
+
+
+def subjects(df, dataset: str, db_name: str or None = None, **kwargs):
+    """Refresh a `pqd.subjects(dataset)` frame, see `refresh`."""
+    return refresh(df, pqd.subjects_q, [dataset], pqd.subjects_frame, db_name=db_name, **kwargs)
+
+
+def samples(df, dataset: str, db_name: str or None = None, **kwargs):
+    """Refresh a `pqd.samples(dataset)` frame, see `refresh`."""
+    return refresh(df, pqd.samplesq, [dataset], pqd.samples_fields, db_name=db_name, **kwargs)
@@ -0,0 +1,239 @@
+"""Export of a dataset's subjects, samples, assays, clinical events,
+measurements (per measurement set) and variants to a local Parquet store,
+partitioned by dataset, entity and measurement set:
+
+    {path}/dataset={dataset}/entity={entity}[/measurement-set={name}]/part-0.parquet
+
+Partitions are fetched concurrently. A manifest.json next to them records,
+per partition, the basis_t it was exported at and a fingerprint of its
+entities' datoms (their count and latest transaction, see
+`fingerprint_query`). Re-running an export fetches only the partitions whose
+fingerprint changed, which also resumes an interrupted export:
+
+    import patternq.snapshot as pqsnap
+
+    manifest = pqsnap.export("tcga-brca", "/data/snapshots", db_name="tcga-brca")
+    subjects = pqsnap.read("/data/snapshots", "tcga-brca", "subjects")
+
+Fingerprints cover the attributes of each partition's own entities, not the
+entities its pulls nest (e.g. a sample's subject id), use `refresh=True` to
+re-fetch everything. Writing and reading Parquet requires pyarrow."""
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List
+from urllib.parse import quote
+
+import patternq.dataset as pqd
+import patternq.formats as pqf
+import patternq.instrument as pqi
+import patternq.lazy as pql
+import patternq.query as pqq
+import patternq.reference as pqr
+
+pd = pql.lazy_import("pandas")
+
+Partition = namedtuple("Partition", ["key", "entity", "measurement_set",
+                                     "q_dict", "args", "batch_arg", "fetch"])
+
+manifest_name = "manifest.json"
+part_name = "part-0.parquet"
+default_max_workers = 4
+# the column of measurement partitions naming the measured variants
+variant_id_column = "measurement-variant-variant-id"
+
+
+def fingerprint_query(q_dict: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+    """Query of the number of datoms, and the latest transaction among them,
+    of the entities pulled by `q_dict`, taking the same args."""
+    root = q_dict[":find"][0][1]
+    return {":find": [["count", "?fp-v"], ["max", "?fp-tx"]],
+            ":with": [root, "?fp-a"],
+            ":in": q_dict.get(":in", ["$"]),
+            ":where": q_dict[":where"] + [[root, "?fp-a", "?fp-v", "?fp-tx"]]}
+
+
+def fingerprint(partition: Partition, db_name: str or None = None, **kwargs) -> List[Any]:
+    """[datom count, latest transaction] of a partition's entities."""
+    q_dict = fingerprint_query(partition.q_dict)
+    if partition.batch_arg is None:
+        qres = pqq.query(q_dict, args=partition.args, db_name=db_name, cache=False, **kwargs)
+    else:
+        qres = pqq.query_batched(q_dict, partition.args, partition.batch_arg,
+                                 db_name=db_name, cache=False, **kwargs)
+    relations = qres["query_result"]
+    return [sum(r[0] for r in relations), max((r[1] for r in relations), default=None)]
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def dataset_dir(path: str, dataset: str) -> str:
+    return os.path.join(path, f"dataset={quote(dataset, safe='')}")
+
+
+def partition_file(path: str, dataset: str, entity: str,
+                   measurement_set: str or None = None) -> str:
+    parts = [dataset_dir(path, dataset), f"entity={entity}"]
+    if measurement_set is not None:
+        parts.append(f"measurement-set={quote(measurement_set, safe='')}")
+    return os.path.join(*parts, part_name)
+
+
+def load_manifest(path: str, dataset: str) -> Dict[str, Any] or None:
+    """The manifest of a dataset's snapshot under `path`, or None."""
+    try:
+        with open(os.path.join(dataset_dir(path, dataset), manifest_name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(file: str, value):
+    tmp = f"{file}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(value, f, indent=2, sort_keys=True)
+    os.replace(tmp, file)
+
+
+def _write_parquet(df, file: str):
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    # nested values (lists, maps) sit in object columns next to NaN for
+    # missing values, which Arrow can't convert.
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].astype(object).where(df[col].notna(), None)
+    tmp = f"{file}.{threading.get_ident()}.tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, file)
+
+
+def _parquet_columns(file: str) -> List[str]:
+    pqf.pyarrow("Parquet snapshots")
+    import pyarrow.parquet as pq
+    return pq.read_schema(file).names
+
+
+def read(path: str, dataset: str, entity: str, measurement_set: str or None = None,
+         columns: List[str] or None = None):
+    """Frame of one partition of a snapshot, see `export`."""
+    pqf.pyarrow("Parquet snapshots")
+    return pd.read_parquet(partition_file(path, dataset, entity, measurement_set),
+                           columns=columns)
+
+
+def core_partitions(dataset: str) -> List[Partition]:
+    return [Partition("subjects", "subjects", None, pqd.subjects_q, [dataset], None,
+                      lambda **kw: pqd.subjects(dataset, **kw)),
+            Partition("samples", "samples", None, pqd.samplesq, [dataset], None,
+                      lambda **kw: pqd.samples(dataset, **kw)),
+            Partition("assays", "assays", None, pqd.assay_summary_q, [dataset], None,
+                      lambda **kw: pqd.assay_summary(dataset, **kw))]
+
+
+def clinical_partition(dataset: str, subject_ids: List[str]) -> Partition:
+    return Partition("clinical-events", "clinical-events", None, pqd.clinical_query,
+                     [dataset, subject_ids], 1,
+                     lambda **kw: pqd.clinical_events_for_patients(dataset, subject_ids, **kw))
+
+
+def measurement_partition(dataset: str, measurement_set: str) -> Partition:
+    return Partition(f"measurements/{measurement_set}", "measurements", measurement_set,
+                     pqd.measurements_q, [dataset, measurement_set], None,
+                     lambda **kw: pqd.measurements(dataset, measurement_set, compact=True, **kw))
+
+
+def variants_partition(variant_ids: List[str]) -> Partition:
+    return Partition("variants", "variants", None, pqr.variant_q, [variant_ids], 0,
+                     lambda **kw: pqr.variant_info(variant_ids, **kw))
+
+
+def export(dataset: str, path: str, db_name: str or None = None,
+           max_workers: int or None = None, refresh: bool = False, **kwargs) -> Dict[str, Any]:
+    """Export `dataset` to a Parquet store under `path` (see the module
+    docstring), fetching only partitions that are new or whose fingerprint
+    changed since they were exported, or all of them if `refresh`. Up to
+    `max_workers` partitions are fetched at a time. Other kwargs are passed
+    to the wrappers. Returns the manifest."""
+    pqf.pyarrow("Parquet snapshots")
+    if max_workers is None:
+        max_workers = default_max_workers
+    if db_name is None:
+        db_name = pqq.db
+    basis_t = pqq.query(pqq.basis_t_q, db_name=db_name, cache=False, **kwargs)["basis_t"]
+    manifest = load_manifest(path, dataset)
+    if manifest is None or refresh or manifest.get("db_name") != db_name:
+        manifest = {"dataset": dataset, "db_name": db_name, "partitions": {}}
+    elif manifest.get("complete") and manifest.get("basis_t") == basis_t:
+        return manifest
+    manifest.update(basis_t=basis_t, complete=False)
+    entries = manifest["partitions"]
+    manifest_file = os.path.join(dataset_dir(path, dataset), manifest_name)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    lock = threading.Lock()
+
+    def sync(partition: Partition):
+        file = partition_file(path, dataset, partition.entity, partition.measurement_set)
+        entry = entries.get(partition.key)
+        args_digest = _digest(partition.args)
+        with pqi.phase("snapshot.partition", partition=partition.key) as attrs:
+            current = entry is not None and entry["args"] == args_digest and os.path.exists(file)
+            if current and entry["basis_t"] == basis_t:
+                attrs["fetched"] = False
+                return
+            fp = fingerprint(partition, db_name=db_name, **kwargs)
+            attrs["fetched"] = not (current and fp == entry["fingerprint"])
+            if attrs["fetched"]:
+                df = partition.fetch(db_name=db_name, **kwargs)
+                _write_parquet(df, file)
+                attrs["rows"] = len(df)
+                entry = {"entity": partition.entity,
+                         "measurement-set": partition.measurement_set,
+                         "file": os.path.relpath(file, dataset_dir(path, dataset)),
+                         "rows": len(df),
+                         "args": args_digest,
+                         "fingerprint": fp,
+                         "exported": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            with lock:
+                entries[partition.key] = dict(entry, basis_t=basis_t)
+                _write_json(manifest_file, manifest)
+
+    def sync_all(partitions: List[Partition]):
+        contexts = [contextvars.copy_context() for _ in partitions]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(partitions)))) as executor:
+            list(executor.map(lambda ctx, p: ctx.run(sync, p), contexts, partitions))
+
+    with pqi.phase("snapshot.export", dataset=dataset, db_name=db_name, basis_t=basis_t):
+        partitions = core_partitions(dataset)
+        sync_all(partitions)
+        subject_ids = read(path, dataset, "subjects", columns=["subject-id"])["subject-id"]
+        measurement_sets = read(path, dataset, "assays", columns=["measurement-set-name"])
+        measurement_sets = measurement_sets["measurement-set-name"].dropna().unique().tolist()
+        stage = [clinical_partition(dataset, sorted(subject_ids.dropna().unique().tolist()))]
+        stage += [measurement_partition(dataset, ms) for ms in sorted(measurement_sets)]
+        sync_all(stage)
+        partitions += stage
+        variant_ids = set()
+        for p in stage[1:]:
+            file = partition_file(path, dataset, p.entity, p.measurement_set)
+            if variant_id_column in _parquet_columns(file):
+                variant_ids.update(read(path, dataset, p.entity, p.measurement_set,
+                                        columns=[variant_id_column])[variant_id_column].dropna())
+        if variant_ids:
+            partitions.append(variants_partition(sorted(variant_ids)))
+            sync_all(partitions[-1:])
+    # partitions no longer in the dataset, e.g. of a removed measurement set
+    keys = {p.key for p in partitions}
+    for key in [key for key in entries if key not in keys]:
+        stale = os.path.join(dataset_dir(path, dataset), entries.pop(key)["file"])
+        shutil.rmtree(os.path.dirname(stale), ignore_errors=True)
+    manifest["complete"] = True
+    _write_json(manifest_file, manifest)
+    return manifest
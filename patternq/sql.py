@@ -0,0 +1,406 @@
+"""Bulk tabular reads over SQL, from the relational (Trino) view of a
+database, laid out as in sql/trino_queries.sql:
+
+- a table per attribute namespace, named with `_` for `-` and `.`
+  (`:measurement-set/...` is table `measurement_set`), keyed by `db__id`,
+  with a row per entity having an attribute of the namespace;
+- a column per cardinality one attribute, named by the attribute's name
+  the same way (`:measurement-set/name` is column `name`), or as given in
+  `column_names` (`:subject/age-at-diagnosis` is column `age`); refs hold
+  the db__id they point to, booleans may be 0/1;
+- a `{table}_x_{column}` table per cardinality many attribute, with the
+  entity's db__id in column `{table}` and the value in column `{column}`
+  (`:subject/race` is table `subject_x_race`, columns `subject`, `race`);
+- the idents of enums in table `db__idents`, columns `db__id`, `ident`.
+
+Whole tables of subjects or expression values scan far cheaper there than
+as query results, so the functions here are SQL equivalents of the high
+volume `patternq.dataset` wrappers, with the same column names and dtypes:
+enum idents are resolved in the join and booleans cast back from 0/1.
+They read through any DB-API connection with qmark parameters
+(trino.dbapi, sqlite3, duckdb), set per call or for the session:
+
+    import trino
+    import patternq.sql as pqsql
+
+    pqsql.use(trino.dbapi.connect(host=..., catalog="tcga-brca", schema="tcga-brca"))
+    subjects = pqsql.subjects("tcga-brca")
+    for batch in pqsql.iter_batches(pqsql.gene_expression_sql("tpm"), ["rna-seq"],
+                                    output="arrow"):
+        ...
+
+`build_sqlite` lays out a SQLite stand-in with the same tables from a local
+copy of a database (see `patternq.backend.build_local`), for working and
+testing offline. Arrow output requires pyarrow."""
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, get_args
+
+import patternq.backend as pqb
+import patternq.dataset as pqd
+import patternq.formats as pqf
+import patternq.instrument as pqi
+import patternq.lazy as pql
+
+pd = pql.lazy_import("pandas")
+
+output_modes = ("frame", "arrow", "records")
+# the session's connection, see `use`
+default_connection = None
+# rows fetched from the cursor at a time
+default_batch_size = 100000
+# values bound per IN list
+max_params = 500
+# columns of the relational view not named by their attribute's name
+column_names = {":subject/age-at-diagnosis": "age"}
+# SQL column types of attribute value types, in `build_sqlite`
+column_types = {":db.type/string": "TEXT", ":db.type/keyword": "TEXT", ":db.type/uuid": "TEXT",
+                ":db.type/uri": "TEXT", ":db.type/ref": "INTEGER", ":db.type/long": "INTEGER",
+                ":db.type/instant": "INTEGER", ":db.type/boolean": "INTEGER",
+                ":db.type/double": "REAL", ":db.type/float": "REAL", ":db.type/bigdec": "REAL"}
+
+
+def use(connection):
+    """Read through the DB-API `connection` (None for none), unless another
+    is passed per call."""
+    global default_connection
+    default_connection = connection
+
+
+def resolve_connection(connection):
+    connection = connection if connection is not None else default_connection
+    if connection is None:
+        raise ValueError("No SQL connection, pass connection= or see patternq.sql.use")
+    return connection
+
+
+def table_name(namespace: str) -> str:
+    """Table of an attribute namespace, e.g. measurement_set."""
+    return namespace.lstrip(":").replace("-", "_").replace(".", "_")
+
+
+def column_name(name: str) -> str:
+    return name.replace("-", "_").replace(".", "_")
+
+
+def attribute_column(ident: str) -> str:
+    """Column of a cardinality one attribute, e.g. name for
+    :measurement-set/name."""
+    return column_names.get(ident) or column_name(ident.partition("/")[2])
+
+
+def quote_name(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _batch(rows, columns, output):
+    if output == "records":
+        return [dict(zip(columns, row)) for row in rows]
+    if output == "arrow":
+        pa = pqf.pyarrow("Arrow output")
+        values = list(zip(*rows)) if rows else [[] for _ in columns]
+        return pa.RecordBatch.from_arrays([pa.array(v) for v in values], names=columns)
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+
+def iter_batches(sql: str, params: List[Any] or None = None, connection=None,
+                 batch_size: int or None = None, output: str = "frame") -> Iterator[Any]:
+    """Result of `sql` in batches of up to `batch_size` rows (default
+    `default_batch_size`): frames, Arrow record batches or lists of
+    records, see `output_modes`."""
+    if output not in output_modes:
+        raise ValueError(f"output must be one of {output_modes}, not {output!r}")
+    if output == "arrow":
+        pqf.pyarrow("Arrow output")
+    if batch_size is None:
+        batch_size = default_batch_size
+    cursor = resolve_connection(connection).cursor()
+    try:
+        with pqi.phase("sql.execute"):
+            cursor.execute(sql, list(params or []))
+        columns = [d[0] for d in cursor.description]
+        while True:
+            with pqi.phase("sql.fetch") as attrs:
+                rows = cursor.fetchmany(batch_size)
+                attrs["rows"] = len(rows)
+            if not rows:
+                break
+            yield _batch(rows, columns, output)
+    finally:
+        cursor.close()
+
+
+def _concat(batches: List[Any], output: str):
+    if output == "records":
+        return [r for batch in batches for r in batch]
+    if output == "arrow":
+        pa = pqf.pyarrow("Arrow output")
+        return pa.Table.from_batches(batches)
+    if len(batches) == 1:
+        return batches[0]
+    return pd.concat(batches, ignore_index=True)
+
+
+def cast_booleans(result, columns: List[str], output: str):
+    """`result` of `read` with `columns` as booleans, for engines without a
+    boolean type (SQLite) that return them as 0/1. NULLs stay missing."""
+    if output == "records":
+        for record in result:
+            for c in columns:
+                if record[c] is not None:
+                    record[c] = bool(record[c])
+        return result
+    if output == "arrow":
+        pa = pqf.pyarrow("Arrow output")
+        for c in columns:
+            i = result.schema.get_field_index(c)
+            result = result.set_column(i, c, result.column(c).cast(pa.bool_()))
+        return result
+    for c in columns:
+        result[c] = result[c].map(bool, na_action="ignore")
+    return result
+
+
+def read(sql: str, params: List[Any] or None = None, connection=None,
+         output: str = "frame", **kwargs):
+    """Whole result of `sql`, as a frame, an Arrow table or records. Other
+    kwargs are passed to `iter_batches`."""
+    batches = list(iter_batches(sql, params, connection=connection, output=output, **kwargs))
+    if not batches:
+        # no rows: run again for the columns of an empty result
+        cursor = resolve_connection(connection).cursor()
+        try:
+            cursor.execute(sql, list(params or []))
+            batches = [_batch([], [d[0] for d in cursor.description], output)]
+        finally:
+            cursor.close()
+    return _concat(batches, output)
+
+
+# -- dataset queries
+
+subjects_sql = """
+SELECT s.db__id AS "db-id",
+       s.id AS "subject-id",
+       sex.ident AS "subject-sex",
+       race.ident AS "subject-race",
+       ethnicity.ident AS "subject-ethnicity",
+       stage.ident AS "subject-disease-stage",
+       s.age AS "subject-age-at-diagnosis",
+       s.dead AS "subject-dead",
+       md.preferred_name AS "subject-meddra-disease-meddra-disease-preferred-name"
+FROM dataset d
+JOIN dataset_x_subjects dxs ON dxs.dataset = d.db__id
+JOIN subject s ON s.db__id = dxs.subjects
+LEFT JOIN db__idents sex ON sex.db__id = s.sex
+LEFT JOIN subject_x_race sxr ON sxr.subject = s.db__id
+LEFT JOIN db__idents race ON race.db__id = sxr.race
+LEFT JOIN db__idents ethnicity ON ethnicity.db__id = s.ethnicity
+LEFT JOIN db__idents stage ON stage.db__id = s.disease_stage
+LEFT JOIN meddra_disease md ON md.db__id = s.meddra_disease
+WHERE d.name = ?
+ORDER BY s.db__id"""
+
+
+subject_therapies_sql = """
+SELECT sxt.subject AS "db-id",
+       t."order" AS "order",
+       tr.name AS "treatment-regimen-name"
+FROM dataset d
+JOIN dataset_x_subjects dxs ON dxs.dataset = d.db__id
+JOIN subject_x_therapies sxt ON sxt.subject = dxs.subjects
+JOIN therapy t ON t.db__id = sxt.therapies
+LEFT JOIN treatment_regimen tr ON tr.db__id = t.treatment_regimen
+WHERE d.name = ?
+ORDER BY sxt.subject, t.db__id"""
+
+
+def subject_therapies(dataset: str, connection=None) -> Dict[int, List[Dict[str, Any]]]:
+    """Therapies of the subjects of a dataset by subject db-id, each as
+    pulled by `pqd.subjects_q`."""
+    therapies = defaultdict(list)
+    for r in read(subject_therapies_sql, [dataset], connection=connection, output="records"):
+        therapy = {}
+        if r["order"] is not None:
+            therapy[":therapy/order"] = r["order"]
+        if r["treatment-regimen-name"] is not None:
+            therapy[":therapy/treatment-regimen"] = {
+                ":treatment-regimen/name": r["treatment-regimen-name"]}
+        therapies[r["db-id"]].append(therapy)
+    return dict(therapies)
+
+
+def subjects(dataset: str, connection=None, output: str = "frame", **kwargs):
+    """Subjects of a dataset, a row per race like `pqd.subjects`, with the
+    subject's therapies (see `subject_therapies`) on each."""
+    result = read(subjects_sql, [dataset], connection=connection, output=output, **kwargs)
+    result = cast_booleans(result, ["subject-dead"], output)
+    therapies = subject_therapies(dataset, connection=connection)
+    column = "subject-therapies"
+    if output == "records":
+        return [dict(r, **{column: therapies.get(r["db-id"])}) for r in result]
+    if output == "arrow":
+        pa = pqf.pyarrow("Arrow output")
+        values = pa.array([therapies.get(e) for e in result.column("db-id").to_pylist()])
+        return result.add_column(result.schema.get_field_index("subject-dead") + 1, column, values)
+    result.insert(result.columns.get_loc("subject-dead") + 1, column, result["db-id"].map(therapies))
+    return result
+
+
+samples_sql = """
+SELECT sa.db__id AS "db-id",
+       sa.id AS "sample-id",
+       specimen.ident AS "sample-specimen",
+       sa.type AS "sample-type-db-id",
+       su.id AS "sample-subject-subject-id",
+       tp.id AS "sample-timepoint-timepoint-id",
+       site.name AS "sample-gdc-anatomic-site-gdc-anatomic-site-name"
+FROM dataset d
+JOIN dataset_x_samples dxs ON dxs.dataset = d.db__id
+JOIN sample sa ON sa.db__id = dxs.samples
+LEFT JOIN db__idents specimen ON specimen.db__id = sa.specimen
+LEFT JOIN gdc_anatomic_site site ON site.db__id = sa.gdc_anatomic_site
+LEFT JOIN subject su ON su.db__id = sa.subject
+LEFT JOIN timepoint tp ON tp.db__id = sa.timepoint
+WHERE d.name = ?
+ORDER BY sa.db__id"""
+
+
+def samples(dataset: str, connection=None, output: str = "frame", **kwargs):
+    return read(samples_sql, [dataset], connection=connection, output=output, **kwargs)
+
+
+def measurement_column(measurement_attr: pqd.RNASeqMeasurementAttribute) -> str:
+    """Column of the measurement table holding `measurement_attr`, which is
+    checked, as it is formatted into the SQL."""
+    if measurement_attr not in get_args(pqd.RNASeqMeasurementAttribute):
+        raise ValueError(f"Unknown measurement attribute {measurement_attr!r}, expected one of "
+                         f"{get_args(pqd.RNASeqMeasurementAttribute)}")
+    return column_name(measurement_attr)
+
+
+def gene_expression_sql(measurement_attr: pqd.RNASeqMeasurementAttribute) -> str:
+    """SQL of the `measurement_attr` values of a measurement set (the one
+    parameter), like `pqd.gene_expression_measurements`."""
+    return f"""
+SELECT sa.id AS "sample-id",
+       g.hgnc_symbol AS "hgnc-symbol",
+       m.{measurement_column(measurement_attr)} AS {quote_name(measurement_attr)}
+FROM measurement_set ms
+JOIN measurement_set_x_measurements msxm ON msxm.measurement_set = ms.db__id
+JOIN measurement m ON m.db__id = msxm.measurements
+JOIN gene_product gp ON gp.db__id = m.gene_product
+JOIN gene g ON g.db__id = gp.gene
+JOIN sample sa ON sa.db__id = m.sample
+WHERE ms.name = ? AND m.{measurement_column(measurement_attr)} IS NOT NULL"""
+
+
+def gene_expression_measurements(measurement_set: str,
+                                 measurement_attr: pqd.RNASeqMeasurementAttribute,
+                                 connection=None, output: str = "frame", **kwargs):
+    return read(gene_expression_sql(measurement_attr), [measurement_set],
+                connection=connection, output=output, **kwargs)
+
+
+def cohort_expression_sql(measurement_attr: pqd.RNASeqMeasurementAttribute, n_genes: int) -> str:
+    """SQL of the `measurement_attr` values of `n_genes` genes (the
+    parameters), like `pqd.cohort_expression_for_genes`."""
+    return f"""
+SELECT g.hgnc_symbol AS "hgnc-symbol",
+       m.{measurement_column(measurement_attr)} AS {quote_name(measurement_attr)}
+FROM gene g
+JOIN gene_product gp ON gp.gene = g.db__id
+JOIN measurement m ON m.gene_product = gp.db__id
+WHERE g.hgnc_symbol IN ({", ".join("?" * n_genes)})
+  AND m.{measurement_column(measurement_attr)} IS NOT NULL"""
+
+
+def cohort_expression_for_genes(measurement_attr: pqd.RNASeqMeasurementAttribute, genes: List[str],
+                                connection=None, output: str = "frame", **kwargs):
+    """All `measurement_attr` values of the genes, `max_params` genes per
+    statement."""
+    genes = list(dict.fromkeys(genes))
+    batches = []
+    for i in range(0, len(genes), max_params):
+        chunk = genes[i:i + max_params]
+        batches.extend(iter_batches(cohort_expression_sql(measurement_attr, len(chunk)), chunk,
+                                    connection=connection, output=output, **kwargs))
+    if not batches:
+        return read(cohort_expression_sql(measurement_attr, 1), [None],
+                    connection=connection, output=output)
+    return _concat(batches, output)
+
+
+variant_measurements_sql = """
+SELECT m.vaf AS "measurement-vaf",
+       sa.id AS "measurement-sample-sample-id",
+       v.id AS "measurement-variant-variant-id"
+FROM measurement_set ms
+JOIN measurement_set_x_measurements msxm ON msxm.measurement_set = ms.db__id
+JOIN measurement m ON m.db__id = msxm.measurements
+JOIN variant v ON v.db__id = m.variant
+LEFT JOIN sample sa ON sa.db__id = m.sample
+WHERE ms.name = ?"""
+
+
+def variant_measurements(measurement_set: str, connection=None, output: str = "frame", **kwargs):
+    return read(variant_measurements_sql, [measurement_set],
+                connection=connection, output=output, **kwargs)
+
+
+# -- stand-in
+
+def build_sqlite(path: str, local_path: str) -> str:
+    """Lay out the datoms of a local copy of a database (see
+    `pqb.build_local`) as the relational view's tables, in a SQLite file at
+    `path`. Returns the path."""
+    store = pqb.SQLiteStore(local_path)
+    tables = defaultdict(list)
+    for a in store.attributes.values():
+        namespace, _, name = a.ident.lstrip(":").partition("/")
+        if namespace == "db" or namespace.startswith("db."):
+            continue
+        tables[table_name(namespace)].append((a, attribute_column(a.ident)))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with pqi.phase("sql.build", tables=len(tables)):
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.execute("ATTACH DATABASE ? AS src", [store.path])
+            conn.execute("CREATE TABLE db__idents (db__id INTEGER PRIMARY KEY, ident TEXT)")
+            conn.execute("INSERT INTO db__idents SELECT e, v FROM src.datoms WHERE a = ':db/ident'")
+            for table, attrs in sorted(tables.items()):
+                one = [(a, c) for a, c in attrs if not a.many]
+                columns = ["db__id INTEGER PRIMARY KEY"] + [
+                    f"{quote_name(c)} {column_types.get(a.value_type, '')}" for a, c in one]
+                conn.execute(f"CREATE TABLE {quote_name(table)} ({', '.join(columns)})")
+                # every entity with an attribute of the namespace gets a row
+                pivot = "".join(", MAX(CASE WHEN a = ? THEN v END)" for _ in one)
+                idents = [a.ident for a, _ in attrs]
+                conn.execute(f"INSERT INTO {quote_name(table)} SELECT e{pivot} FROM src.datoms"
+                             f" WHERE a IN ({', '.join('?' * len(idents))}) GROUP BY e",
+                             [a.ident for a, _ in one] + idents)
+                for a, c in one:
+                    if a.value_type == ":db.type/ref" or a.unique:
+                        conn.execute(f"CREATE INDEX {quote_name(f'{table}_{c}')}"
+                                     f" ON {quote_name(table)} ({quote_name(c)})")
+                for a, c in attrs:
+                    if not a.many:
+                        continue
+                    many = f"{table}_x_{c}"
+                    conn.execute(f"CREATE TABLE {quote_name(many)} ({quote_name(table)} INTEGER,"
+                                 f" {quote_name(c)} {column_types.get(a.value_type, '')})")
+                    conn.execute(f"INSERT INTO {quote_name(many)} SELECT e, v FROM src.datoms"
+                                 f" WHERE a = ?", [a.ident])
+                    conn.execute(f"CREATE INDEX {quote_name(f'{many}_{table}')}"
+                                 f" ON {quote_name(many)} ({quote_name(table)})")
+                    conn.execute(f"CREATE INDEX {quote_name(f'{many}_{c}')}"
+                                 f" ON {quote_name(many)} ({quote_name(c)})")
+            conn.commit()
+            conn.execute("DETACH DATABASE src")
+        finally:
+            conn.close()
+    os.replace(tmp, path)
+    return path
@@ -0,0 +1,181 @@
+"""Incremental decoding of gzip'd JSON query results, so that large results
+can be consumed relation by relation without holding the compressed body,
+the decompressed text and the full parsed result in memory at once."""
+import codecs
+import json
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List
+
+whitespace = " \t\n\r"
+number_chars = "0123456789+-.eE"
+# bytes read from the download per network read.
+read_size = 64 * 1024
+
+
+def gunzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Incrementally decompress an iterable of gzip'd byte chunks, including
+    multi-member gzip streams."""
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            out = decomp.decompress(chunk)
+            if out:
+                yield out
+            chunk = b""
+            if decomp.eof and decomp.unused_data:
+                chunk = decomp.unused_data
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    tail = decomp.flush()
+    if tail:
+        yield tail
+
+
+def decode_chunks(chunks: Iterable[bytes], encoding: str = "utf-8") -> Iterator[str]:
+    """Incrementally decode byte chunks to text, handling multi-byte
+    characters split across chunk boundaries."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+class JSONReader:
+    """Reads JSON values one at a time from an iterable of text chunks,
+    keeping only the undecoded remainder of the stream buffered."""
+
+    def __init__(self, chunks: Iterable[str], decoder: json.JSONDecoder or None = None):
+        self.chunks = iter(chunks)
+        self.decoder = decoder or json.JSONDecoder()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Append at least as much text as is currently buffered (so that
+        retried decodes of a large value stay linear), returns False at end
+        of stream."""
+        remaining = self.text[self.pos:]
+        parts = [remaining]
+        wanted = max(len(remaining), 1)
+        read = 0
+        for chunk in self.chunks:
+            parts.append(chunk)
+            read += len(chunk)
+            if read >= wanted:
+                break
+        else:
+            self.eof = True
+        self.text = "".join(parts)
+        self.pos = 0
+        return read > 0
+
+    def peek(self) -> str:
+        """Returns next non-whitespace character without consuming it, or
+        the empty string at end of stream."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in whitespace:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.eof or not self.fill():
+                return ""
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed query result stream: expected one of {chars!r}, "
+                             f"found {char or 'end of stream'!r}")
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.eof and self.fill():
+                    continue
+                raise
+            # a number cut off by the buffer end (e.g. "-2." of "-2.5e-3")
+            # decodes as a shorter number, so decode again with more text.
+            if isinstance(obj, (int, float)) and not self.eof \
+                    and not self.text[end:].strip(number_chars) and self.fill():
+                continue
+            self.pos = end
+            return obj
+
+    def array_elements(self, attempts: int = 4) -> List[Any]:
+        """Decodes, in one pass of the JSON decoder, the array elements that
+        are arrays themselves (e.g. relations) buffered ahead of the current
+        position, up to the last "]," found, and consumes them along with
+        the comma. A "]," within an element (in a string, or a nested array)
+        leaves the brackets unbalanced, so the decode fails and the previous
+        "]," is tried, up to `attempts` times. Returns [] when no elements
+        could be decoded this way."""
+        self.peek()
+        if self.pos >= len(self.text) or self.text[self.pos] != "[":
+            return []
+        cut = len(self.text)
+        for _ in range(attempts):
+            cut = self.text.rfind("],", self.pos, cut)
+            if cut < 0:
+                return []
+            try:
+                values = self.decoder.decode("[" + self.text[self.pos:cut + 1] + "]")
+            except json.JSONDecodeError:
+                continue
+            self.pos = cut + 2
+            return values
+        return []
+
+
+def iter_result(chunks: Iterable[str], key: str = "query_result",
+                meta: Dict[str, Any] or None = None,
+                decoder: json.JSONDecoder or None = None) -> Iterator[Any]:
+    """Given the text chunks of a JSON object, yields the elements of the
+    array stored under `key` one at a time. All other top level entries
+    (e.g. basis_t) are decoded into `meta` as they are encountered."""
+    if meta is None:
+        meta = {}
+    reader = JSONReader(chunks, decoder)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        entry_key = reader.value()
+        reader.expect(":")
+        if entry_key == key and reader.peek() == "[":
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                while True:
+                    # many buffered relations at a time where possible
+                    elements = reader.array_elements()
+                    if elements:
+                        yield from elements
+                        continue
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            meta[entry_key] = reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+
+def chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Group items into lists of at most `size`."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,36 @@
+"""Fixtures shared by the tests: the mock query service of
+benchmarks/mockserver.py, serving small synthetic fixtures."""
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, "benchmarks"))
+
+import mockserver  # noqa: E402
+
+scale = 0.01
+
+
+@pytest.fixture(scope="session")
+def mock_server():
+    """A mock query service, with patternq pointed at it."""
+    server = mockserver.start(scale)
+    env = {"PATTERNQ_ENDPOINT": server.url, "PATTERNQ_API_KEY": "test"}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    yield server
+    server.shutdown()
+    server.server_close()
+    for k, v in saved.items():
+        if v is None:
+            os.environ.pop(k, None)
+        else:
+            os.environ[k] = v
+
+
+@pytest.fixture(scope="session")
+def python_env():
+    """Environment for python subprocesses importing this checkout."""
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([root] + sys.path[1:]))
@@ -0,0 +1,77 @@
+"""A LocalBackend built from the mock query service answers every wrapper
+as the service does."""
+import pandas as pd
+import pytest
+
+import patternq.backend as pqb
+import patternq.dataset as pqd
+import patternq.query as pqq
+
+import mockserver
+import suite
+from conftest import scale
+
+
+@pytest.fixture(scope="module")
+def local(mock_server, tmp_path_factory):
+    return pqb.LocalBackend(pqb.build_local(str(tmp_path_factory.mktemp("local") / "mock.sqlite")))
+
+
+@pytest.fixture(scope="module")
+def calls(mock_server):
+    return suite.cases(suite.fixture_ids())
+
+
+def normalized(df):
+    """`df` with its rows in a canonical order, as query results are sets."""
+    if isinstance(df, list):
+        return sorted(df)
+    df = df.sparse.to_dense() if hasattr(df, "sparse") else df
+    order = df.astype(str).sort_values(list(df.columns), kind="stable").index
+    return df.loc[order].reset_index(drop=True)
+
+
+@pytest.mark.parametrize("name", [name for name, _ in suite.cases(dict.fromkeys(
+    ["subjects", "samples", "variants", "genes", "matrix"], []))])
+def test_local_matches_remote(name, calls, local):
+    call = dict(calls)[name]
+    remote = call()
+    pqb.use(local)
+    try:
+        result = call()
+    finally:
+        pqb.use(None)
+    if isinstance(remote, pd.DataFrame):
+        assert list(result.columns) == list(remote.columns)
+        pd.testing.assert_frame_equal(normalized(result), normalized(remote))
+    else:
+        assert normalized(result) == normalized(remote)
+
+
+def test_local_results_are_copies(local):
+    first = pqd.samples("tcga-brca", output="raw", backend=local)
+    first["query_result"].clear()
+    assert pqd.samples("tcga-brca", output="raw", backend=local)["query_result"]
+
+
+def test_build_fails_on_transactions_during_walk(tmp_path, monkeypatch):
+    server = mockserver.start(scale)
+    monkeypatch.setenv("PATTERNQ_ENDPOINT", server.url)
+    monkeypatch.setenv("PATTERNQ_API_KEY", "test")
+    iter_datoms = pqq.iter_datoms
+
+    def transacting(*args, **kwargs):
+        for i, datom in enumerate(iter_datoms(*args, **kwargs)):
+            if i == 0:
+                server.fixtures.transact([[":db/add", server.fixtures.subjects[0],
+                                           ":subject/age-at-diagnosis", 99]])
+            yield datom
+    monkeypatch.setattr(pqq, "iter_datoms", transacting)
+    path = tmp_path / "mock.sqlite"
+    try:
+        with pytest.raises(Exception, match="basis_t"):
+            pqb.build_local(str(path), page_size=1000)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not path.exists()
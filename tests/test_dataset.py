@@ -0,0 +1,18 @@
+import pytest
+
+import patternq.dataset as pqd
+
+
+@pytest.mark.parametrize("options", [{"wide": True}, {"compact": True}])
+def test_streamed_wrappers_take_cache(options, mock_server):
+    # streamed results are never cached, but callers pass the same kwargs
+    streamed = pqd.gene_expression_measurements("rna-seq", "tpm", cache=False, **options)
+    assert streamed.equals(pqd.gene_expression_measurements("rna-seq", "tpm", **options))
+
+
+def test_cohort_gene_expression(mock_server):
+    gene = pqd.cohort_expression_for_genes("tpm", ["GENE0"])
+    df = pqd.cohort_gene_expression("tpm", "GENE0")
+    assert len(df) and list(df.columns) == ["tpm", "hgnc-symbol"]
+    # a :find of ?value alone is a set of values
+    assert sorted(df["tpm"]) == sorted(gene["tpm"].drop_duplicates())
@@ -0,0 +1,42 @@
+import sys
+
+import pytest
+
+import patternq.dataset as pqd
+import patternq.formats as pqf
+import patternq.query as pqq
+
+import mockserver
+from conftest import scale
+
+
+def relations(**kwargs):
+    return pqq.query(pqd.measurement_matrices_q, ["tcga-brca"], cache=False,
+                     **kwargs)["query_result"]
+
+
+def test_arrow_when_enabled(mock_server, monkeypatch):
+    monkeypatch.setattr(pqf, "enabled", True)
+    assert isinstance(relations(), pqf.ArrowRelations)
+
+
+def test_json_without_pyarrow(mock_server, monkeypatch):
+    monkeypatch.setattr(pqf, "enabled", True)
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    assert pqf.accepted() == ["json-gzip"]
+    assert isinstance(relations(), list)
+    with pytest.raises(ImportError, match="pyarrow"):
+        pqf.enable()
+
+
+def test_json_from_service(monkeypatch):
+    server = mockserver.start(scale, json_only=True)
+    monkeypatch.setenv("PATTERNQ_ENDPOINT", server.url)
+    monkeypatch.setenv("PATTERNQ_API_KEY", "test")
+    monkeypatch.setattr(pqf, "enabled", True)
+    try:
+        result = relations()
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert isinstance(result, list) and result
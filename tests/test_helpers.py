@@ -0,0 +1,39 @@
+import copy
+import math
+
+import patternq.helpers as pqh
+
+
+def test_flatten_enum_idents_copies_on_write():
+    qres = {"basis_t": 1,
+            "query_result": [[{"a": {":db/ident": ":x/y"},
+                               "b": [{"c": {":db/ident": ":z"}}, {"d": 1}],
+                               "e": {"f": 2}}],
+                             [3]]}
+    original = copy.deepcopy(qres)
+    flat = pqh.flatten_enum_idents(qres)
+    assert qres == original
+    assert flat["query_result"] == [[{"a": ":x/y", "b": [{"c": ":z"}, {"d": 1}], "e": {"f": 2}}], [3]]
+    assert flat == pqh.postwalk(pqh.maybe_flatten_enum, original) | {pqh.enums_flattened_key: True}
+    # containers without enums are shared
+    assert flat["query_result"][1] is qres["query_result"][1]
+    assert flat["query_result"][0][0]["e"] is qres["query_result"][0][0]["e"]
+
+
+def test_flatten_enum_idents_deeply_nested():
+    nested = {":db/ident": ":deep/enum"}
+    for _ in range(3000):
+        nested = {"child": [nested]}
+    flat = pqh.flatten_enum_idents({"query_result": [[nested]]})["query_result"][0][0]
+    for _ in range(3000):
+        flat = flat["child"][0]
+    assert flat == ":deep/enum"
+
+
+def test_triples_matrix_grows_from_empty_shape():
+    triples = [("r0", "c0", 1.0), ("r1", "c2", 2.0), ("r0", "c1", 3.0)]
+    X, rows, cols = pqh.triples_matrix(triples, shape=(0, 0))
+    assert rows == ["r0", "r1"] and cols == ["c0", "c2", "c1"]
+    assert X.shape == (2, 3)
+    assert X[0, 0] == 1.0 and X[1, 1] == 2.0 and X[0, 2] == 3.0
+    assert math.isnan(X[1, 0])
@@ -0,0 +1,38 @@
+"""pandas and numpy are only imported once a DataFrame is built, see
+patternq.lazy and benchmarks/bench_import.py."""
+import subprocess
+import sys
+
+import pytest
+
+from bench_import import heavy, lean_modules
+
+loaded_probe = "import sys; print(*[name for name in {heavy!r} if name in sys.modules])"
+
+output_probe = """
+import patternq.dataset as pqd
+result = pqd.{call}
+assert isinstance(result, {kind}), type(result)
+""" + loaded_probe
+
+
+def loaded(code, env):
+    """The heavy modules loaded by running `code` in a fresh interpreter."""
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                         env=env)
+    assert out.returncode == 0, out.stderr
+    return out.stdout.split()
+
+
+@pytest.mark.parametrize("module", lean_modules)
+def test_import_is_lean(module, python_env):
+    assert loaded(f"import {module}\n" + loaded_probe.format(heavy=heavy), python_env) == []
+
+
+@pytest.mark.parametrize("output, kind", [("records", "list"), ("raw", "dict")])
+@pytest.mark.parametrize("call", ['samples("tcga-brca", output={output!r})',
+                                  'gene_expression_measurements("rna-seq", "tpm", output={output!r})'])
+def test_output_without_pandas(call, output, kind, mock_server, python_env):
+    code = output_probe.format(call=call.format(output=output), kind=kind, heavy=heavy)
+    assert loaded(code, dict(python_env, PATTERNQ_ENDPOINT=mock_server.url,
+                             PATTERNQ_API_KEY="test")) == []
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+import patternq.cache as pqc
+import patternq.dataset as pqd
+import patternq.matrix as pqm
+import patternq.query as pqq
+
+ad = pytest.importorskip("anndata")
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_backed_anndata(cached, mock_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(pqc, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(pqc, "enabled", cached)
+    matrix = pqd.measurement_matrices("tcga-brca").iloc[0]
+    dense = pqm.anndata(matrix, dataset="tcga-brca", sparse=False)
+    sparse = pqm.anndata(matrix, dataset="tcga-brca", sparse=True)
+    # written next to, not into, the matrix cache, one file per option
+    assert os.path.dirname(dense.filename) == pqc.directory("anndata")
+    assert dense.filename != sparse.filename
+    assert pqm.anndata(matrix, dataset="tcga-brca", sparse=False).filename == dense.filename
+    if cached:
+        key = pqm.matrix_key_of(matrix)
+        assert pqc.load_matrix(pqq.db, key).shape[0] == dense.n_vars
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import mockserver
+from conftest import scale
+
+import patternq.cache as pqc
+import patternq.dataset as pqd
+import patternq.instrument as pqi
+import patternq.query as pqq
+
+
+def received(server, monkeypatch):
+    """Query requests `server` receives from now on."""
+    sent = []
+    run_query = server.run_query
+
+    def counted(body, accepted=()):
+        sent.append(body)
+        return run_query(body, accepted)
+    monkeypatch.setattr(server, "run_query", counted)
+    return sent
+
+
+@pytest.fixture
+def sent(mock_server, monkeypatch):
+    """Query requests the mock server received."""
+    return received(mock_server, monkeypatch)
+
+
+@pytest.fixture
+def cached(tmp_path, monkeypatch):
+    """The result cache, enabled in a directory of this test's own."""
+    monkeypatch.setattr(pqc, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(pqc, "enabled", True)
+    monkeypatch.setattr(pqc, "_basis_ts", {})
+    pqc.reset_stats()
+
+
+def subjects_sent(sent):
+    return [body for body in sent if body["query"] == pqd.subjects_q]
+
+
+def test_timed_out_query_sent_once(mock_server, sent, monkeypatch):
+    monkeypatch.setattr(mock_server, "max_rows", 1)
+    # results of earlier tests would be served without running the query
+    monkeypatch.setattr(mock_server, "results", OrderedDict())
+    session = pqq.make_session(backoff_factor=0)
+    with pytest.raises(requests.exceptions.HTTPError) as e:
+        pqq.query(pqd.subjects_q, ["tcga-brca"], session=session, cache=False)
+    assert pqq.is_timeout(e.value)
+    assert len(sent) == 1
+
+
+
+def test_repeated_query_from_cache(sent, cached):
+    first = pqq.query(pqd.subjects_q, ["tcga-brca"])
+    assert pqq.query(pqd.subjects_q, ["tcga-brca"]) == first
+    assert len(subjects_sent(sent)) == 1
+    stats = pqc.stats()
+    assert (stats.hits, stats.misses, stats.stores) == (1, 1, 1)
+
+
+def test_stale_entry_refetched(cached, monkeypatch):
+    # transacts, so on a server of its own
+    server = mockserver.start(scale)
+    monkeypatch.setenv("PATTERNQ_ENDPOINT", server.url)
+    monkeypatch.setenv("PATTERNQ_API_KEY", "test")
+    try:
+        sent = received(server, monkeypatch)
+        first = pqq.query(pqd.subjects_q, ["tcga-brca"])
+        server.fixtures.transact([[":db/add", server.fixtures.subjects[0],
+                                   ":subject/age-at-diagnosis", 120]])
+        # the cached entry is served until basis_t is checked again
+        assert pqq.query(pqd.subjects_q, ["tcga-brca"]) == first
+        monkeypatch.setattr(pqc, "basis_check_interval", 0)
+        fresh = pqq.query(pqd.subjects_q, ["tcga-brca"])
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert fresh["basis_t"] > first["basis_t"]
+    assert 120 in [s[":subject/age-at-diagnosis"] for (s,) in fresh["query_result"]]
+    assert len(subjects_sent(sent)) == 2
+    stats = pqc.stats()
+    assert (stats.hits, stats.misses) == (1, 2)
+
+
+def test_concurrent_queries_coalesced(mock_server, sent, monkeypatch):
+    # long enough a request for the others to find it in flight
+    monkeypatch.setattr(mock_server, "latency", 0.3)
+    events = []
+    pqi.add_hook(events.append)
+    try:
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda _: pqq.query(pqd.subjects_q, ["tcga-brca"], cache=False),
+                                    range(4)))
+    finally:
+        pqi.remove_hook(events.append)
+    assert len(subjects_sent(sent)) == 1
+    assert all(qres == results[0] for qres in results)
+    assert sum(bool(e.attrs.get("coalesced")) for e in events if e.name == "query") == 3
@@ -0,0 +1,96 @@
+import pandas as pd
+import pytest
+
+import patternq.dataset as pqd
+import patternq.helpers as pqh
+import patternq.instrument as pqi
+import patternq.refresh as pqrefresh
+
+import mockserver
+from conftest import scale
+
+dataset = "tcga-brca"
+
+
+@pytest.fixture
+def fixtures(monkeypatch):
+    """Fixtures of a mock server of this test's own, as it transacts."""
+    server = mockserver.start(scale)
+    monkeypatch.setenv("PATTERNQ_ENDPOINT", server.url)
+    monkeypatch.setenv("PATTERNQ_API_KEY", "test")
+    yield server.fixtures
+    server.shutdown()
+    server.server_close()
+
+
+def assert_refreshed(df, fresh, key):
+    """`df` holds the rows of `fresh`, whatever their order and labels."""
+    def canonical(frame):
+        frame = frame[fresh.columns].astype(str)
+        return frame.sort_values(key).reset_index(drop=True)
+    pd.testing.assert_frame_equal(canonical(df), canonical(fresh))
+    assert pqh.get_provenance(df).unify_basis_t == pqh.get_provenance(fresh).unify_basis_t
+
+
+def test_unchanged(fixtures):
+    subjects = pqd.subjects(dataset)
+    assert pqrefresh.subjects(subjects, dataset) is subjects
+
+
+def test_refresh(fixtures):
+    subjects, samples = pqd.subjects(dataset), pqd.samples(dataset)
+    s0, s1, s2 = fixtures.subjects[:3]
+    fixtures.transact([
+        [":db/add", s0, ":subject/age-at-diagnosis", 99],
+        [":db/add", s1, ":subject/race", fixtures.ident(":subject.race/asian")],
+        [":db/add", "new", ":subject/id", "TCGA-NEW"],
+        [":db/add", "new", ":subject/sex", fixtures.ident(":subject.sex/male")],
+        [":db/add", fixtures.dataset, ":dataset/subjects", "new"],
+        [":db/retract", fixtures.dataset, ":dataset/subjects", s2],
+        # shows in samples through their subject
+        [":db/add", s0, ":subject/id", "TCGA-RENAMED"],
+    ])
+    events = []
+    pqi.add_hook(events.append)
+    try:
+        refreshed = pqrefresh.subjects(subjects, dataset)
+    finally:
+        pqi.remove_hook(events.append)
+    assert_refreshed(refreshed, pqd.subjects(dataset), ["subject-id", "subject-race"])
+    assert [e.attrs["removed"] for e in events if e.name == "refresh"] == [1]
+    # other rows keep their labels, patched ones are appended
+    assert refreshed.groupby(level=0)["db-id"].nunique().eq(1).all()
+    assert refreshed.index.max() > subjects.index.max()
+    assert_refreshed(pqrefresh.samples(samples, dataset), pqd.samples(dataset), ["sample-id"])
+
+    first, second = fixtures.entities[fixtures.dataset][":dataset/samples"][:2]
+    fixtures.transact([[":db/retractEntity", first]])
+    samples = pqd.samples(dataset)
+    fixtures.transact([[":db/retractEntity", second]])
+    assert_refreshed(pqrefresh.samples(samples, dataset), pqd.samples(dataset), ["sample-id"])
+
+
+def test_refresh_labels_entities(fixtures):
+    subjects = pqd.subjects(dataset)
+    s0 = fixtures.subjects[0]
+    fixtures.transact([
+        [":db/add", s0, ":subject/race", fixtures.ident(":subject.race/asian")],
+        [":db/add", s0, ":subject/race", fixtures.ident(":subject.race/black")],
+        [":db/add", "new", ":subject/id", "TCGA-NEW"],
+        [":db/add", "new", ":subject/race", fixtures.ident(":subject.race/asian")],
+        [":db/add", "new", ":subject/race", fixtures.ident(":subject.race/white")],
+        [":db/add", fixtures.dataset, ":dataset/subjects", "new"],
+    ])
+    refreshed = pqrefresh.subjects(subjects, dataset)
+    assert_refreshed(refreshed, pqd.subjects(dataset), ["subject-id", "subject-race"])
+    # like pqd.subjects, one label per subject, shared by its race rows
+    patched = refreshed[refreshed.index > subjects.index.max()]
+    assert {s0, fixtures.lookup(":subject/id", "TCGA-NEW")} <= set(patched["db-id"])
+    assert (patched["db-id"] == s0).sum() > 1
+    assert patched.index.to_series().groupby(patched["db-id"].values).nunique().eq(1).all()
+    assert patched.groupby(level=0)["db-id"].nunique().eq(1).all()
+
+
+def test_requires_provenance(fixtures):
+    with pytest.raises(ValueError):
+        pqrefresh.subjects(pd.DataFrame({"db-id": [1]}), dataset)
@@ -0,0 +1,41 @@
+"""The SQLite stand-in of the relational view, built from the mock query
+service, reads as the `patternq.dataset` wrappers do."""
+import sqlite3
+
+import pytest
+
+import patternq.backend as pqb
+import patternq.dataset as pqd
+import patternq.sql as pqsql
+
+
+@pytest.fixture(scope="module")
+def connection(mock_server, tmp_path_factory):
+    path = tmp_path_factory.mktemp("sql")
+    local = pqb.build_local(str(path / "mock.sqlite"))
+    connection = sqlite3.connect(pqsql.build_sqlite(str(path / "view.sqlite"), local))
+    yield connection
+    connection.close()
+
+
+def canonical(df):
+    df = df.astype(str)
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("name", ["subjects", "samples"])
+def test_matches_dataset(name, connection):
+    remote = getattr(pqd, name)("tcga-brca")
+    local = getattr(pqsql, name)("tcga-brca", connection=connection)
+    assert list(local.columns) == list(remote.columns)
+    assert local.dtypes.equals(remote.dtypes)
+    assert len(local) == len(remote)
+    assert canonical(local).equals(canonical(remote))
+
+
+def test_booleans(connection):
+    records = pqsql.subjects("tcga-brca", connection=connection, output="records")
+    assert {type(r["subject-dead"]) for r in records} == {bool}
+    pytest.importorskip("pyarrow")
+    table = pqsql.subjects("tcga-brca", connection=connection, output="arrow")
+    assert str(table.schema.field("subject-dead").type) == "bool"